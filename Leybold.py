@@ -1,17 +1,641 @@
 #!/usr/bin/env python
 
+import itertools
 import operator
+import math
+import sys
 import time
-from collections import deque
+from array import array
 import threading
 from Queue import Queue, Empty
+from collections import deque, namedtuple
+from instrumentation import Histogram, parse_latency_bounds, command_latency_bounds
+
+class PressureHistory(object):
+    """ A circular buffer of (time, pressure) samples in preallocated arrays.
+
+    Alongside the samples, the running sum of the pressure values is
+    stored, so the mean over the last N samples is available in constant
+    time without copying the buffer.
+
+    The running sums are published with the head, the sample count and
+    the sum evicted so far as one tuple with a single assignment (like
+    GaugeState), and rebased on a fresh array at each wrap-around, so
+    mean() in another thread doesn't mix two bases. """
+    # readings per sample, more in a decimated history (see decimation.py):
+    readings_per_sample = 1
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.times = array('d', [0.]) * capacity
+        self.values = array('d', [0.]) * capacity
+        self._sums = array('d', [0.]) * capacity
+        self._total = 0.
+        # the running sums of the current lap, the rebased sums for the next wrap:
+        self._lap_sums = array('d', [0.]) * capacity
+        self._lap_total = 0.
+        self._evicted = 0. # running sum up to (excluding) the oldest sample
+        self._head = 0 # the slot to be written next
+        self._count = 0
+        self.written = 0 # the sequence number of the next sample
+        self._changes = 0 # incremented before the arrays are changed
+        self._publish()
+
+    def __len__(self):
+        return self._count
+
+    def _publish(self):
+        self._snapshot = (self._sums, self._head, self._count, self._evicted, self._changes)
+
+    def append(self, timestamp, value):
+        self._changes += 1
+        slot = self._head
+        if self._count == self.capacity:
+            self._evicted = self._sums[slot]
+        else:
+            self._count += 1
+        self._total += value
+        self._lap_total += value
+        self.times[slot] = timestamp
+        self.values[slot] = value
+        self._sums[slot] = self._total
+        self._lap_sums[slot] = self._lap_total
+        slot += 1
+        if slot == self.capacity:
+            slot = 0
+            self._rebase()
+        self._head = slot
+        self.written += 1
+        self._publish()
+
+    def _rebase(self):
+        """ Switches to the running sums of the lap just completed, so they
+            don't drag along rounding errors of evicted values. These were
+            summed up with each sample, there is no pass over the buffer. """
+        (self._sums, self._lap_sums) = (self._lap_sums, self._sums)
+        self._total = self._lap_total
+        self._lap_total = 0.
+        self._evicted = 0.
+
+    def _slot(self, age):
+        """ The slot of the sample with the given age (0 being the newest). """
+        return (self._head - 1 - age) % self.capacity
+
+    def mean(self, num_samples):
+        while True:
+            (sums, head, count, evicted, changes) = self._snapshot
+            n = min(num_samples, count)
+            if n <= 0:
+                raise NoDataError('cannot calculate an average pressure without any values.')
+            high = sums[(head - 1) % self.capacity]
+            if n == count:
+                low = evicted
+            else:
+                low = sums[(head - 1 - n) % self.capacity]
+            # the slots read may have been overwritten by a sample appended meanwhile:
+            if self._changes == changes:
+                break
+        total = high - low
+        if total < 1e-6 * (abs(high) + abs(low)):
+            # cancellation after a drop by many orders of magnitude, sum up directly:
+            total = math.fsum(value for (timestamp, value) in self.last(n))
+        return total / n
+
+    def rate(self, num_samples=64):
+        """ The number of samples per second over the last `num_samples` samples. """
+        num_samples = min(num_samples, self._count)
+        if num_samples < 2:
+            return None
+        duration = self.times[self._slot(0)] - self.times[self._slot(num_samples - 1)]
+        return (num_samples - 1) / duration if duration > 0 else None
+
+    def latest(self):
+        if not self._count:
+            raise NoDataError('the history is empty.')
+        slot = self._slot(0)
+        return (self.times[slot], self.values[slot])
+
+    def slices(self, num_samples=None):
+        """ Returns the (start, stop) index ranges of the arrays `times` and `values`
+            holding the last `num_samples` samples, oldest first. """
+        if num_samples is None or num_samples > self._count:
+            num_samples = self._count
+        if num_samples <= 0:
+            return []
+        start = self._slot(num_samples - 1)
+        stop = start + num_samples
+        if stop <= self.capacity:
+            return [(start, stop)]
+        return [(start, self.capacity), (0, stop - self.capacity)]
+
+    def _sequence_slot(self, sequence):
+        return (self._head - (self.written - sequence)) % self.capacity
+
+    def find(self, timestamp):
+        """ Returns the sequence number of the first sample with a time >= timestamp
+            (or self.written if there is none). """
+        low, high = self.written - self._count, self.written
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self._sequence_slot(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def select(self, t_from=None, t_to=None):
+        """ The range of sequence numbers with t_from <= time < t_to """
+        first = self.written - self._count if t_from is None else self.find(t_from)
+        last = self.written if t_to is None else self.find(t_to)
+        return (first, max(first, last))
+
+    def chunks(self, first, last, stride=1, chunk_size=4096):
+        """ Yields every `stride`-th sample with a sequence number in [first, last)
+            in arrays of up to `chunk_size` interleaved times and pressures. """
+        times, values = self.times, self.values
+        for start in xrange(first, last, chunk_size * stride):
+            stop = min(start + chunk_size * stride, last)
+            chunk = array('d')
+            sequence = start
+            while sequence < stop:
+                slot = self._sequence_slot(sequence)
+                end = min(slot + stop - sequence, self.capacity)
+                num = len(xrange(slot, end, stride))
+                part = array('d', [0.]) * (2 * num)
+                part[0::2] = times[slot:end:stride]
+                part[1::2] = values[slot:end:stride]
+                chunk.extend(part)
+                sequence += num * stride
+            yield chunk
+
+    def views(self, num_samples=None):
+        """ Zero-copy read-only buffers of the last `num_samples` times and values. """
+        size = self.values.itemsize
+        return [(buffer(self.times, start*size, (stop-start)*size),
+                 buffer(self.values, start*size, (stop-start)*size))
+                 for (start, stop) in self.slices(num_samples)]
+
+    def last(self, num_samples=None):
+        """ Iterates over the last `num_samples` (time, pressure) tuples, oldest first. """
+        times, values = self.times, self.values
+        for (start, stop) in self.slices(num_samples):
+            for i in xrange(start, stop):
+                yield (times[i], values[i])
+
+    __iter__ = last
+
+    def tolist(self):
+        return list(self.last())
+
+    def clear(self):
+        self._changes += 1
+        self._total = 0.
+        self._lap_total = 0.
+        self._evicted = 0.
+        self._head = 0
+        self._count = 0
+        self._publish()
+
+class RunLengthHistory(object):
+    """ A circular buffer of runs of identical readings in preallocated arrays.
+
+    A gauge in a stable vacuum sends the same pressure counts many times in
+    a row. Instead of a sample per frame, a run stores the time of its first
+    and last sample, the pressure and the sequence number of its first
+    sample (its length follows from the next run): 32 bytes per run instead
+    of 24 per sample. The times of the samples within a run are
+    interpolated. Queries locate the runs by binary search and work on them
+    directly, only the samples returned by chunks() are expanded. Same API
+    as PressureHistory. """
+    # seconds without a frame after which a new run is started:
+    max_gap = 1.
+    readings_per_sample = 1
+
+    def __init__(self, capacity=750):
+        self.capacity = capacity
+        self.starts = array('d', [0.]) * capacity
+        self.ends = array('d', [0.]) * capacity
+        self.values = array('d', [0.]) * capacity
+        self.firsts = array('d', [0.]) * capacity
+        self._head = 0 # the slot to be written next
+        self._count = 0 # the number of runs
+        self.written = 0 # the sequence number of the next sample
+
+    def __len__(self):
+        if not self._count:
+            return 0
+        return self.written - int(self.firsts[self._run_slot(0)])
+
+    def append(self, timestamp, value):
+        if self._count:
+            slot = self._head - 1 if self._head else self.capacity - 1
+            if value == self.values[slot] and timestamp - self.ends[slot] <= self.max_gap:
+                self.ends[slot] = timestamp
+                self.written += 1
+                return
+        slot = self._head
+        self.starts[slot] = timestamp
+        self.ends[slot] = timestamp
+        self.values[slot] = value
+        self.firsts[slot] = self.written
+        if self._count < self.capacity:
+            self._count += 1
+        slot += 1
+        if slot == self.capacity:
+            slot = 0
+        self._head = slot
+        self.written += 1
+
+    def _run_slot(self, index):
+        """ The slot of the run with the given index (0 being the oldest). """
+        return (self._head - self._count + index) % self.capacity
+
+    def _run(self, index):
+        """ The slot, the sequence number of the first sample and the number of samples of a run """
+        slot = self._run_slot(index)
+        first = int(self.firsts[slot])
+        end = self.written if index == self._count - 1 else int(self.firsts[self._run_slot(index + 1)])
+        return (slot, first, end - first)
+
+    def _locate(self, sequence):
+        """ The index of the run holding the sample with the given sequence number """
+        low, high = 0, self._count - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.firsts[self._run_slot(middle)] <= sequence:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def _interval(self, slot, length):
+        """ The (interpolated) time between the samples of a run """
+        return (self.ends[slot] - self.starts[slot]) / (length - 1) if length > 1 else 0.
+
+    def _time(self, sequence):
+        (slot, first, length) = self._run(self._locate(sequence))
+        return self.starts[slot] + (sequence - first) * self._interval(slot, length)
+
+    def mean(self, num_samples):
+        num_samples = min(num_samples, len(self))
+        if num_samples <= 0:
+            raise NoDataError('cannot calculate an average pressure without any values.')
+        total = 0.
+        remaining = num_samples
+        index = self._count - 1
+        while remaining:
+            (slot, first, length) = self._run(index)
+            taken = min(length, remaining)
+            total += taken * self.values[slot]
+            remaining -= taken
+            index -= 1
+        return total / num_samples
+
+    def rate(self, num_samples=64):
+        """ The number of samples per second over the last `num_samples` samples. """
+        num_samples = min(num_samples, len(self))
+        if num_samples < 2:
+            return None
+        duration = self._time(self.written - 1) - self._time(self.written - num_samples)
+        return (num_samples - 1) / duration if duration > 0 else None
+
+    def latest(self):
+        if not self._count:
+            raise NoDataError('the history is empty.')
+        slot = self._run_slot(self._count - 1)
+        return (self.ends[slot], self.values[slot])
+
+    def find(self, timestamp):
+        """ Returns the sequence number of the first sample with a time >= timestamp
+            (or self.written if there is none). """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self.ends[self._run_slot(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self._count:
+            return self.written
+        (slot, first, length) = self._run(low)
+        if self.starts[slot] >= timestamp:
+            return first
+        offset = int(math.ceil((timestamp - self.starts[slot]) / self._interval(slot, length)))
+        return first + min(offset, length - 1)
+
+    def select(self, t_from=None, t_to=None):
+        """ The range of sequence numbers with t_from <= time < t_to """
+        first = self.written - len(self) if t_from is None else self.find(t_from)
+        last = self.written if t_to is None else self.find(t_to)
+        return (first, max(first, last))
+
+    def chunks(self, first, last, stride=1, chunk_size=4096):
+        """ Yields every `stride`-th sample with a sequence number in [first, last)
+            in arrays of up to `chunk_size` interleaved times and pressures. """
+        for start in xrange(first, last, chunk_size * stride):
+            stop = min(start + chunk_size * stride, last)
+            chunk = array('d')
+            sequence = start
+            index = self._locate(start)
+            while sequence < stop:
+                (slot, run_first, length) = self._run(index)
+                offsets = xrange(sequence - run_first, min(run_first + length, stop) - run_first, stride)
+                (begin, interval) = (self.starts[slot], self._interval(slot, length))
+                part = array('d', [self.values[slot]]) * (2 * len(offsets))
+                part[0::2] = array('d', [begin + offset * interval for offset in offsets])
+                chunk.extend(part)
+                sequence += len(offsets) * stride
+                index += 1
+            yield chunk
+
+    def last(self, num_samples=None):
+        """ Iterates over the last `num_samples` (time, pressure) tuples, oldest first. """
+        if num_samples is None or num_samples > len(self):
+            num_samples = len(self)
+        for chunk in self.chunks(self.written - num_samples, self.written):
+            for i in xrange(0, len(chunk), 2):
+                yield (chunk[i], chunk[i+1])
+
+    __iter__ = last
 
-class RingBuffer(deque):
-    """ http://en.wikipedia.org/wiki/Circular_buffer """
-    def __init__(self, maxlen):
-        deque.__init__(self, maxlen=maxlen)
     def tolist(self):
-        return list(self)
+        return list(self.last())
+
+    def clear(self):
+        self._count = 0
+
+class FrameSynchronizer(object):
+    """ Reassembles the byte stream of a gauge into validated messages.
+
+    Received data is collected in a single bytearray. Complete frames are
+    handed to the callback and the consumed bytes are dropped in one go
+    after each call to feed(). If a frame fails validation, the buffer is
+    searched for the next candidate header byte instead of advancing one
+    byte at a time. """
+    msg_size_bytes = 9
+    header_byte = 0x7
+    fixed_bytes = {1: 0x5}
+    checksum_byte = 8
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.buffer = bytearray()
+        # statistics:
+        self.bytes_received = 0
+        self.frames = 0
+        self.skipped_bytes = 0
+        self.fixed_byte_errors = 0
+        self.checksum_errors = 0
+
+    def feed(self, data):
+        buf = self.buffer
+        buf.extend(data)
+        self.bytes_received += len(data)
+        size = self.msg_size_bytes
+        header = chr(self.header_byte)
+        pos = 0
+        end = len(buf)
+        try:
+            while end - pos >= size:
+                if buf[pos] != self.header_byte:
+                    nxt = buf.find(header, pos + 1)
+                    if nxt < 0: nxt = end
+                    self.skipped_bytes += nxt - pos
+                    pos = nxt
+                    continue
+                valid = True
+                for bytenum in self.fixed_bytes:
+                    if buf[pos+bytenum] != self.fixed_bytes[bytenum]:
+                        self.fixed_byte_errors += 1
+                        valid = False
+                        break
+                if valid and buf[pos+self.checksum_byte] != sum(buf[pos+1:pos+8]) % 256:
+                    self.checksum_errors += 1
+                    valid = False
+                if not valid:
+                    nxt = buf.find(header, pos + 1)
+                    if nxt < 0: nxt = end
+                    self.skipped_bytes += nxt - pos
+                    pos = nxt
+                    continue
+                frame = bytes(buf[pos:pos+size])
+                pos += size
+                self.frames += 1
+                self.callback(frame)
+        finally:
+            del buf[:pos]
+
+    def clear(self):
+        del self.buffer[:]
+
+class Command(object):
+    """ A command scheduled for a gauge, usable as a future.
+
+    The state changes from 'pending' to 'sent' to one of the final states
+    'confirmed' (the parsed status frames show the requested change),
+    'superseded' (replaced by a newer command with the same key before it
+    was sent) or 'timeout'. Commands without an observable effect are
+    confirmed by the first status frame after sending them. """
+    ids = itertools.count(1)
+
+    def __init__(self, name, key, payload, confirm=None, priority=1, on_confirm=None):
+        self.id = next(self.ids)
+        self.name = name
+        self.key = key
+        self.payload = payload
+        self.confirm = confirm # callable(itr) -> True once the command took effect
+        self.priority = priority # commands with a lower number are sent first
+        self.on_confirm = on_confirm
+        self.state = 'pending'
+        self.submitted = time.time()
+        self.dispatched = None # when it was sent first
+        self.last_sent = None
+        self.attempts = 0
+        self.finished = None
+        self._done = threading.Event()
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Returns True if the command finished within `timeout` seconds """
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """ Returns the time in seconds from sending the command until it was
+            confirmed or raises a CommandError. """
+        if not self._done.wait(timeout):
+            raise CommandTimeout('%s is not confirmed yet' % self.name)
+        if self.state == 'superseded':
+            raise CommandSuperseded('%s was superseded by a newer command' % self.name)
+        if self.state == 'timeout':
+            raise CommandTimeout('%s was not confirmed after %d attempts' % (self.name, self.attempts))
+        return self.latency
+
+    @property
+    def latency(self):
+        if self.state != 'confirmed': return None
+        return self.finished - self.dispatched
+
+    def add_done_callback(self, callback):
+        """ Calls `callback` with the command once it finished (from the ingest thread) """
+        self._callbacks.append(callback)
+        if self.done() and callback in self._callbacks:
+            self._callbacks.remove(callback)
+            callback(self)
+
+    def finish(self, state):
+        self.state = state
+        self.finished = time.time()
+        self._done.set()
+        (callbacks, self._callbacks) = (self._callbacks, [])
+        for callback in callbacks:
+            callback(self)
+
+    def to_dict(self):
+        return dict(id=self.id, name=self.name, state=self.state, submitted=self.submitted, attempts=self.attempts,
+                    queued=self.dispatched - self.submitted if self.dispatched else None, latency=self.latency)
+
+class CommandScheduler(object):
+    """ Sends the commands of a gauge one at a time and confirms them.
+
+    A pending command is replaced by a newer one with the same key (the
+    older one is superseded). Commands with a lower priority number are
+    sent first; a command with priority 0 (like degas off) is sent right
+    away, even while another command waits for its confirmation. A
+    command not confirmed within `confirm_timeout` seconds is sent again
+    up to `retries` times. Registered as a listener of the ITR, so the
+    confirmations are checked after each parsed status frame. The loop
+    reading the gauge also calls expire() periodically, so a command to a
+    gauge which stopped sending times out as well. """
+    def __init__(self, itr, confirm_timeout=1., retries=2, keep=50):
+        self.itr = itr
+        self.confirm_timeout = confirm_timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.pending = dict() # key -> Command
+        self.in_flight = None
+        self.recent = deque(maxlen=keep)
+        self.latency = Histogram(command_latency_bounds)
+
+    def submit(self, command):
+        """ Schedules `command` and returns it or an identical command already scheduled. """
+        with self.lock:
+            in_flight = self.in_flight
+            pending = self.pending.get(command.key)
+            if pending is not None and pending.payload == command.payload:
+                return pending
+            superseded = [self.pending.pop(command.key)] if pending is not None else []
+            if in_flight is not None and (in_flight.key, in_flight.payload) == (command.key, command.payload):
+                command = in_flight
+            else:
+                self.pending[command.key] = command
+                self.recent.append(command)
+            if in_flight is not None and command.priority == 0 and in_flight.priority > 0:
+                # the interrupted command is sent again afterwards (if still needed)
+                if in_flight.key in self.pending:
+                    superseded.append(in_flight)
+                else:
+                    self.pending[in_flight.key] = in_flight
+                self.in_flight = None
+            finished = self.dispatch_next() if self.in_flight is None else []
+        for older in superseded:
+            older.finish('superseded')
+        self.complete(finished)
+        return command
+
+    def __call__(self, itr):
+        if self.in_flight is None and not self.pending: return
+        finished = []
+        with self.lock:
+            command = self.in_flight
+            if command is not None and (command.confirm is None or command.confirm(itr)):
+                self.in_flight = None
+                finished.append((command, 'confirmed'))
+            finished += self.check_timeout()
+        self.complete(finished)
+
+    def expire(self):
+        """ Sends the command in flight again or times it out without waiting
+            for a status frame. """
+        if self.in_flight is None: return
+        with self.lock:
+            finished = self.check_timeout()
+        self.complete(finished)
+
+    def check_timeout(self):
+        """ Returns the (command, state) of the commands finished. Needs the lock. """
+        finished = []
+        command = self.in_flight
+        if command is not None and time.time() - command.last_sent > self.confirm_timeout:
+            if command.attempts > self.retries:
+                self.in_flight = None
+                finished.append((command, 'timeout'))
+            else:
+                self.send(command)
+        if self.in_flight is None:
+            finished += self.dispatch_next()
+        return finished
+
+    def dispatch_next(self):
+        """ Sends the next pending command. Returns the (command, state) of
+            those found confirmed without sending them. Needs the lock. """
+        finished = []
+        while self.pending and self.in_flight is None:
+            command = min(self.pending.values(), key=lambda command: (command.priority, command.submitted))
+            del self.pending[command.key]
+            if command.attempts and command.confirm is not None and command.confirm(self.itr):
+                finished.append((command, 'confirmed'))
+                continue
+            self.in_flight = command
+            self.send(command)
+        return finished
+
+    def send(self, command):
+        command.attempts += 1
+        command.last_sent = time.time()
+        if command.dispatched is None: command.dispatched = command.last_sent
+        command.state = 'sent'
+        self.itr.send_message(command.payload)
+
+    def complete(self, finished):
+        for (command, state) in finished:
+            if state == 'confirmed':
+                self.latency.observe(time.time() - command.dispatched)
+                if command.on_confirm: command.on_confirm()
+            command.finish(state)
+
+class GaugeState(namedtuple('GaugeState', ('sequence', 'last_update', 'pressure', 'pressure_unit', 'emission_state',
+                                           'toggle_bit', 'version', 'sensor_type', 'error_code', 'currently_adjusting'))):
+    """ The fields of a gauge after parsing a status frame.
+
+    ITR.state is replaced by a new immutable GaugeState after each frame
+    with a single assignment, so readers in other threads get a consistent
+    view without locking by reading itr.state once. """
+    __slots__ = ()
+
+    @classmethod
+    def from_itr(cls, itr, sequence):
+        return cls(sequence, itr.last_update, itr.pressure, itr.pressure_unit, itr.emission_state, itr.toggle_bit,
+                   itr.version, itr.sensor_type, getattr(itr, 'error_code', None), getattr(itr, 'currently_adjusting', None))
+
+GaugeState.empty = GaugeState(0, *([None] * (len(GaugeState._fields) - 1)))
+
+class HistoryWriter(object):
+    """ The base of the listeners storing each new sample of the pressure
+        history (i.e. only the samples of a decimated history) elsewhere,
+        with append(timestamp, pressure) implemented by subclasses.
+        The pressures are converted to mbar, so a unit change doesn't mix
+        units in the stored samples. """
+    written = 0 # of the pressure history of the ITR
+
+    def __call__(self, itr):
+        history = itr.pressure_history
+        if len(history) and history.written != self.written:
+            self.written = history.written
+            (timestamp, pressure) = history.latest()
+            self.append(timestamp, itr.to_mbar(pressure, itr.pressure_unit))
 
 class ITR(threading.Thread):
     # constants:
@@ -21,6 +645,11 @@ class ITR(threading.Thread):
     emission_states = { 0: 'emission off', 1: 'emission 25 uA',
                         2: 'emission 5mA', 3: 'degas' }
     pressure_units = {0: 'mbar', 1: 'Torr', 2: 'Pa'}
+    history_modes = ('samples', 'runs')
+    # p = 10**(counts/4000 - offset) for each pressure unit:
+    pressure_offsets = {0: 12.5, 1: 12.625, 2: 10.5}
+    # lookup tables mapping counts to pressure, built on first use:
+    pressure_tables = dict()
     # volatile constants:
     sensor_types = dict() # to be filled in __init__()
     # initial values:
@@ -31,17 +660,37 @@ class ITR(threading.Thread):
     toggle_bit = None
     emission_state = None
     pressure_unit = None
-    pressure_history = RingBuffer(maxlen=1000)
     type_adjusted = False
-
-    def __init__(self, in_queue, out_queue, debug = False):
+    clear_pending = False
+    state = GaugeState.empty
+    # the time of the readings, replaced when replaying a capture:
+    clock = staticmethod(time.time)
+
+    def __init__(self, in_queue, out_queue, debug = False, lookup_tables = False, history_size = 1000, history_mode = 'samples'):
+        """ history_mode 'samples' keeps the last `history_size` readings,
+            'runs' keeps runs of identical readings in the same memory. """
+        if history_mode not in self.history_modes:
+            raise ValueError('unknown history mode %s' % history_mode)
         self.debug = debug
+        self.lookup_tables = lookup_tables
+        if history_mode == 'runs':
+            # a run takes 32 bytes, a sample 24 bytes:
+            self.pressure_history = RunLengthHistory(max(history_size * 3 // 4, 1))
+        else:
+            self.pressure_history = PressureHistory(history_size)
         self.sensor_types = {
             10: ITR90,
             12: ITR200,
         }
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.synchronizer = FrameSynchronizer(self.parse_status)
+        self.parse_latency = Histogram(parse_latency_bounds)
+        self.listeners = [] # callables invoked with the ITR after each parsed message
+        self.history_listeners = [] # ... only after the messages stored in the pressure history
+        self.history_written = 0
+        self.command_scheduler = CommandScheduler(self)
+        self.add_listener(self.command_scheduler)
         self.closing = False # A flag to indicate thread shutdown
         threading.Thread.__init__(self)
 
@@ -54,19 +703,13 @@ class ITR(threading.Thread):
     def read_from_queue(self):
         """ This method serves as a buffer, validity checker
             and as a message synchroniser. """
-        str_buffer = ""
         while not self.closing:
             try:
-                str_buffer += self.in_queue.get(timeout=0.1)
+                self.synchronizer.feed(self.in_queue.get(timeout=0.1))
             except Empty:
-                continue
-            while len(str_buffer) >= self.msg_size_bytes:
-                msg = str_buffer[:9]
-                if ITR.valid_message(msg):
-                    self.parse_status(msg)
-                    str_buffer = str_buffer[9:]
-                else:
-                    str_buffer = str_buffer[1:]
+                pass
+            # also when the gauge stopped sending:
+            self.command_scheduler.expire()
 
     @classmethod
     def check_message(cls, data):
@@ -91,8 +734,9 @@ class ITR(threading.Thread):
         return reduce(operator.add, map(ord, st)) % 256
 
     def parse_status(self, status):
+        start = time.time()
         try:
-            ITR.check_message(status)
+            self.check_message(status)
             self.parse_state(status)
             self.parse_error(status)
             self.parse_pressure(status)
@@ -106,7 +750,34 @@ class ITR(threading.Thread):
         except Exception, e:
             if self.debug: print str(e)
             raise ParseError(e)
-        self.last_update = time.time()
+        self.last_update = self.clock()
+        self.state = GaugeState.from_itr(self, self.state.sequence + 1)
+        self.parse_latency.observe(time.time() - start)
+        self.notify(self.listeners)
+        if self.history_listeners and self.pressure_history.written != self.history_written:
+            self.history_written = self.pressure_history.written
+            self.notify(self.history_listeners)
+
+    def notify(self, listeners):
+        for listener in listeners:
+            try:
+                listener(self)
+            except Exception, e:
+                # a failing listener (e.g. a full disk for the log) must neither
+                # keep the others from running nor end the thread reading the gauge:
+                sys.stderr.write("listener %r: %s: %s\n" % (listener, e.__class__.__name__, e))
+
+    def add_listener(self, listener, decimated=False):
+        """ `listener` is called with the ITR after each parsed message or, if
+            `decimated`, only after those whose reading the pressure history
+            stored, i.e. once per sample of a decimated history (see decimation.py). """
+        (self.history_listeners if decimated else self.listeners).append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.history_listeners:
+            self.history_listeners.remove(listener)
+        else:
+            self.listeners.remove(listener)
 
     def fix_gauge_type(self):
         if not isinstance(self, self.sensor_type):
@@ -138,14 +809,37 @@ class ITR(threading.Thread):
         pass
 
     def parse_pressure(self, data):
-        (highbyte, lowbyte) = (data[4], data[5])
-        if self.pressure_unit == 0:
-            self.pressure = 10.**((ord(highbyte)*256+ord(lowbyte))/4000.-12.5)
-        if self.pressure_unit == 1:
-            self.pressure = 10.**((ord(highbyte)*256+ord(lowbyte))/4000.-12.625)
-        if self.pressure_unit == 2:
-            self.pressure = 10.**((ord(highbyte)*256+ord(lowbyte))/4000.-10.5)
-        self.pressure_history.append((time.time(), self.pressure))
+        counts = ord(data[4])*256+ord(data[5])
+        if self.pressure_unit in self.pressure_offsets:
+            if self.lookup_tables:
+                self.pressure = ITR.pressure_table(self.pressure_unit)[counts]
+            else:
+                self.pressure = ITR.counts_to_pressure(counts, self.pressure_unit)
+        if self.pressure is not None:
+            if self.clear_pending:
+                self.clear_pending = False
+                self.clear_buffers()
+            self.pressure_history.append(self.clock(), self.pressure)
+
+    @classmethod
+    def counts_to_pressure(cls, counts, pressure_unit):
+        return 10.**(counts/4000.-cls.pressure_offsets[pressure_unit])
+
+    @classmethod
+    def to_mbar(cls, pressure, pressure_unit):
+        """ Converts `pressure` in `pressure_unit` to mbar with the factor
+            the gauge itself uses, i.e. the ratio of the offsets above. """
+        return pressure * 10.**(cls.pressure_offsets[pressure_unit] - cls.pressure_offsets[0])
+
+    @classmethod
+    def pressure_table(cls, pressure_unit):
+        """ Returns a table with the pressure for all 65536 possible counts
+            in the given unit. The table is built once and shared by all gauges. """
+        try:
+            return cls.pressure_tables[pressure_unit]
+        except KeyError:
+            table = array('d', (cls.counts_to_pressure(counts, pressure_unit) for counts in xrange(65536)))
+            return cls.pressure_tables.setdefault(pressure_unit, table)
 
     def parse_type(self, data):
         self.sensor_type = self.sensor_types[ord(data[7])]
@@ -154,14 +848,40 @@ class ITR(threading.Thread):
         assert len(payload) == 3, "The payload to send has to contain 3 bytes."
         self.out_queue.put('\x03' + payload + str(chr(ITR.checksum256(payload))))
 
+    def schedule_command(self, name, key, payload, confirm=None, priority=1, on_confirm=None):
+        """ Sends `payload` via the command scheduler and returns a Command
+            future which is confirmed once `confirm`(itr) is true. """
+        return self.command_scheduler.submit(Command(name, key, payload, confirm, priority, on_confirm))
+
     def get_average_pressure(self, num_samples=60):
+        """ The mean of the last `num_samples` readings, i.e. of correspondingly
+            fewer samples of a decimated history. """
         # 1 sample / 0.016 seconds = 62.5 samples per second
-        if self.debug and num_samples > len(self.pressure_history):
-            print "The buffer contains only %i samples. Cannot calculate the average over %i values." % (len(self.pressure_history), num_samples)
-        if len(self.pressure_history) == 0:
-            raise NoDataError('cannot calculate an average pressure without any values.')
-        num_samples = min(num_samples, len(self.pressure_history))
-        return sum([hist[1] for hist in self.pressure_history.tolist()[-num_samples:]])/float(num_samples)
+        history = self.pressure_history
+        num_samples = max(int(round(num_samples / history.readings_per_sample)), 1)
+        if self.debug and num_samples > len(history):
+            print "The buffer contains only %i samples. Cannot calculate the average over %i values." % (len(history), num_samples)
+        return history.mean(num_samples)
+
+    def get_history(self, t_from=None, t_to=None, max_points=None, statistic=None):
+        """ Returns the number of samples with t_from <= time < t_to, thinned out
+            to at most `max_points`, and an iterator over arrays of their
+            interleaved times and pressures. With a decimated history (see
+            decimation.py), `statistic` selects e.g. the 'max' of the buckets. """
+        history = self.pressure_history
+        if statistic is not None:
+            history = getattr(history, 'statistics', dict(mean=history)).get(statistic)
+            if history is None:
+                raise ValueError('the history has no statistic %s' % statistic)
+        (first, last) = history.select(t_from, t_to)
+        stride = 1
+        if max_points and last - first > max_points:
+            stride = -(-(last - first) // max_points)
+        return (len(xrange(first, last, stride)), history.chunks(first, last, stride))
+
+    def get_frame_rate(self, num_samples=64):
+        """ Received messages per second, estimated from the history """
+        return self.pressure_history.rate(num_samples)
 
     def clear_history(self):
         self.pressure_history.clear()
@@ -169,6 +889,12 @@ class ITR(threading.Thread):
     def clear_buffers(self):
         self.clear_history()
 
+    def request_clear(self):
+        """ Clears the buffers before the next reading is stored, i.e. at a
+            frame boundary in the ingest thread and not while the listeners
+            of the current frame still read the history. """
+        self.clear_pending = True
+
     def __str__(self):
         return self.__class__.__name__
 
@@ -185,22 +911,26 @@ class ITR90(ITR):
     def parse_adjustment_status(self, data):
         """ 1000mbar adjustment """
         self.currently_adjusting = bool(ord(data[2]) & 0b100)
+    def set_unit(self, unit):
+        """ The history is cleared with the first reading after the gauge reported the new unit. """
+        return self.schedule_command('set_unit_' + self.pressure_units[unit], 'unit', chr(16)+chr(62)+chr(unit),
+                                     lambda itr: itr.pressure_unit == unit, on_confirm=self.request_clear)
     def set_unit_mbar(self):
-        self.send_message(chr(16)+chr(62)+chr(0))
-        self.clear_buffers()
+        return self.set_unit(0)
     def set_unit_Torr(self):
-        self.send_message(chr(16)+chr(62)+chr(1))
-        self.clear_buffers()
+        return self.set_unit(1)
     def set_unit_Pa(self):
-        self.send_message(chr(16)+chr(62)+chr(2))
-        self.clear_buffers()
+        return self.set_unit(2)
     def permanently_store_unit(self):
-        self.send_message(chr(32)+chr(62)+chr(62))
+        return self.schedule_command('permanently_store_unit', 'store_unit', chr(32)+chr(62)+chr(62))
     def set_degas(self, switch_on=True):
         if switch_on:
-            self.send_message(chr(16)+chr(93)+chr(148))
+            return self.schedule_command('degas_on', 'degas', chr(16)+chr(93)+chr(148),
+                                         lambda itr: itr.emission_state == 3)
         else:
-            self.send_message(chr(16)+chr(93)+chr(105))
+            # switching degas off has precedence over all other commands:
+            return self.schedule_command('degas_off', 'degas', chr(16)+chr(93)+chr(105),
+                                         lambda itr: itr.emission_state != 3, priority=0)
 
 class ITR200(ITR):
     active_filament = {0: '1st filament', 1: '2nd filament'}
@@ -218,6 +948,15 @@ class NoDataError(VacuumGaugeError):
 class ParseError(VacuumGaugeError, AssertionError):
     pass
 
+class CommandError(VacuumGaugeError):
+    pass
+
+class CommandTimeout(CommandError):
+    pass
+
+class CommandSuperseded(CommandError):
+    pass
+
 if __name__ == "__main__":
     device = 'COM7'
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+""" Sets up the acquisition of a number of gauges with one of the engines. """
+
+from serialman import SerialManager
+from eventloop import GaugeEventLoop
+from sharding import GaugeSupervisor
+from shmhistory import SharedHistoryWriter, shared_history_path
+from pressurelog import PressureLogWriter, pressure_log_path
+from metrics import Rollup
+from decimation import apply_decimation, decimation_option
+from Leybold import ITR
+
+class GaugeAcquisition(object):
+    """ Owns the serial ports in `device_names` and provides an ITR object
+    (or a proxy with the same API) per gauge in self.gauges.
+
+    engine 'threads' runs a SerialManager and an ITR thread per gauge,
+    engine 'eventloop' runs all gauges in a single GaugeEventLoop thread,
+    engine 'processes' spreads the gauges over `workers` processes.
+    With `shared_history_dir`, the pressure history of each gauge is
+    also written to a file in shared memory readable by other processes.
+    With `log_dir`, all readings are stored permanently in that directory.
+    history_mode 'runs' stores the pressure history as runs of identical
+    readings, which covers a much longer time in a stable vacuum.
+    With `capture_dir`, the raw data received from each gauge is recorded
+    to a capture file in that directory (see capture.py).
+    `decimation` maps device names (None: all other gauges) to a decimation
+    of their history like 'bucket:10' (see decimation.py).
+    Opening a serial port may raise a SerialException. """
+    engines = ('threads', 'eventloop', 'processes')
+
+    def __init__(self, device_names, engine='threads', workers=None, serial_mode='poll', lookup_tables=False,
+                 history_size=1000, history_mode='samples', shared_history_dir=None, log_dir=None, capture_dir=None,
+                 decimation=None, debug=True):
+        self.engine = engine
+        self.gauges = dict()
+        self.rollups = dict()
+        self.threads = []
+        self.listeners = []
+        listener_factories = []
+        if shared_history_dir:
+            listener_factories.append(lambda device_name: SharedHistoryWriter(
+                shared_history_path(shared_history_dir, device_name), device_name=device_name))
+        if log_dir:
+            listener_factories.append(lambda device_name: PressureLogWriter(pressure_log_path(log_dir, device_name)))
+        itr_kwargs = dict(debug = debug, lookup_tables = lookup_tables, history_size = history_size, history_mode = history_mode)
+        if engine == 'eventloop':
+            loop = GaugeEventLoop(device_names, capture_dir=capture_dir, decimation=decimation, **itr_kwargs)
+            self.threads.append(loop)
+            self.gauges.update(loop.gauges)
+        elif engine == 'processes':
+            # the event loops of the workers open the capture files and decimate the histories:
+            supervisor = GaugeSupervisor(device_names, workers, listener_factories=listener_factories,
+                                         capture_dir=capture_dir, decimation=decimation, **itr_kwargs)
+            listener_factories = [] # added by the workers
+            self.threads.append(supervisor)
+            self.gauges.update(supervisor.gauges)
+        else:
+            for device_name in device_names:
+                serial_manager = SerialManager(device_name, mode=serial_mode, capture_dir=capture_dir)
+                self.gauges[device_name] = ITR(serial_manager.in_queue, serial_manager.out_queue, **itr_kwargs)
+                apply_decimation(self.gauges[device_name], decimation, device_name)
+                self.threads += [serial_manager, self.gauges[device_name]]
+        for device_name in device_names:
+            for factory in listener_factories:
+                listener = factory(device_name)
+                self.gauges[device_name].add_listener(listener, decimated=True)
+                self.listeners.append(listener)
+            if engine != 'processes':
+                # the gauges of worker processes are not accessible here;
+                # the rollups aggregate all readings, also of decimated gauges
+                self.rollups[device_name] = Rollup()
+                self.gauges[device_name].add_listener(self.rollups[device_name])
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        for thread in self.threads:
+            thread.close()
+        for thread in self.threads:
+            thread.join()
+        for listener in self.listeners:
+            listener.close()
+
+def add_arguments(parser, engine='threads'):
+    """ Adds the command line options configuring a GaugeAcquisition to the
+        argparse `parser`, see from_args(). """
+    parser.add_argument('-e', '--engine', choices=GaugeAcquisition.engines, default=engine, help='Run two threads per gauge, all gauges in a single event loop thread or in several worker processes.')
+    parser.add_argument('-w', '--workers', type=int, help='The number of worker processes for the processes engine (default: number of CPUs).')
+    parser.add_argument('-s', '--shared-history', metavar='DIR', help='Also write the pressure history of each gauge to shared memory files in DIR (e.g. /dev/shm).')
+    parser.add_argument('-l', '--log', metavar='DIR', help='Store all pressure readings (as decimated with -x) permanently in DIR.')
+    parser.add_argument('-r', '--run-length-history', action='store_true', help='Store the pressure history as runs of identical readings, covering a much longer time in a stable vacuum.')
+    parser.add_argument('-x', '--decimate', metavar='[SERIAL_PORT=]SPEC', type=decimation_option, action='append', default=[],
+                        help='Decimate the history of a gauge (or of all others without SERIAL_PORT=): every:N keeps every N-th reading, bucket:N or bucket:Tms stores the mean, min, max and last reading of N readings or T ms.')
+    parser.add_argument('-c', '--capture', metavar='DIR', help='Record the raw data received from the gauges to capture files in DIR (see capture.py).')
+    parser.add_argument('-L', '--lookup-tables', action='store_true', help='Decode the pressures with a lookup table per unit (512 KiB each) instead of computing a power per reading.')
+
+def acquisition_options(args):
+    """ The keyword arguments of GaugeAcquisition given by the options of add_arguments() """
+    return dict(engine=args.engine, workers=args.workers, shared_history_dir=args.shared_history, log_dir=args.log,
+                capture_dir=args.capture, history_mode='runs' if args.run_length_history else 'samples',
+                decimation=dict(args.decimate), lookup_tables=args.lookup_tables)
+
+def from_args(args, **kwargs):
+    """ A GaugeAcquisition of the gauges in args.serial_ports configured by
+        the options of add_arguments() (and `kwargs`). """
+    options = acquisition_options(args)
+    options.update(kwargs)
+    return GaugeAcquisition(args.serial_ports, **options)
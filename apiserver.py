@@ -4,11 +4,142 @@
 import argparse
 import sys
 import inspect
-from serialman import SerialManager
+import json
+import struct
+import threading
+import time
+from acquisition import GaugeAcquisition, add_arguments, acquisition_options
+from gaugedaemon import GaugeDaemonClient, RemoteGauge, RemoteProfiler, prefetch_states
+from instrumentation import render_gauges
+from profiling import GaugeProfiler, install_signal_handlers
+from iotools import to_little_endian
 from serial.serialutil import SerialException
 from Leybold import ITR, LeyboldError
+from array import array
 
-from bottle import Bottle, HTTPError, PluginError, response, request, abort
+from bottle import Bottle, HTTPError, HTTPResponse, PluginError, response, request, abort
+from wsgiref.simple_server import WSGIServer
+from SocketServer import ThreadingMixIn
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """ The debug server has to handle requests while /stream connections are open. """
+    daemon_threads = True
+
+class PressureSnapshot(threading.Thread):
+    """ Periodically renders the averaged pressures of all gauges to JSON.
+
+    Requests for /pressure/<which> are answered from the latest rendering,
+    so their cost doesn't depend on the number of clients or gauges.
+    The sequence number in the ETag only increases when the content changed.
+    The same rendering is pushed as a server-sent event to all subscribers.
+    The pressures are averaged over `num_samples` readings (about 0.5 s),
+    also for gauges with a decimated history. """
+    keepalive_interval = 15.
+
+    def __init__(self, gauges, interval=0.1, num_samples=30):
+        self.gauges = gauges
+        self.interval = interval
+        self.num_samples = num_samples
+        self.instance = '%x' % int(time.time() * 1000)
+        self.sequence = 0
+        self.entries = dict() # 'all' or device name -> (ETag, JSON or LeyboldError)
+        self.event = (0, '') # (sequence, server-sent event)
+        self.event_data = None
+        self.refreshed = threading.Condition()
+        self.closing = False # A flag to indicate thread shutdown
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.refresh()
+
+    def run(self):
+        while not self.closing:
+            time.sleep(self.interval)
+            self.refresh()
+
+    def refresh(self):
+        pressures = dict()
+        states = dict()
+        try:
+            prefetch_states([self.gauges[device]['ITR'] for device in self.gauges])
+        except LeyboldError:
+            pass # reported per gauge below
+        for device in self.gauges:
+            itr = self.gauges[device]['ITR']
+            try:
+                pressures[device] = dict(pressure=itr.get_average_pressure(num_samples = self.num_samples))
+                state = itr.state
+                states[device] = dict(pressures[device], pressure_unit=ITR.pressure_units.get(state.pressure_unit),
+                                      emission_state=ITR.emission_states.get(state.emission_state))
+            except LeyboldError, e:
+                pressures[device] = e
+        renderings = dict()
+        for device in pressures:
+            renderings[device] = self.render({device: pressures[device]})
+        renderings['all'] = self.render(pressures)
+        entries = dict()
+        changed = False
+        for which in renderings:
+            old = self.entries.get(which)
+            if old and old[1] == renderings[which]:
+                entries[which] = old
+            else:
+                changed = True
+                entries[which] = (None, renderings[which])
+        if changed:
+            self.sequence += 1
+        etag = '"%s-%d"' % (self.instance, self.sequence)
+        for which in entries:
+            if entries[which][0] is None:
+                entries[which] = (etag, entries[which][1])
+        self.entries = entries
+        data = json.dumps(states)
+        if data != self.event_data:
+            sequence = self.event[0] + 1
+            self.event = (sequence, 'id: %d\ndata: %s\n\n' % (sequence, data))
+            self.event_data = data
+        with self.refreshed:
+            self.refreshed.notify_all()
+
+    @staticmethod
+    def render(pressures):
+        for value in pressures.values():
+            if isinstance(value, LeyboldError): return value
+        return json.dumps(pressures)
+
+    def respond(self, which):
+        (etag, body) = self.entries[which]
+        if isinstance(body, LeyboldError):
+            raise body
+        if request.headers.get('If-None-Match') == etag:
+            return HTTPResponse(status=304, headers={'ETag': etag})
+        response.set_header('ETag', etag)
+        response.content_type = 'application/json'
+        return body
+
+    def subscribe(self, interval, changes_only=False):
+        """ Yields a server-sent event at most every `interval` seconds, with
+            `changes_only` only if the content changed since the last one. """
+        sent = None
+        last_time = 0.
+        while not self.closing:
+            with self.refreshed:
+                self.refreshed.wait(self.keepalive_interval)
+            now = time.time()
+            if now - last_time < interval:
+                continue
+            (sequence, event) = self.event
+            if changes_only and sequence == sent:
+                if now - last_time < self.keepalive_interval:
+                    continue
+                event = ': keep-alive\n\n'
+            sent = sequence
+            last_time = now
+            yield event
+
+    def close(self):
+        self.closing = True
+        with self.refreshed:
+            self.refreshed.notify_all()
 
 class LeyboldGaugesBottlePlugin(object):
     ''' This plugin provides Bottle routes which accept a `gauges` argument
@@ -19,19 +150,40 @@ class LeyboldGaugesBottlePlugin(object):
     name = 'gauges'
     api = 2
 
-    def __init__(self, device_names, keyword='gauges'):
+    def __init__(self, device_names, keyword='gauges', snapshot_interval=0.1, daemon_socket=None, **kwargs):
+        """ Opens the serial ports in `device_names` with a GaugeAcquisition
+            configured by `kwargs` or, with `daemon_socket`, connects to a
+            gauge daemon owning the ports instead (`device_names` is ignored).
+            Each gauge can be given an ingest decimation of its history with
+            `decimation`, e.g. {'/dev/ttyUSB0': 'bucket:10', None: 'every:5'}
+            (see decimation.py and GaugeAcquisition).
+            The averaged pressures are rendered every `snapshot_interval` seconds. """
         self.devices = dict()
-        for device_name in device_names:
-            self.devices[device_name] = dict()
+        self.acquisition = None
+        self.daemon_client = None
+        if daemon_socket:
+            self.daemon_client = GaugeDaemonClient(daemon_socket)
             try:
-                self.devices[device_name]['SerialManager'] = SerialManager(device_name)
-                in_queue = self.devices[device_name]['SerialManager'].in_queue
-                out_queue = self.devices[device_name]['SerialManager'].out_queue
-                self.devices[device_name]['ITR'] = ITR(in_queue, out_queue, debug = True)
-                self.devices[device_name]['nickname'] = ''
-            except SerialException:
-                sys.stdout.write('Could not open serial device {0}\n'.format(device_name))
+                gauges = self.daemon_client.gauges()
+            except LeyboldError, e:
+                sys.stdout.write('Could not connect to the gauge daemon: {0}\n'.format(e))
                 sys.exit(1)
+        else:
+            try:
+                self.acquisition = GaugeAcquisition(device_names, **kwargs)
+            except SerialException, e:
+                sys.stdout.write('Could not open serial device: {0}\n'.format(e))
+                sys.exit(1)
+            gauges = self.acquisition.gauges
+        for device_name in gauges:
+            self.devices[device_name] = dict(ITR=gauges[device_name], nickname='')
+            if self.acquisition and device_name in self.acquisition.rollups:
+                self.devices[device_name]['rollup'] = self.acquisition.rollups[device_name]
+        self.snapshot = PressureSnapshot(self.devices, snapshot_interval)
+        if self.daemon_client:
+            self.profiler = RemoteProfiler(self.daemon_client)
+        else:
+            self.profiler = GaugeProfiler(gauges)
         self.keyword = keyword
 
     def setup(self, app):
@@ -39,24 +191,25 @@ class LeyboldGaugesBottlePlugin(object):
             if not isinstance(other, LeyboldGaugesBottlePlugin): continue
             if other.keyword == self.keyword:
                 raise PluginError("Found another MaxiGauge plugin with conflicting settings (non-unique keyword).")
-        for device in self.devices:
-            try:
-                self.devices[device]['SerialManager'].start()
-                self.devices[device]['ITR'].start()
-            except Exception, e:
-                raise PluginError("Could not connect to Leybold Gauge with device name %s. Error: %s" % (device, e) )
+        try:
+            if self.acquisition: self.acquisition.start()
+            self.snapshot.start()
+        except Exception, e:
+            raise PluginError("Could not connect to the Leybold Gauges %s. Error: %s" % (', '.join(self.devices), e) )
 
     def apply(self, callback, context):
         keyword = self.keyword
         # Test if the original callback accepts a 'maxigauge' keyword.
         # Ignore it if it does not need a handle.
-        args = inspect.getargspec(context.callback)[0]
-        if keyword not in args:
+        argnames = inspect.getargspec(context.callback)[0]
+        if keyword not in argnames and 'snapshot' not in argnames and 'profiler' not in argnames:
             return callback
 
         def wrapper(*args, **kwargs):
             gauges = self.devices
-            kwargs[keyword] = gauges
+            if keyword in argnames: kwargs[keyword] = gauges
+            if 'snapshot' in argnames: kwargs['snapshot'] = self.snapshot
+            if 'profiler' in argnames: kwargs['profiler'] = self.profiler
             try:
                 rv = callback(*args, **kwargs)
             except LeyboldError, e:
@@ -68,15 +221,16 @@ class LeyboldGaugesBottlePlugin(object):
         return wrapper
 
     def close(self):
-        for device in self.devices:
-            self.devices[device]['SerialManager'].close()
-            self.devices[device]['ITR'].close()
-        for device in self.devices:
-            self.devices[device]['SerialManager'].join()
-            self.devices[device]['ITR'].join()
+        self.snapshot.close()
+        self.snapshot.join()
+        if self.acquisition: self.acquisition.close()
+        if self.daemon_client: self.daemon_client.close()
 
 api = Bottle()
 
+# /history answers in JSON up to this number of points:
+history_json_limit = 10000
+
 @api.hook('after_request')
 def enable_cors():
     """
@@ -97,23 +251,197 @@ def list_gauges(gauges):
 
 @api.route('/pressure')
 @api.route('/pressure/')
-def all_pressures(gauges):
-    return pressure('all', gauges)
+def all_pressures(snapshot):
+    return snapshot.respond('all')
 
 @api.route('/pressure/<which>')
-def pressure(which, gauges):
+def pressure(which, snapshot):
+    if which != 'all' and which not in snapshot.gauges:
+        abort(504, 'This gauge does not exist')
+    return snapshot.respond(which)
+
+def select_devices(which, gauges):
+    if which == 'all':
+        return list(gauges)
+    elif which in gauges:
+        return [which]
+    abort(504, 'This gauge does not exist')
+
+@api.route('/rollup/<which>')
+def rollup(which, gauges):
+    """ Pre-aggregated pressure buckets (mean, min, max, count) in mbar of the
+        finest resolution covering the query parameters `from` and `to` (Unix
+        time) with at most `max_buckets` buckets. """
+    t_from = request.query.get('from', type=float)
+    t_to = request.query.get('to', type=float)
+    max_buckets = request.query.get('max_buckets', default=1000, type=int)
     status = dict()
+    for device in select_devices(which, gauges):
+        if 'rollup' not in gauges[device]:
+            abort(501, 'Rollups are not available for this engine')
+        (seconds, buckets) = gauges[device]['rollup'].query(t_from, t_to, max_buckets)
+        status[device] = dict(seconds=seconds, unit='mbar', buckets=[bucket.to_dict() for bucket in buckets])
+    return status
+
+@api.route('/metrics')
+def prometheus_metrics(gauges):
+    """ Ingest counters and latency histograms in the Prometheus text format """
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    itrs = dict((device, gauges[device]['ITR']) for device in gauges)
+    clients = set(itr.client for itr in itrs.values() if isinstance(itr, RemoteGauge))
+    if clients:
+        return ''.join(client.metrics() for client in clients)
+    return render_gauges(itrs)
+
+@api.route('/stream')
+def stream(snapshot):
+    """ Pushes the pressures, units and emission states of all gauges as
+        server-sent events every `interval` seconds or, with `changes_only=1`,
+        only when they changed. """
+    interval = request.query.get('interval', default=snapshot.interval, type=float)
+    changes_only = request.query.get('changes_only', default='0') in ('1', 'true')
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    return snapshot.subscribe(interval, changes_only)
+
+def npy_header(num_points):
+    """ The header of a .npy file (format version 1.0) holding `num_points` (time, pressure) records """
+    header = "{'descr': [('time', '<f8'), ('pressure', '<f8')], 'fortran_order': False, 'shape': (%d,), }" % num_points
+    header += ' ' * (-(len(header) + 11) % 64) + '\n'
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+@api.route('/history/<which>')
+def history(which, gauges):
+    """ The pressure history of a gauge between the query parameters `from`
+        and `to` (Unix time), thinned out to at most `max_points` samples.
+        `format` can be 'json', 'f64' (raw little-endian time and pressure
+        doubles), 'npy' (a NumPy record array) or 'auto' (JSON for up to
+        history_json_limit points, .npy above). Binary formats are streamed.
+        For a gauge decimated into buckets, `statistic` selects the 'mean'
+        (default), 'min', 'max' or 'last' reading of the buckets. """
+    if which not in gauges:
+        abort(504, 'This gauge does not exist')
+    itr = gauges[which]['ITR']
+    if not hasattr(itr, 'get_history'):
+        abort(501, 'The history is not available for this engine')
+    t_from = request.query.get('from', type=float)
+    t_to = request.query.get('to', type=float)
+    max_points = request.query.get('max_points', type=int)
+    fmt = request.query.get('format', default='auto')
+    try:
+        (num_points, chunks) = itr.get_history(t_from, t_to, max_points, request.query.get('statistic'))
+    except ValueError, e:
+        abort(400, str(e))
+    if fmt == 'auto':
+        fmt = 'json' if num_points <= history_json_limit else 'npy'
+    pressure_unit = ITR.pressure_units.get(itr.state.pressure_unit)
+    if fmt == 'json':
+        data = array('d')
+        for chunk in chunks:
+            data.extend(chunk)
+        return dict(pressure_unit=pressure_unit, time=data[0::2].tolist(), pressure=data[1::2].tolist())
+    if fmt not in ('f64', 'npy'):
+        abort(400, 'Unknown format %s' % fmt)
+    header = npy_header(num_points) if fmt == 'npy' else ''
+    response.content_type = 'application/octet-stream'
+    response.set_header('X-Pressure-Unit', pressure_unit)
+    response.set_header('X-Num-Points', str(num_points))
+    def generate():
+        yield header
+        for chunk in chunks:
+            yield to_little_endian(chunk).tostring()
+    return generate()
+
+def gauge_status(itr):
+    state = itr.state
+    return dict(
+        sequence = state.sequence,
+        pressure = state.pressure,
+        pressure_unit = ITR.pressure_units.get(state.pressure_unit),
+        emission_state = ITR.emission_states.get(state.emission_state),
+        toggle_bit = state.toggle_bit,
+        version = state.version,
+        sensor_type = state.sensor_type.__name__ if state.sensor_type else None,
+        error_code = state.error_code,
+        currently_adjusting = state.currently_adjusting,
+        last_update = state.last_update,
+        age = time.time() - state.last_update if state.last_update else None,
+        frame_rate = itr.get_frame_rate(),
+    )
+
+@api.route('/status')
+@api.route('/status/')
+def all_states(gauges):
+    return status('all', gauges)
+
+@api.route('/status/<which>')
+def status(which, gauges):
+    """ All parsed fields of the gauges in a single response. `which` is
+        'all' or a comma separated list of gauges. """
     if which == 'all':
         devices = list(gauges)
-    elif which in gauges:
-        devices = [which]
     else:
+        devices = which.split(',')
+        for device in devices:
+            if device not in gauges:
+                abort(504, 'This gauge does not exist')
+    prefetch_states([gauges[device]['ITR'] for device in devices])
+    return dict((device, gauge_status(gauges[device]['ITR'])) for device in devices)
+
+# the commands accepted by /command/<which>:
+gauge_commands = ('set_unit_mbar', 'set_unit_Torr', 'set_unit_Pa', 'permanently_store_unit', 'degas_on', 'degas_off')
+
+@api.post('/command/<which>')
+def command(which, gauges):
+    """ Sends the `command` to a gauge. Answers 202 right away or, with
+        `wait` (seconds), once the command was confirmed (200). """
+    if which not in gauges:
         abort(504, 'This gauge does not exist')
-    for device in devices:
-        itr = gauges[device]['ITR']
-        status[device] = dict(pressure=itr.get_average_pressure(num_samples = 30))
-        #itr.clear_history()
-    return status
+    name = request.forms.get('command')
+    if name not in gauge_commands:
+        abort(400, 'Unknown command, use one of ' + ', '.join(gauge_commands))
+    itr = gauges[which]['ITR']
+    try:
+        if name.startswith('degas_'):
+            scheduled = itr.set_degas(name == 'degas_on')
+        else:
+            scheduled = getattr(itr, name)()
+    except AttributeError:
+        abort(400, '%s is not supported by this gauge (%s)' % (name, itr))
+    if not hasattr(scheduled, 'wait'):
+        # gauges of worker processes don't report back
+        response.status = 202
+        return dict(name=name, state='forwarded')
+    wait = request.forms.get('wait', type=float)
+    if wait: scheduled.wait(wait)
+    if not scheduled.done(): response.status = 202
+    return scheduled.to_dict()
+
+@api.get('/commands/<which>')
+def recent_commands(which, gauges):
+    """ The recent commands of a gauge and their states """
+    if which not in gauges:
+        abort(504, 'This gauge does not exist')
+    itr = gauges[which]['ITR']
+    if not hasattr(itr, 'command_scheduler'):
+        abort(501, 'The commands are not tracked for this engine')
+    return dict(commands=[command.to_dict() for command in itr.command_scheduler.recent])
+
+@api.get('/profile')
+def profile(profiler):
+    """ The stage timings of the parse pipeline (in seconds) of all local gauges """
+    return profiler.state()
+
+@api.post('/profile')
+def configure_profile(profiler):
+    """ Switches the stage timing on or off (`enabled`=1/0), resets the
+        timings (`reset`=1) or runs cProfile for `cprofile` seconds. """
+    enabled = request.forms.get('enabled')
+    if enabled is not None:
+        enabled = enabled.lower() in ('1', 'true', 'on')
+    if not profiler.configure(enabled, bool(request.forms.get('reset')), request.forms.get('cprofile', type=float)):
+        abort(409, 'A cProfile window is running already')
+    return profiler.state()
 
 @api.get('/nickname/<which>')
 def pressure(which, gauges):
@@ -138,26 +466,48 @@ def pressure(which, gauges):
     status = dict(which=dict(nickname=gauges[which]['nickname']))
     return status
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Start the Leybold Vacuum Gauges API Web-Server')
-    parser.add_argument('-p', '--port', default='8080', help='The port to run the web server on.')
+def add_server_arguments(parser, port):
+    """ Adds the options of the web servers, those of the gauge acquisition
+        and the serial ports to the argparse `parser`. """
+    parser.add_argument('-p', '--port', default=port, help='The port to run the web server on.')
     parser.add_argument('-6', '--ipv6', action='store_true', help='Listen to incoming connections via IPv6 instead of IPv4.')
     parser.add_argument('-d', '--debug', action='store_true', help='Start in debug mode (with verbose HTTP error pages.')
-    parser.add_argument('serial_ports', metavar='SERIAL_PORT', nargs='+',
+    add_arguments(parser)
+    parser.add_argument('-t', '--threads', type=int, default=50, help='The number of server threads, each open /stream connection occupies one.')
+    parser.add_argument('-b', '--backend', default='cherrypy', help='The Bottle server adapter to run with (e.g. cherrypy, paste, waitress) or "threading" for the threaded wsgiref server.')
+    parser.add_argument('-D', '--daemon', metavar='SOCKET', help='Get the gauges from the acquisition daemon listening on SOCKET instead of opening the serial ports.')
+    parser.add_argument('serial_ports', metavar='SERIAL_PORT', nargs='*',
                         help='The serial port to connect to, sth. like COM7 on Windows /dev/ttyUSB1 on Linux.')
-    args = parser.parse_args()
 
+def install_gauges(parser, args):
+    """ Installs the LeyboldGaugesBottlePlugin configured by the options of
+        add_server_arguments() into the api and returns it. """
+    if not args.daemon and not args.serial_ports:
+        parser.error('Please specify serial ports or the socket of a gauge daemon.')
     if args.debug and args.ipv6:
-        args.error('You cannot use IPv6 in debug mode, sorry.')
-
-    leybold_gauges_plugin = LeyboldGaugesBottlePlugin(args.serial_ports)
+        parser.error('You cannot use IPv6 in debug mode, sorry.')
+    leybold_gauges_plugin = LeyboldGaugesBottlePlugin(args.serial_ports, daemon_socket=args.daemon, **acquisition_options(args))
     api.install(leybold_gauges_plugin)
+    install_signal_handlers(leybold_gauges_plugin.profiler)
+    return leybold_gauges_plugin
 
+def run_server(app, args):
+    """ Runs the Bottle `app` as configured by the options of add_server_arguments() """
     if args.debug:
-        api.run(host='0.0.0.0', port=args.port, debug=True, reloader=True)
+        app.run(host='0.0.0.0', port=args.port, debug=True, reloader=True, server_class=ThreadingWSGIServer)
     else:
-        if args.ipv6:
+        host = '::' if args.ipv6 else '0.0.0.0'
+        if args.backend == 'threading':
+            app.run(host=host, port=args.port, server_class=ThreadingWSGIServer)
+        elif args.backend == 'cherrypy':
             # CherryPy is Python3 ready and has IPv6 support:
-            api.run(host='::', server='cherrypy', port=args.port)
+            app.run(host=host, server='cherrypy', port=args.port, numthreads=args.threads)
         else:
-            api.run(host='0.0.0.0', server='cherrypy', port=args.port)
+            app.run(host=host, server=args.backend, port=args.port)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Start the Leybold Vacuum Gauges API Web-Server')
+    add_server_arguments(parser, '8080')
+    args = parser.parse_args()
+    install_gauges(parser, args)
+    run_server(api, args)
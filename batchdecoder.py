@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+""" Decodes large blocks of raw ITR90 / ITR200 data at once using NumPy.
+
+This is meant for offline processing of recorded data where going
+through the ITR thread frame by frame would be far too slow. """
+
+import numpy as np
+from Leybold import ITR
+
+frame_dtype = np.dtype([
+    ('offset', np.int64),
+    ('status', np.uint8),
+    ('emission_state', np.uint8),
+    ('currently_adjusting', np.bool_),
+    ('toggle_bit', np.bool_),
+    ('pressure_unit', np.uint8),
+    ('error_status', np.uint8),
+    ('counts', np.uint16),
+    ('pressure', np.float64),
+    ('version', np.float32),
+    ('sensor_type', np.uint8),
+])
+
+def find_frames(data):
+    """ Returns the offsets of all valid frames in the uint8 array `data`.
+
+    Candidates have to start with the fixed bytes and carry a matching
+    checksum. Overlapping candidates are resolved the same way the
+    FrameSynchronizer does it: the earlier frame wins. """
+    size = ITR.msg_size_bytes
+    n = len(data) - size + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.ones(n, dtype=np.bool_)
+    for bytenum in ITR.fixed_bytes:
+        candidates &= data[bytenum:bytenum+n] == ord(ITR.fixed_bytes[bytenum])
+    offsets = np.flatnonzero(candidates)
+    checksum = np.zeros(len(offsets), dtype=np.uint16)
+    for bytenum in range(1, ITR.checksum_byte):
+        checksum += data[offsets + bytenum]
+    offsets = offsets[(checksum % 256) == data[offsets + ITR.checksum_byte]]
+    while len(offsets) > 1:
+        overlapping = np.diff(offsets) < size
+        if not overlapping.any():
+            break
+        # only drop frames overlapping with a frame that is kept itself:
+        first = overlapping.copy()
+        first[1:] &= ~overlapping[:-1]
+        offsets = offsets[np.concatenate(([True], ~first))]
+    return offsets.astype(np.int64)
+
+def decode_frames(buffer):
+    """ Decodes all valid frames found in `buffer` (a str, bytearray, buffer
+        or uint8 array) into a structured array of dtype `frame_dtype`. """
+    if isinstance(buffer, np.ndarray):
+        data = buffer.view(np.uint8).ravel()
+    else:
+        data = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = find_frames(data)
+    frames = np.empty(len(offsets), dtype=frame_dtype)
+    frames['offset'] = offsets
+    status = data[offsets + 2]
+    frames['status'] = status
+    frames['emission_state'] = status & 0b11
+    frames['currently_adjusting'] = (status & 0b100) != 0
+    frames['toggle_bit'] = (status & 0b1000) != 0
+    unit = (status & 0b110000) >> 4
+    frames['pressure_unit'] = unit
+    frames['error_status'] = data[offsets + 3]
+    counts = data[offsets + 4].astype(np.uint16) * 256 + data[offsets + 5]
+    frames['counts'] = counts
+    offset = np.full(4, np.nan)
+    for pressure_unit in ITR.pressure_offsets:
+        offset[pressure_unit] = ITR.pressure_offsets[pressure_unit]
+    frames['pressure'] = 10.**(counts / 4000. - offset[unit])
+    frames['version'] = data[offsets + 6] / 20.
+    frames['sensor_type'] = data[offsets + 7]
+    return frames
+
+def decode_chunks(chunks):
+    """ Decodes a sequence of received data chunks such as sampledata.sample_itr90 """
+    return decode_frames(b''.join(chunks))
+
+if __name__ == "__main__":
+    import time
+    from sampledata import sample_itr90
+
+    data = b''.join(sample_itr90) * 10000
+    start = time.time()
+    frames = decode_frames(data)
+    duration = time.time() - start
+    print "Decoded %d frames (%d bytes) in %.3f s: %.0f frames/s" % (len(frames), len(data), duration, len(frames)/duration)
+    print "Average pressure: %.3g %s" % (frames['pressure'].mean(), ITR.pressure_units[frames['pressure_unit'][0]])
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+""" Load benchmark of the API server with simulated gauges.
+
+For each server backend and number of gauges, apiserver.py is started
+as a subprocess reading from gauges of simulator.py. Client processes
+then request /pressure/all, /pressure/<which> and /gauges with a number
+of concurrent connections (keep-alive or a new connection per request)
+while a number of displays are connected to /stream. The throughput and
+the latency percentiles of each combination are reported.
+
+Everything runs locally. Unix only. """
+
+import argparse
+import httplib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer as timer
+from simulator import GaugeSimulator, SimulatedGauge, oscillation
+
+# server backends and the module they need:
+backends = (('threading', None), ('cherrypy', 'cherrypy'), ('paste', 'paste'), ('waitress', 'waitress'))
+# (path, weight) of the requests, {} is replaced by a gauge name:
+request_mix = (('/pressure/all', 5), ('/pressure/{}', 4), ('/gauges', 1))
+
+def available_backends():
+    names = []
+    for (name, module) in backends:
+        try:
+            if module: __import__(module)
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
+def percentile(values, fraction):
+    return values[min(int(fraction * len(values)), len(values) - 1)] if values else None
+
+class ApiServer(object):
+    """ Runs apiserver.py with `num_gauges` simulated gauges, named gauge0...
+        by symbolic links in a temporary directory as slashes can't be used
+        in the URLs. """
+    def __init__(self, backend, device_names, port, engine='eventloop', threads=50):
+        self.port = port
+        self.directory = tempfile.mkdtemp(prefix='bench_http')
+        self.gauge_names = []
+        for (i, device_name) in enumerate(device_names):
+            name = 'gauge%d' % i
+            os.symlink(device_name, os.path.join(self.directory, name))
+            self.gauge_names.append(name)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'apiserver.py')
+        command = [sys.executable, script, '-p', str(port), '-b', backend, '-e', engine, '-t', str(threads)] + self.gauge_names
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(command, cwd=self.directory, stdout=devnull, stderr=devnull)
+        self.wait_until_ready()
+
+    def wait_until_ready(self, timeout=30.):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('apiserver.py exited with status %d' % self.process.returncode)
+            try:
+                connection = httplib.HTTPConnection('127.0.0.1', self.port, timeout=1.)
+                connection.request('GET', '/pressure/all')
+                if connection.getresponse().status == 200: return
+            except (socket.error, httplib.HTTPException):
+                pass
+            time.sleep(0.2)
+        raise RuntimeError('apiserver.py did not start within %d s' % timeout)
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.directory)
+
+class Display(threading.Thread):
+    """ A connected display, receiving the server-sent events of /stream """
+    def __init__(self, port, interval=0.5):
+        self.port = port
+        self.interval = interval
+        self.received = 0
+        self.closing = False # A flag to indicate thread shutdown
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(0.5)
+        sock.sendall('GET /stream?interval=%s HTTP/1.1\r\nHost: localhost\r\n\r\n' % self.interval)
+        try:
+            while not self.closing:
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data: break
+                self.received += len(data)
+        finally:
+            sock.close()
+
+    def close(self):
+        self.closing = True
+
+def client_process(port, paths, num_connections, keep_alive, duration, results):
+    """ Runs `num_connections` client threads for `duration` seconds and puts
+        the list of latencies and the number of errors into `results`. """
+    latencies = []
+    errors = [0]
+    deadline = time.time() + duration
+    def client():
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10.)
+        headers = {} if keep_alive else {'Connection': 'close'}
+        rnd = random.Random()
+        while time.time() < deadline:
+            path = rnd.choice(paths)
+            start = timer()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200: errors[0] += 1
+                if not keep_alive or response.will_close: connection.close()
+            except (socket.error, httplib.HTTPException):
+                errors[0] += 1
+                connection.close()
+                continue
+            latencies.append(timer() - start)
+    threads = [threading.Thread(target=client) for i in range(num_connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((latencies, errors[0]))
+
+def measure(port, gauge_names, concurrency, keep_alive, duration, num_processes):
+    """ Returns the requests per second, the latency percentiles and the number of errors """
+    paths = []
+    for (path, weight) in request_mix:
+        for i in range(weight):
+            paths.append(path.replace('{}', gauge_names[i % len(gauge_names)]) if '{}' in path else path)
+    num_processes = min(num_processes, concurrency)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client_process,
+                     args=(port, paths, concurrency // num_processes + (i < concurrency % num_processes), keep_alive, duration, results))
+                 for i in range(num_processes)]
+    start = time.time()
+    for process in processes:
+        process.start()
+    latencies = []
+    errors = 0
+    for process in processes:
+        (process_latencies, process_errors) = results.get()
+        latencies += process_latencies
+        errors += process_errors
+    for process in processes:
+        process.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return dict(requests_per_second=len(latencies) / elapsed, errors=errors,
+                p50=percentile(latencies, .5), p99=percentile(latencies, .99), p999=percentile(latencies, .999))
+
+def run(args):
+    simulator = GaugeSimulator([SimulatedGauge(curve=oscillation(period=10. + i)) for i in range(max(args.gauges))])
+    simulator.start()
+    results = []
+    print '%-10s %6s %8s %11s %10s %10s %10s %10s %6s' % ('backend', 'gauges', 'displays', 'connections', 'req/s', 'p50 ms', 'p99 ms', 'p999 ms', 'errors')
+    try:
+        for backend in args.backends:
+            for num_gauges in args.gauges:
+                threads = max(args.concurrency) + max(args.displays) + 10
+                server = ApiServer(backend, simulator.device_names[:num_gauges], args.port, args.engine, threads)
+                try:
+                    for num_displays in args.displays:
+                        displays = [Display(args.port) for i in range(num_displays)]
+                        for display in displays:
+                            display.start()
+                        for concurrency in args.concurrency:
+                            result = measure(args.port, server.gauge_names, concurrency, not args.new_connections, args.duration, args.processes)
+                            result.update(backend=backend, gauges=num_gauges, displays=num_displays,
+                                          connections=concurrency, keep_alive=not args.new_connections)
+                            results.append(result)
+                            ms = lambda value: 1000. * value if value is not None else float('nan')
+                            print '%-10s %6d %8d %11d %10.1f %10.2f %10.2f %10.2f %6d' % (backend, num_gauges, num_displays, concurrency,
+                                result['requests_per_second'], ms(result['p50']), ms(result['p99']), ms(result['p999']), result['errors'])
+                            sys.stdout.flush()
+                        for display in displays:
+                            display.close()
+                        for display in displays:
+                            display.join()
+                finally:
+                    server.close()
+    finally:
+        simulator.close()
+        simulator.join()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the API server with simulated gauges')
+    parser.add_argument('-B', '--backends', nargs='+', default=available_backends(), help='The server backends to compare (default: all available ones).')
+    parser.add_argument('-n', '--gauges', type=int, nargs='+', default=[1, 10, 100], help='The numbers of simulated gauges.')
+    parser.add_argument('-D', '--displays', type=int, nargs='+', default=[0, 20], help='The numbers of displays connected to /stream.')
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1, 16], help='The numbers of concurrent client connections.')
+    parser.add_argument('-k', '--new-connections', action='store_true', help='Open a new connection for each request instead of using keep-alive.')
+    parser.add_argument('-P', '--processes', type=int, default=multiprocessing.cpu_count(), help='The number of client processes.')
+    parser.add_argument('-t', '--duration', type=float, default=5., help='The duration of each measurement in seconds.')
+    parser.add_argument('-e', '--engine', default='eventloop', help='The acquisition engine of the API server.')
+    parser.add_argument('-p', '--port', type=int, default=8181, help='The port to run the API server on.')
+    parser.add_argument('-j', '--json', metavar='FILE', help='Also write the results to FILE as JSON.')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=1)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+""" Benchmarks of the ingest path of the gauges.
+
+* throughput: frames per second through ITR, fed in chunks of different
+  sizes directly into its frame synchronizer or through its in_queue,
+* decoding: the same, decoding the pressures with a power per reading or
+  with the lookup tables of the ITR,
+* latency: from writing a frame to a serial port until the ITR object
+  of the engine has parsed it (pseudo terminals),
+* memory: bytes per ITR object with a full pressure history,
+* scaling: CPU usage per gauge and received frame rate with 1 to 100
+  simulated gauges sending a frame every 16 ms,
+* replay: frames per second through ITR replaying capture files of real
+  traffic (--capture) as fast as possible.
+
+The results can be written as JSON (--json) and compared with a former
+run (--baseline): the exit status is 1 if a result got worse by more than
+--tolerance. Unix only. """
+
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from Queue import Queue
+from timeit import default_timer as timer
+from sampledata import sample_itr90
+from bench_serialman import Feeder, cpu_time
+from acquisition import GaugeAcquisition
+from capture import replay
+from Leybold import ITR
+
+def sample_frames():
+    data = ''.join(sample_itr90)
+    start = data.find('\x07\x05')
+    frames = [data[i:i+9] for i in range(start, len(data)-8, 9)]
+    return [frame for frame in frames if ITR.valid_message(frame)]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def result(benchmark, value, unit, better, **params):
+    return dict(benchmark=benchmark, params=params, value=value, unit=unit, better=better)
+
+def result_key(entry):
+    return entry['benchmark'] + ''.join(' %s=%s' % (name, entry['params'][name]) for name in sorted(entry['params']))
+
+def bench_throughput(chunk_size, via_queue=False, num_frames=20000, lookup_tables=False):
+    """ Frames per second through an ITR object, fed with chunks of `chunk_size` bytes """
+    frames = sample_frames()
+    stream = ''.join(frames[i % len(frames)] for i in xrange(num_frames))
+    chunks = [stream[i:i+chunk_size] for i in xrange(0, len(stream), chunk_size)]
+    if not via_queue:
+        itr = ITR(None, Queue(), lookup_tables=lookup_tables)
+        start = timer()
+        for chunk in chunks:
+            itr.synchronizer.feed(chunk)
+        duration = timer() - start
+    else:
+        itr = ITR(Queue(), Queue(), lookup_tables=lookup_tables)
+        done = threading.Event()
+        itr.add_listener(lambda itr: itr.synchronizer.frames >= num_frames and done.set())
+        for chunk in chunks:
+            itr.in_queue.put(chunk)
+        start = timer()
+        itr.start()
+        done.wait(60.)
+        duration = timer() - start
+        itr.close()
+        itr.join()
+    return itr.synchronizer.frames / duration
+
+def bench_replay(path):
+    """ Frames per second through an ITR object, fed from the capture file `path` """
+    itr = ITR(None, Queue())
+    start = timer()
+    replay(path, itr, speed=None)
+    return itr.synchronizer.frames / (timer() - start)
+
+def bench_latency(engine, serial_mode='poll', num_samples=200, interval=0.01):
+    """ The latencies in seconds from writing a frame to a pseudo terminal
+        until it was parsed by the ITR object """
+    (master, slave) = os.openpty()
+    device = os.ttyname(slave)
+    acquisition = GaugeAcquisition([device], engine=engine, serial_mode=serial_mode, debug=False)
+    arrived = threading.Event()
+    parsed = []
+    def listener(itr):
+        parsed.append(time.time())
+        arrived.set()
+    acquisition.gauges[device].add_listener(listener)
+    acquisition.start()
+    frames = sample_frames()
+    latencies = []
+    try:
+        time.sleep(0.2)
+        for i in xrange(num_samples + 10):
+            arrived.clear()
+            del parsed[:]
+            written = time.time()
+            os.write(master, frames[i % len(frames)])
+            if arrived.wait(1.) and i >= 10: # the first frames warm up
+                latencies.append(parsed[0] - written)
+            time.sleep(interval)
+    finally:
+        acquisition.close()
+        os.close(master)
+        os.close(slave)
+    return latencies
+
+def rss():
+    """ The resident set size of this process in bytes (Linux) or None """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return None
+
+def bench_memory(num_gauges=100, history_size=1000, history_mode='samples'):
+    """ The bytes used per ITR object with a full history of `history_size` samples """
+    gc.collect()
+    before = rss()
+    if before is None: return None
+    gauges = []
+    frames = sample_frames()
+    for i in xrange(num_gauges):
+        itr = ITR(None, Queue(), history_size=history_size, history_mode=history_mode)
+        for j in xrange(history_size):
+            itr.synchronizer.feed(frames[j % len(frames)])
+        gauges.append(itr)
+    gc.collect()
+    return float(rss() - before) / num_gauges
+
+def bench_scaling(num_gauges, engine, serial_mode='poll', duration=3.):
+    """ Returns the CPU seconds per wall clock second and gauge and the
+        received frames per second and gauge. With engine None, only
+        the feeder is running. """
+    ptys = [os.openpty() for i in range(num_gauges)]
+    devices = [os.ttyname(slave) for (master, slave) in ptys]
+    feeder = Feeder([master for (master, slave) in ptys])
+    acquisition = None
+    if engine is not None:
+        acquisition = GaugeAcquisition(devices, engine=engine, serial_mode=serial_mode, debug=False)
+        acquisition.start()
+    feeder.start()
+    time.sleep(0.5)
+    frames = lambda: sum(acquisition.gauges[device].synchronizer.frames for device in devices) if acquisition else 0
+    start_cpu, start_frames, start = cpu_time(), frames(), time.time()
+    time.sleep(duration)
+    elapsed = time.time() - start
+    used = (cpu_time() - start_cpu) / elapsed / num_gauges
+    frame_rate = (frames() - start_frames) / elapsed / num_gauges
+    feeder.close()
+    feeder.join()
+    if acquisition: acquisition.close()
+    for (master, slave) in ptys:
+        os.close(master)
+        os.close(slave)
+    return (used, frame_rate)
+
+# (engine, serial mode) combinations for the latency and scaling benchmarks:
+configurations = (('threads', 'poll'), ('threads', 'events'), ('eventloop', 'poll'))
+
+def run(benchmarks, gauge_counts, duration, captures=()):
+    results = []
+    def report(entry):
+        results.append(entry)
+        sys.stderr.write('%-70s %14.6g %s\n' % (result_key(entry), entry['value'], entry['unit']))
+    if 'throughput' in benchmarks:
+        for chunk_size in (1, 9, 64, 4096):
+            for via_queue in (False, True):
+                report(result('throughput', bench_throughput(chunk_size, via_queue), 'frames/s', 'higher',
+                              chunk_size=chunk_size, path='queue' if via_queue else 'direct'))
+    if 'decoding' in benchmarks:
+        ITR.pressure_table(0) # built once, not part of the measurement
+        for lookup_tables in (False, True):
+            report(result('decoding', bench_throughput(4096, lookup_tables=lookup_tables), 'frames/s', 'higher',
+                          decoding='table' if lookup_tables else 'pow'))
+    if 'latency' in benchmarks:
+        for (engine, mode) in configurations:
+            latencies = bench_latency(engine, mode)
+            for (name, fraction) in (('p50', .5), ('p99', .99)):
+                report(result('latency', percentile(latencies, fraction), 's', 'lower', engine=engine, mode=mode, stat=name))
+    if 'memory' in benchmarks:
+        # in a new process, as freed memory of the other benchmarks would be reused:
+        for mode in ITR.history_modes:
+            per_gauge = json.loads(subprocess.check_output([sys.executable, '-c',
+                'import bench_ingest, json; print json.dumps(bench_ingest.bench_memory(history_mode=%r))' % mode],
+                cwd=os.path.dirname(os.path.abspath(__file__))))
+            if per_gauge is not None:
+                report(result('memory', per_gauge, 'bytes/gauge', 'lower', history_size=1000, history_mode=mode))
+    if 'scaling' in benchmarks:
+        for num_gauges in gauge_counts:
+            (baseline, frame_rate) = bench_scaling(num_gauges, None, duration=duration)
+            for (engine, mode) in configurations:
+                (used, frame_rate) = bench_scaling(num_gauges, engine, mode, duration)
+                report(result('cpu', 100. * (used - baseline), '% per gauge', 'lower', gauges=num_gauges, engine=engine, mode=mode))
+                report(result('frame_rate', frame_rate, 'frames/s per gauge', 'higher', gauges=num_gauges, engine=engine, mode=mode))
+    for path in captures:
+        report(result('replay', bench_replay(path), 'frames/s', 'higher', capture=os.path.basename(path)))
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Prints the change of each result relative to the baseline and
+        returns the number of results that got worse by more than `tolerance`. """
+    former = dict((result_key(entry), entry) for entry in baseline)
+    regressions = 0
+    for entry in results:
+        key = result_key(entry)
+        if key not in former or not former[key]['value']:
+            continue
+        change = entry['value'] / former[key]['value'] - 1.
+        worse = change < -tolerance if entry['better'] == 'higher' else change > tolerance
+        regressions += worse
+        print '%-70s %+8.1f %%%s' % (key, 100. * change, '  REGRESSION' if worse else '')
+    return regressions
+
+if __name__ == "__main__":
+    benchmarks = ('throughput', 'decoding', 'latency', 'memory', 'scaling')
+    parser = argparse.ArgumentParser(description='Benchmark the ingest path of the gauges')
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=benchmarks, default=benchmarks, help='The benchmarks to run.')
+    parser.add_argument('-n', '--gauges', type=int, nargs='+', default=[1, 10, 100], help='The numbers of simulated gauges for the scaling benchmark.')
+    parser.add_argument('-t', '--duration', type=float, default=3., help='The duration of each scaling measurement in seconds.')
+    parser.add_argument('-c', '--capture', metavar='FILE', nargs='+', default=[], help='Also replay these capture files (see capture.py).')
+    parser.add_argument('-j', '--json', metavar='FILE', help='Write the results to FILE as JSON (- for stdout).')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare the results with those of a former run stored with --json.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='The relative change of a result regarded as a regression.')
+    args = parser.parse_args()
+
+    results = run(args.benchmarks, args.gauges, args.duration, args.capture)
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=1)
+    elif args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=1)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if compare(results, json.load(baseline), args.tolerance):
+                sys.exit(1)
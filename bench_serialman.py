@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+""" Measures the CPU time the SerialManager threads need per gauge.
+
+Each simulated gauge is a pseudo terminal that receives the frames of
+sampledata.sample_itr90 every 16 ms. The CPU time used by the feeder alone
+is measured first and subtracted from the results. Unix only. """
+
+import argparse
+import os
+import threading
+import time
+from Queue import Queue
+from sampledata import sample_itr90
+from serialman import SerialManager
+from Leybold import ITR
+
+class Feeder(threading.Thread):
+    """ Writes one frame to each pseudo terminal every `interval` seconds. """
+    def __init__(self, fds, interval=0.016):
+        self.fds = fds
+        self.interval = interval
+        data = ''.join(sample_itr90)
+        start = data.find('\x07\x05')
+        self.frames = [data[i:i+9] for i in range(start, len(data)-8, 9)]
+        self.closing = False # A flag to indicate thread shutdown
+        threading.Thread.__init__(self)
+
+    def run(self):
+        j = 0
+        next_time = time.time()
+        while not self.closing:
+            for fd in self.fds:
+                os.write(fd, self.frames[j])
+            j = (j + 1) % len(self.frames)
+            next_time += self.interval
+            time.sleep(max(0., next_time - time.time()))
+
+    def close(self):
+        self.closing = True
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def measure(num_gauges, mode, duration):
+    """ Returns the CPU seconds per wall clock second used with `num_gauges` gauges.
+        With mode None, only the feeder is running. """
+    ptys = [os.openpty() for i in range(num_gauges)]
+    feeder = Feeder([master for (master, slave) in ptys])
+    threads = []
+    if mode is not None:
+        for (master, slave) in ptys:
+            sm = SerialManager(os.ttyname(slave), mode=mode)
+            threads += [sm, ITR(sm.in_queue, Queue())]
+    for thread in threads:
+        thread.start()
+    feeder.start()
+    time.sleep(0.2)
+    start_cpu, start = cpu_time(), time.time()
+    time.sleep(duration)
+    used = (cpu_time() - start_cpu) / (time.time() - start)
+    for thread in threads + [feeder]:
+        thread.close()
+    for thread in threads + [feeder]:
+        thread.join()
+    for (master, slave) in ptys:
+        os.close(master)
+        os.close(slave)
+    return used
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the CPU usage of the SerialManager modes')
+    parser.add_argument('-n', '--gauges', type=int, nargs='+', default=[1, 4, 16], help='The numbers of simulated gauges.')
+    parser.add_argument('-t', '--duration', type=float, default=5., help='The duration of each measurement in seconds.')
+    args = parser.parse_args()
+
+    print "%8s %8s %16s" % ('gauges', 'mode', 'CPU % per gauge')
+    for num_gauges in args.gauges:
+        baseline = measure(num_gauges, None, args.duration)
+        for mode in SerialManager.modes:
+            used = measure(num_gauges, mode, args.duration) - baseline
+            print "%8d %8s %16.2f" % (num_gauges, mode, 100. * used / num_gauges)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+""" Capture files of the raw data received from a gauge, and their replay.
+
+A CaptureWriter records every chunk of bytes read from the serial port
+together with its arrival time on the monotonic clock, so a capture
+reproduces exactly what the frame synchronizer got: the chunking, line
+noise, partial frames and the timing. replay() feeds a capture into an
+ITR object in the calling thread, in real time, N times faster or as fast
+as possible.
+
+File layout (all little-endian):
+
+    header (64 bytes):
+        8s  magic 'LVGCAPT1'
+        I   header size
+        d   wall clock time of the start of the capture
+        d   monotonic clock time of the start of the capture
+        32s device name
+    records, one per chunk:
+        I   microseconds since the previous record (the start for the first)
+        H   length of the data
+        ... data
+
+Chunks longer than 65535 bytes are split into several records, pauses
+longer than the maximum delta are bridged by records without data. A
+capture cut short (e.g. by a crash) is read up to its last complete
+record. """
+
+import mmap
+import os
+import struct
+import sys
+import time
+from iotools import device_file_name
+from Leybold import ParseError
+
+MAGIC = 'LVGCAPT1'
+HEADER = struct.Struct('<8sIdd32s')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<IH')
+MAX_DELTA = 0xffffffff
+MAX_LENGTH = 0xffff
+
+def monotonic_clock():
+    """ clock_gettime(CLOCK_MONOTONIC) in seconds via ctypes, or time.time()
+        where it is not available. Python 2 has no time.monotonic(). """
+    try:
+        import ctypes
+        import ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_id = 6 if sys.platform == 'darwin' else 1
+        def monotonic():
+            now = timespec()
+            if clock_gettime(clock_id, ctypes.byref(now)):
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return now.tv_sec + now.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError, TypeError):
+        return time.time
+
+monotonic = monotonic_clock()
+
+def capture_path(directory, device_name):
+    """ A new capture file for the gauge `device_name`, e.g. dev_ttyUSB0-20240131-120000.cap """
+    return os.path.join(directory, device_file_name(device_name) + time.strftime('-%Y%m%d-%H%M%S.cap'))
+
+class CaptureWriter(object):
+    """ Records chunks of received data to the capture file `path`.
+
+    Only the thread reading the serial port calls write(); the records
+    are buffered by the file object. """
+    def __init__(self, path, device_name=''):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'wb')
+        self.start_monotonic = monotonic()
+        self.file.write(HEADER.pack(MAGIC, HEADER_SIZE, time.time(), self.start_monotonic, device_name).ljust(HEADER_SIZE, '\0'))
+        self.offset = 0 # microseconds since the start, of the last record
+
+    def write(self, data, timestamp=None):
+        """ Records `data` received at `timestamp` (monotonic clock, default: now) """
+        if timestamp is None:
+            timestamp = monotonic()
+        offset = int(round((timestamp - self.start_monotonic) * 1e6))
+        delta = max(offset - self.offset, 0)
+        self.offset += delta
+        write = self.file.write
+        while delta > MAX_DELTA:
+            write(RECORD.pack(MAX_DELTA, 0))
+            delta -= MAX_DELTA
+        for position in xrange(0, len(data), MAX_LENGTH):
+            chunk = data[position:position+MAX_LENGTH]
+            write(RECORD.pack(delta, len(chunk)))
+            write(chunk)
+            delta = 0
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class CaptureReader(object):
+    """ Read access to a capture file. Iterating yields the recorded
+        (seconds since the start of the capture, data) pairs. """
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size < HEADER_SIZE:
+                raise ValueError('%s is not a capture file' % path)
+            self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        (magic, header_size, start_time, start_monotonic, device_name) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        self.header_size = header_size
+        self.start_time = start_time
+        self.start_monotonic = start_monotonic
+        self.device_name = device_name.rstrip('\0')
+
+    def __iter__(self):
+        mm = self.mm
+        end = len(mm)
+        position = self.header_size
+        offset = 0
+        while position + RECORD.size <= end:
+            (delta, length) = RECORD.unpack_from(mm, position)
+            position += RECORD.size
+            if position + length > end: break
+            offset += delta
+            if length:
+                yield (offset * 1e-6, mm[position:position+length])
+            position += length
+
+    def duration(self):
+        """ The time of the last record in seconds since the start """
+        last = 0.
+        for (last, data) in self:
+            pass
+        return last
+
+    def close(self):
+        self.mm.close()
+
+def replay(path, itr, speed=1., recorded_times=True):
+    """ Feeds the capture file `path` into the frame synchronizer of the ITR
+    object `itr` in the calling thread, `speed` times faster than recorded
+    (None or 0: as fast as possible). With `recorded_times`, the readings
+    get the time they were originally received at (itr.last_update and
+    the pressure history), so the results don't depend on the speed.
+    Returns the number of bytes fed. """
+    reader = CaptureReader(path)
+    chunk_time = [reader.start_time]
+    if recorded_times:
+        itr.clock = lambda: chunk_time[0]
+    feed = itr.synchronizer.feed
+    fed = 0
+    start = time.time()
+    try:
+        for (offset, data) in reader:
+            if speed:
+                delay = start + offset / speed - time.time()
+                if delay > 0: time.sleep(delay)
+            chunk_time[0] = reader.start_time + offset
+            try:
+                feed(data)
+            except ParseError, e:
+                # like the event loop: a broken frame doesn't stop the replay
+                if itr.debug: print "%s: %s" % (path, e)
+            fed += len(data)
+    finally:
+        if recorded_times:
+            del itr.clock
+        reader.close()
+    return fed
+
+if __name__ == "__main__":
+    import argparse
+    from Queue import Queue
+    from Leybold import ITR
+
+    parser = argparse.ArgumentParser(description='Replay capture files of Leybold gauges and summarize them')
+    parser.add_argument('-s', '--speed', type=float, default=0., help='Replay N times faster than recorded (default: 0, as fast as possible).')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every reading.')
+    parser.add_argument('-L', '--lookup-tables', action='store_true', help='Decode the pressures with lookup tables instead of computing a power per reading.')
+    parser.add_argument('captures', metavar='CAPTURE_FILE', nargs='+', help='The capture files to replay.')
+    args = parser.parse_args()
+
+    for path in args.captures:
+        itr = ITR(None, Queue(), lookup_tables=args.lookup_tables)
+        if args.verbose:
+            itr.add_listener(lambda itr: sys.stdout.write('%.6f %s %.4g %s\n' % (itr.last_update, itr,
+                itr.pressure, ITR.pressure_units.get(itr.pressure_unit))))
+        reader = CaptureReader(path)
+        print '%s: %s, started %s, %.1f s' % (path, reader.device_name or 'unknown device',
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.start_time)), reader.duration())
+        reader.close()
+        start = time.time()
+        fed = replay(path, itr, args.speed)
+        elapsed = time.time() - start
+        synchronizer = itr.synchronizer
+        print '  %d bytes, %d frames (%.0f frames/s replayed), %d checksum errors, %d fixed byte errors, %d bytes dropped' % (
+            fed, synchronizer.frames, synchronizer.frames / elapsed if elapsed else 0., synchronizer.checksum_errors,
+            synchronizer.fixed_byte_errors, synchronizer.skipped_bytes)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+""" Decimation of the pressure history of a gauge at ingest time.
+
+Not every consumer needs all 62.5 readings per second. A decimated history
+wraps the pressure history of an ITR object (itr.pressure_history) and
+stores only a part of the readings, while itr.pressure is still updated
+on every frame for low-latency readers:
+
+* EveryNth keeps every n-th reading ('every:N'),
+* Buckets aggregates n readings ('bucket:N') or the readings of t
+  milliseconds ('bucket:Tms') into one bucket and stores its mean,
+  minimum, maximum and last reading. A short spike is averaged out of the
+  mean but still shows up in the maximum.
+
+Both provide the API of the wrapped history: averages and the history
+queries work on the kept readings or the bucket means, the other
+statistics of the buckets are available in self.statistics. The frame
+rate is still estimated from all readings and ITR.get_average_pressure()
+still averages over a number of readings, i.e. over correspondingly
+fewer samples. Listeners registered with itr.add_listener(listener,
+decimated=True) are only called for the readings stored. """
+
+from collections import deque
+
+class DecimatedHistory(object):
+    """ Forwards the queries to the wrapped `history` and estimates
+        the frame rate from all readings. """
+    def __init__(self, history):
+        self.history = history
+        self.statistics = dict(mean=history)
+        self.frame_times = deque(maxlen=64)
+
+    def __len__(self):
+        return len(self.history)
+
+    def __iter__(self):
+        return iter(self.history)
+
+    def __getattr__(self, name):
+        return getattr(self.history, name)
+
+    def rate(self, num_samples=64):
+        """ The number of readings per second over the last `num_samples` readings. """
+        times = self.frame_times
+        num_samples = min(num_samples, len(times))
+        if num_samples < 2:
+            return None
+        duration = times[-1] - times[-num_samples]
+        return (num_samples - 1) / duration if duration > 0 else None
+
+    def clear(self):
+        for history in self.statistics.values():
+            history.clear()
+        self.frame_times.clear()
+
+class EveryNth(DecimatedHistory):
+    """ Keeps the first of every `n` readings """
+    def __init__(self, history, n):
+        DecimatedHistory.__init__(self, history)
+        self.n = n
+        self.position = 0 # of the next reading in its group of n
+
+    @property
+    def readings_per_sample(self):
+        return self.n
+
+    def append(self, timestamp, value):
+        self.frame_times.append(timestamp)
+        if not self.position:
+            self.history.append(timestamp, value)
+        self.position += 1
+        if self.position == self.n:
+            self.position = 0
+
+    def clear(self):
+        DecimatedHistory.clear(self)
+        self.position = 0
+
+class Buckets(DecimatedHistory):
+    """ Aggregates `frames` readings or the readings of `interval` seconds into
+    a bucket, stored with the time of its last reading. A bucket of an
+    interval is closed by the first reading after it. The minima, maxima
+    and last readings are kept in histories of the same type and capacity
+    as the wrapped one, which holds the means. """
+    def __init__(self, history, frames=None, interval=None):
+        if not frames and not interval:
+            raise ValueError('a bucket needs a number of frames or an interval')
+        DecimatedHistory.__init__(self, history)
+        self.frames = frames
+        self.interval = interval
+        for name in ('min', 'max', 'last'):
+            self.statistics[name] = type(history)(history.capacity)
+        self.count = 0 # the number of readings in the open bucket
+
+    @property
+    def readings_per_sample(self):
+        if self.frames:
+            return self.frames
+        return max(self.interval * (self.rate() or 0.), 1.)
+
+    def append(self, timestamp, value):
+        self.frame_times.append(timestamp)
+        if self.count and self.interval and timestamp - self.start >= self.interval:
+            self.close_bucket()
+        if self.count:
+            self.total += value
+            if value < self.minimum: self.minimum = value
+            if value > self.maximum: self.maximum = value
+        else:
+            self.start = timestamp
+            self.total = self.minimum = self.maximum = value
+        self.count += 1
+        self.last = (timestamp, value)
+        if self.count == self.frames:
+            self.close_bucket()
+
+    def close_bucket(self):
+        (timestamp, value) = self.last
+        statistics = self.statistics
+        statistics['mean'].append(timestamp, self.total / self.count)
+        statistics['min'].append(timestamp, self.minimum)
+        statistics['max'].append(timestamp, self.maximum)
+        statistics['last'].append(timestamp, value)
+        self.count = 0
+
+    def clear(self):
+        DecimatedHistory.clear(self)
+        self.count = 0
+
+def parse_decimation(spec):
+    """ Returns a function wrapping a history according to `spec` ('every:N',
+        'bucket:N' or 'bucket:Tms'), or None for no decimation ('' or 'none'). """
+    if not spec or spec == 'none':
+        return None
+    (kind, sep, arg) = spec.partition(':')
+    try:
+        if kind == 'every' and int(arg) > 0:
+            return lambda history: EveryNth(history, int(arg))
+        if kind == 'bucket' and arg.endswith('ms') and float(arg[:-2]) > 0:
+            return lambda history: Buckets(history, interval=float(arg[:-2]) / 1000.)
+        if kind == 'bucket' and int(arg) > 0:
+            return lambda history: Buckets(history, frames=int(arg))
+    except ValueError:
+        pass
+    raise ValueError('unknown decimation %s' % spec)
+
+def decimation_option(option):
+    """ Parses a command line option '[DEVICE=]SPEC' into (device name or None, spec) """
+    (device_name, sep, spec) = option.rpartition('=')
+    parse_decimation(spec)
+    return (device_name or None, spec)
+
+def apply_decimation(itr, decimation, device_name):
+    """ Wraps the pressure history of `itr` as given for `device_name` in the
+        dict `decimation`, where the key None applies to all other gauges. """
+    if not decimation:
+        return
+    wrap = parse_decimation(decimation.get(device_name, decimation.get(None)))
+    if wrap:
+        itr.pressure_history = wrap(itr.pressure_history)
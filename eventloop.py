@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+""" Runs the acquisition of any number of gauges in a single thread.
+
+Instead of a SerialManager and an ITR thread per gauge connected by a
+queue, a single loop waits for all serial ports with select.poll() and
+feeds the received bytes directly to the frame synchronizer of the
+respective ITR object. Unix only. """
+
+import errno
+import os
+import select
+import sys
+import threading
+import time
+from Queue import Empty
+import serial
+from serialman import serial_settings
+from instrumentation import TimedQueue
+from capture import CaptureWriter, capture_path
+from decimation import apply_decimation
+from iotools import set_nonblocking
+from Leybold import ITR, ParseError
+
+class WakeupQueue(TimedQueue):
+    """ A queue that signals a pipe for each item put into it,
+        so that a poll() based loop notices new items. """
+    def __init__(self, wakeup_fd):
+        self.wakeup_fd = wakeup_fd
+        TimedQueue.__init__(self)
+
+    def _put(self, item):
+        TimedQueue._put(self, item)
+        try:
+            os.write(self.wakeup_fd, '\0')
+        except OSError, e:
+            # the pipe is full, the loop will be woken up anyway
+            if e.errno != errno.EAGAIN: raise
+
+class GaugeEventLoop(threading.Thread):
+    """ Owns the serial ports of all gauges in `device_names` and exposes an ITR
+        object per gauge in self.gauges. With `capture_dir`, the received data
+        of each gauge is also recorded to a capture file in that directory.
+        `decimation` maps device names to decimation specs (see decimation.py).
+        Remaining keyword arguments are handed to the ITR objects. """
+    read_size = 4096
+    poll_timeout_ms = 100
+    # seconds between the checks for commands to gauges which stopped sending:
+    expire_interval = 0.1
+
+    def __init__(self, device_names, serial_kwargs=dict(), capture_dir=None, decimation=None, **itr_kwargs):
+        self.debug = itr_kwargs.get('debug', False)
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            set_nonblocking(fd)
+        self.gauges = dict()
+        self._ports = dict() # file descriptor -> (serial port, ITR)
+        self._captures = dict() # file descriptor -> CaptureWriter
+        for device_name in device_names:
+            ser = serial.Serial(device_name, **serial_settings(serial_kwargs))
+            itr = ITR(None, WakeupQueue(self._wakeup_w), **itr_kwargs)
+            apply_decimation(itr, decimation, device_name)
+            self.gauges[device_name] = itr
+            self._ports[ser.fileno()] = (ser, itr)
+            if capture_dir:
+                self._captures[ser.fileno()] = CaptureWriter(capture_path(capture_dir, device_name), device_name)
+        self.closing = False # A flag to indicate thread shutdown
+        threading.Thread.__init__(self)
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self._wakeup_r, select.POLLIN)
+        for fd in self._ports:
+            set_nonblocking(fd)
+            poller.register(fd, select.POLLIN)
+        last_expired = time.time()
+        try:
+            while not self.closing:
+                if time.time() - last_expired >= self.expire_interval:
+                    last_expired = time.time()
+                    self.expire_commands()
+                for (fd, event) in poller.poll(self.poll_timeout_ms):
+                    if fd == self._wakeup_r:
+                        self.drain_wakeup_pipe()
+                        self.write_commands()
+                    elif event & select.POLLIN:
+                        self.read_port(fd)
+                    else:
+                        # POLLHUP / POLLERR: the device is gone
+                        poller.unregister(fd)
+                        if self.debug: print "Lost serial port %s" % self._ports[fd][0].port
+        finally:
+            for (ser, itr) in self._ports.values():
+                ser.close()
+            for capture in self._captures.values():
+                capture.close()
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+
+    def read_port(self, fd):
+        (ser, itr) = self._ports[fd]
+        try:
+            data = os.read(fd, self.read_size)
+        except OSError, e:
+            if e.errno == errno.EAGAIN: return
+            raise
+        capture = self._captures.get(fd)
+        try:
+            if capture is not None: capture.write(data)
+            itr.synchronizer.feed(data)
+        except ParseError, e:
+            # a single broken frame must not stop the acquisition of all gauges
+            if self.debug: print "%s: %s" % (ser.port, e)
+        except Exception, e:
+            # neither must a failing listener or capture file of one gauge
+            sys.stderr.write("%s: %s: %s\n" % (ser.port, e.__class__.__name__, e))
+
+    def expire_commands(self):
+        for (ser, itr) in self._ports.values():
+            itr.command_scheduler.expire()
+
+    def drain_wakeup_pipe(self):
+        try:
+            while os.read(self._wakeup_r, self.read_size): pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN: raise
+
+    def write_commands(self):
+        for (ser, itr) in self._ports.values():
+            while True:
+                try:
+                    ser.write(itr.out_queue.get_nowait())
+                except Empty:
+                    break
+                itr.out_queue.sent()
+
+    def close(self):
+        self.closing = True
+
+if __name__ == "__main__":
+    loop = GaugeEventLoop(sys.argv[1:], debug = True)
+    loop.start()
+    try:
+        while True:
+            time.sleep(1.)
+            for device in sorted(loop.gauges):
+                itr = loop.gauges[device]
+                if itr.pressure is None: continue
+                print "%s: %.3g %s (%s)" % (device, itr.pressure, ITR.pressure_units[itr.pressure_unit], itr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+    loop.join()
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+
+""" A daemon owning the serial ports, serving the gauges over a Unix socket.
+
+Any number of front-ends (like the API and interface web servers) can
+connect to the daemon and may be restarted without interrupting the
+acquisition.
+
+Protocol: every request is a header (uint32 request id, uint8 opcode,
+uint32 payload length, little-endian) followed by the payload. The daemon
+answers each request, in order, with a header (uint32 request id, uint8
+status, uint32 payload length) and the payload. Clients may send any number
+of requests before reading the responses (pipelining). Device names are
+sent as uint16 length + UTF-8 bytes. COMMAND answers with the state of the
+scheduled command as JSON, WAIT waits a little for a command to finish and
+answers with its state again. """
+
+import json
+import math
+import os
+import socket
+import struct
+import threading
+import time
+from array import array
+from SocketServer import ThreadingUnixStreamServer, StreamRequestHandler
+from Leybold import ITR, ITR90, ITR200, GaugeState, LeyboldError, NoDataError
+from instrumentation import render_gauges
+from iotools import to_little_endian
+from profiling import GaugeProfiler
+
+REQUEST = struct.Struct('<IBI')
+RESPONSE = struct.Struct('<IBI')
+# opcodes:
+LIST, STATE, AVERAGE, HISTORY, COMMAND, METRICS, PROFILE, WAIT = range(1, 9)
+# status codes:
+OK, ERROR, NO_DATA = range(3)
+# sequence, last_update, pressure, pressure_unit, emission_state, toggle_bit, version,
+# sensor_type, error_code, currently_adjusting, frame_rate; unknown is -1 / NaN
+STATE_RECORD = struct.Struct('<Qddbbbdbbbd')
+state_fields = ('sequence', 'last_update', 'pressure', 'pressure_unit', 'emission_state', 'toggle_bit', 'version',
+                'sensor_type', 'error_code', 'currently_adjusting', 'frame_rate')
+HISTORY_QUERY = struct.Struct('<ddI') # from, to (NaN for open ends), max_points (0: all), then optionally a statistic
+AVERAGE_QUERY = struct.Struct('<I')
+WAIT_QUERY = struct.Struct('<Id') # command id, seconds to wait at most
+# the commands a client may call and how their argument is encoded:
+commands = {
+    'send_message': str,
+    'set_unit_mbar': None,
+    'set_unit_Torr': None,
+    'set_unit_Pa': None,
+    'permanently_store_unit': None,
+    'set_degas': bool,
+    'clear_history': None,
+    'clear_buffers': None,
+}
+sensor_types = {10: ITR90, 12: ITR200}
+
+class DaemonError(LeyboldError):
+    pass
+
+def pack_name(name):
+    name = name.encode('utf-8')
+    return struct.pack('<H', len(name)) + name
+
+def unpack_name(payload):
+    """ Returns the name at the start of `payload` and the rest of it. """
+    (length,) = struct.unpack_from('<H', payload)
+    return (payload[2:2+length].decode('utf-8'), payload[2+length:])
+
+def nan_if_none(value):
+    return float('nan') if value is None else value
+
+def minus_one_if_none(value):
+    return -1 if value is None else int(value)
+
+class GaugeDaemon(ThreadingUnixStreamServer):
+    """ Serves the gauges of a GaugeAcquisition on the Unix socket `path`. """
+    daemon_threads = True
+    # seconds a WAIT may hold up the other requests of a front-end:
+    max_wait = 0.1
+
+    def __init__(self, path, acquisition):
+        self.acquisition = acquisition
+        self.profiler = GaugeProfiler(acquisition.gauges)
+        if os.path.exists(path):
+            os.unlink(path)
+        ThreadingUnixStreamServer.__init__(self, path, GaugeRequestHandler)
+
+    def handle_request_payload(self, opcode, payload):
+        """ Returns the status and payload of the response. """
+        gauges = self.acquisition.gauges
+        if opcode == LIST:
+            return (OK, ''.join(pack_name(name) for name in sorted(gauges)))
+        if opcode == METRICS:
+            return (OK, render_gauges(gauges))
+        if opcode == PROFILE:
+            # a JSON object with the arguments of GaugeProfiler.configure()
+            if not self.profiler.configure(**dict((str(key), value) for (key, value) in json.loads(payload).items())):
+                return (ERROR, 'A cProfile window is running already')
+            return (OK, json.dumps(self.profiler.state()))
+        (name, payload) = unpack_name(payload)
+        if name not in gauges:
+            return (ERROR, 'This gauge does not exist')
+        itr = gauges[name]
+        try:
+            if opcode == STATE:
+                return (OK, self.pack_state(itr))
+            if opcode == AVERAGE:
+                (num_samples,) = AVERAGE_QUERY.unpack(payload)
+                return (OK, struct.pack('<d', itr.get_average_pressure(num_samples)))
+            if opcode == HISTORY:
+                (t_from, t_to, max_points) = HISTORY_QUERY.unpack_from(payload)
+                statistic = payload[HISTORY_QUERY.size:] or None
+                if not hasattr(itr, 'get_history'):
+                    return (ERROR, 'The history is not available for this engine')
+                (num_points, chunks) = itr.get_history(None if math.isnan(t_from) else t_from,
+                                                       None if math.isnan(t_to) else t_to, max_points or None, statistic)
+                data = array('d')
+                for chunk in chunks:
+                    data.extend(chunk)
+                return (OK, to_little_endian(data).tostring())
+            if opcode == COMMAND:
+                (command, argument) = unpack_name(payload)
+                if command not in commands:
+                    return (ERROR, 'Unknown command %s' % command)
+                if commands[command] is bool:
+                    args = (argument == '\x01',)
+                elif commands[command] is str:
+                    args = (argument,)
+                else:
+                    args = ()
+                scheduled = getattr(itr, command)(*args)
+                # gauges of worker processes don't report back
+                return (OK, json.dumps(scheduled.to_dict()) if hasattr(scheduled, 'to_dict') else '')
+            if opcode == WAIT:
+                (command_id, timeout) = WAIT_QUERY.unpack(payload)
+                for scheduled in list(itr.command_scheduler.recent):
+                    if scheduled.id == command_id:
+                        scheduled.wait(min(timeout, self.max_wait))
+                        return (OK, json.dumps(scheduled.to_dict()))
+                return (ERROR, 'Unknown command %d' % command_id)
+        except NoDataError, e:
+            return (NO_DATA, str(e))
+        except (LeyboldError, AttributeError, ValueError), e:
+            return (ERROR, str(e))
+        return (ERROR, 'Unknown opcode %d' % opcode)
+
+    @staticmethod
+    def pack_state(itr):
+        state = itr.state
+        sensor_type = 0
+        for (code, cls) in sensor_types.items():
+            if state.sensor_type is cls: sensor_type = code
+        return STATE_RECORD.pack(state.sequence, nan_if_none(state.last_update), nan_if_none(state.pressure),
+            minus_one_if_none(state.pressure_unit), minus_one_if_none(state.emission_state),
+            minus_one_if_none(state.toggle_bit), nan_if_none(state.version), sensor_type,
+            minus_one_if_none(state.error_code), minus_one_if_none(state.currently_adjusting),
+            nan_if_none(itr.get_frame_rate()))
+
+class GaugeRequestHandler(StreamRequestHandler):
+    def handle(self):
+        while True:
+            header = self.rfile.read(REQUEST.size)
+            if len(header) < REQUEST.size:
+                break
+            (request_id, opcode, length) = REQUEST.unpack(header)
+            payload = self.rfile.read(length)
+            (status, body) = self.server.handle_request_payload(opcode, payload)
+            self.wfile.write(RESPONSE.pack(request_id, status, len(body)) + body)
+
+class GaugeDaemonClient(object):
+    """ A connection to a GaugeDaemon, shared by all threads of a front-end.
+        Reconnects once if the daemon was restarted, otherwise raises a DaemonError. """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sock = None
+        self.rfile = None
+        self.next_id = 0
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.rfile = self.sock.makefile('rb')
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = self.rfile = None
+
+    def pipeline(self, requests):
+        """ Sends all (opcode, payload) `requests` at once and returns the
+            list of (status, payload) responses. """
+        with self.lock:
+            try:
+                return self._pipeline(requests)
+            except (socket.error, EOFError):
+                self.close()
+            try:
+                return self._pipeline(requests)
+            except (socket.error, EOFError), e:
+                self.close()
+                raise DaemonError('The gauge daemon is not available: %s' % e)
+
+    def _pipeline(self, requests):
+        if self.sock is None:
+            self.connect()
+        first_id = self.next_id
+        self.next_id = (self.next_id + len(requests)) % 2**32
+        self.sock.sendall(''.join(REQUEST.pack((first_id + i) % 2**32, opcode, len(payload)) + payload
+                                  for (i, (opcode, payload)) in enumerate(requests)))
+        responses = []
+        for i in range(len(requests)):
+            header = self.rfile.read(RESPONSE.size)
+            if len(header) < RESPONSE.size:
+                raise EOFError('The gauge daemon closed the connection')
+            (request_id, status, length) = RESPONSE.unpack(header)
+            responses.append((status, self.rfile.read(length)))
+        return responses
+
+    def request(self, opcode, payload=''):
+        (status, payload) = self.pipeline([(opcode, payload)])[0]
+        return check_response(status, payload)
+
+    def list_gauges(self):
+        payload = self.request(LIST)
+        names = []
+        while payload:
+            (name, payload) = unpack_name(payload)
+            names.append(name)
+        return names
+
+    def metrics(self):
+        """ The ingest metrics of the daemon in the Prometheus text format """
+        return self.request(METRICS)
+
+    def gauges(self):
+        return dict((name, RemoteGauge(self, name)) for name in self.list_gauges())
+
+    def read_states(self, names):
+        """ Reads the states of several gauges with one round trip. """
+        responses = self.pipeline([(STATE, pack_name(name)) for name in names])
+        return [unpack_state(check_response(status, payload)) for (status, payload) in responses]
+
+def check_response(status, payload):
+    if status == NO_DATA:
+        raise NoDataError(payload)
+    if status != OK:
+        raise DaemonError(payload)
+    return payload
+
+def unpack_state(payload):
+    state = dict(zip(state_fields, STATE_RECORD.unpack(payload)))
+    for name in state:
+        if state[name] == -1 or state[name] != state[name]:
+            state[name] = None
+    for name in ('toggle_bit', 'currently_adjusting'):
+        if state[name] is not None: state[name] = bool(state[name])
+    state['sensor_type'] = sensor_types.get(state['sensor_type'])
+    return state
+
+class RemoteGauge(object):
+    """ Provides the API of an ITR object for a gauge served by a GaugeDaemon.
+        The state is cached for `max_age` seconds. """
+    max_age = 0.02
+
+    def __init__(self, client, device_name):
+        self.client = client
+        self.device_name = device_name
+        self.last_state = None
+        self.state_time = 0.
+
+    def read_state(self):
+        if time.time() - self.state_time > self.max_age:
+            self.set_state(self.client.read_states([self.device_name])[0])
+        return self.last_state
+
+    def set_state(self, state):
+        self.last_state = state
+        self.state_time = time.time()
+
+    def __getattr__(self, name):
+        if name in commands:
+            return lambda *args: self.call(name, *args)
+        if name not in state_fields:
+            raise AttributeError(name)
+        return self.read_state()[name]
+
+    @property
+    def state(self):
+        state = self.read_state()
+        return GaugeState(*[state[name] for name in GaugeState._fields])
+
+    def call(self, command, *args):
+        argument = ''
+        if commands[command] is bool:
+            argument = '\x01' if (args[0] if args else True) else '\x00'
+        elif commands[command] is str:
+            argument = args[0]
+        payload = self.client.request(COMMAND, pack_name(self.device_name) + pack_name(command) + argument)
+        return RemoteCommand(self, json.loads(payload)) if payload else None
+
+    def get_average_pressure(self, num_samples=60):
+        payload = self.client.request(AVERAGE, pack_name(self.device_name) + AVERAGE_QUERY.pack(num_samples))
+        return struct.unpack('<d', payload)[0]
+
+    def get_frame_rate(self):
+        return self.frame_rate
+
+    def get_history(self, t_from=None, t_to=None, max_points=None, statistic=None):
+        query = HISTORY_QUERY.pack(nan_if_none(t_from), nan_if_none(t_to), max_points or 0) + (statistic or '')
+        data = array('d')
+        data.fromstring(self.client.request(HISTORY, pack_name(self.device_name) + query))
+        return (len(data) // 2, [to_little_endian(data)])
+
+    def __str__(self):
+        sensor_type = self.sensor_type
+        return sensor_type.__name__ if sensor_type else ITR.__name__
+
+class RemoteCommand(object):
+    """ Provides the API of a Command for a command scheduled by a GaugeDaemon. """
+    final_states = ('confirmed', 'superseded', 'timeout')
+
+    def __init__(self, gauge, state):
+        self.gauge = gauge
+        self.last_state = state # as returned by Command.to_dict()
+
+    def done(self):
+        return self.last_state['state'] in self.final_states
+
+    def wait(self, timeout=None):
+        """ Returns True if the command finished within `timeout` seconds """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.done():
+            remaining = GaugeDaemon.max_wait if deadline is None else deadline - time.time()
+            if remaining <= 0:
+                break
+            payload = self.gauge.client.request(WAIT, pack_name(self.gauge.device_name) + WAIT_QUERY.pack(self.last_state['id'], remaining))
+            self.last_state = json.loads(payload)
+        return self.done()
+
+    def to_dict(self):
+        return dict(self.last_state)
+
+class RemoteProfiler(object):
+    """ Provides the API of a GaugeProfiler for the gauges of a GaugeDaemon. """
+    def __init__(self, client):
+        self.client = client
+
+    def configure(self, enabled=None, reset=False, cprofile=None):
+        try:
+            self.client.request(PROFILE, json.dumps(dict(enabled=enabled, reset=reset, cprofile=cprofile)))
+        except DaemonError:
+            return False
+        return True
+
+    def state(self):
+        return json.loads(self.client.request(PROFILE, '{}'))
+
+    def toggle(self):
+        self.configure(enabled=not self.state()['enabled'])
+
+    def run_cprofile(self, seconds=10.):
+        return self.configure(cprofile=seconds)
+
+def prefetch_states(gauges):
+    """ Fetches the states of all RemoteGauges in `gauges` with one round trip per daemon. """
+    by_client = dict()
+    for gauge in gauges:
+        if isinstance(gauge, RemoteGauge):
+            by_client.setdefault(gauge.client, []).append(gauge)
+    for (client, remote_gauges) in by_client.items():
+        states = client.read_states([gauge.device_name for gauge in remote_gauges])
+        for (gauge, state) in zip(remote_gauges, states):
+            gauge.set_state(state)
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from serial.serialutil import SerialException
+    from acquisition import add_arguments, from_args
+    from profiling import install_signal_handlers
+
+    parser = argparse.ArgumentParser(description='Start the Leybold Vacuum Gauges acquisition daemon')
+    parser.add_argument('-S', '--socket', default='/tmp/leybold-gauges.sock', help='The Unix socket to listen on.')
+    add_arguments(parser, engine='eventloop')
+    parser.add_argument('serial_ports', metavar='SERIAL_PORT', nargs='+',
+                        help='The serial port to connect to, sth. like COM7 on Windows /dev/ttyUSB1 on Linux.')
+    args = parser.parse_args()
+
+    try:
+        acquisition = from_args(args, debug=False)
+    except SerialException, e:
+        sys.stdout.write('Could not open serial device: {0}\n'.format(e))
+        sys.exit(1)
+    acquisition.start()
+    daemon = GaugeDaemon(args.socket, acquisition)
+    install_signal_handlers(daemon.profiler)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        os.unlink(args.socket)
+        acquisition.close()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+""" Cheap counters and histograms for the ingest path of the gauges,
+rendered in the Prometheus text exposition format.
+
+All updates happen in the thread owning the gauge and are plain integer
+and float additions, so they are always enabled. Scrapes read the values
+without locking; a scrape may see an observation counted in a bucket but
+not yet in the sum, which Prometheus tolerates. """
+
+import bisect
+import time
+from Queue import Queue
+
+# seconds, for parsing a single frame:
+parse_latency_bounds = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3)
+# seconds, from queueing a command until it was written to the serial port:
+command_latency_bounds = (1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.)
+
+class Histogram(object):
+    """ Counts observations in buckets with the upper bounds `bounds`. """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ Returns the (upper bound, number of observations <= bound) pairs. """
+        total = 0
+        buckets = []
+        for (bound, count) in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+class TimedQueue(Queue):
+    """ A queue remembering when its items were put into it.
+
+    The (single) consumer calls sent() after handing an item on, which
+    records the time the item spent waiting in self.latency. """
+    def __init__(self, maxsize=0):
+        Queue.__init__(self, maxsize)
+        self.latency = Histogram(command_latency_bounds)
+        self.put_time = None
+
+    def _put(self, item):
+        Queue._put(self, (time.time(), item))
+
+    def _get(self):
+        (self.put_time, item) = Queue._get(self)
+        return item
+
+    def sent(self):
+        self.latency.observe(time.time() - self.put_time)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (name, escaped(labels[name])) for name in sorted(labels)) + '}'
+
+class Exposition(object):
+    """ Collects metric families and renders them in the text exposition format. """
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, kind, help_text):
+        self.lines.append('# HELP %s %s' % (name, help_text))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+
+    def sample(self, name, labels, value):
+        if value is None: return
+        self.lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+    def histogram(self, name, labels, histogram):
+        for (bound, count) in histogram.cumulative():
+            self.sample(name + '_bucket', dict(labels, le=format_value(bound)), count)
+        self.sample(name + '_sum', labels, histogram.sum)
+        self.sample(name + '_count', labels, histogram.count)
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+# (metric name, type, help, function returning the value for an ITR)
+gauge_metrics = (
+    ('leybold_bytes_received_total', 'counter', 'Bytes received from the gauge.',
+        lambda itr: itr.synchronizer.bytes_received),
+    ('leybold_frames_total', 'counter', 'Valid frames decoded.',
+        lambda itr: itr.synchronizer.frames),
+    ('leybold_checksum_errors_total', 'counter', 'Frames with a wrong checksum.',
+        lambda itr: itr.synchronizer.checksum_errors),
+    ('leybold_fixed_byte_errors_total', 'counter', 'Frames with a wrong fixed byte.',
+        lambda itr: itr.synchronizer.fixed_byte_errors),
+    ('leybold_resync_dropped_bytes_total', 'counter', 'Bytes dropped while searching for the next frame.',
+        lambda itr: itr.synchronizer.skipped_bytes),
+    ('leybold_frame_rate_hz', 'gauge', 'Frames per second, estimated from the pressure history.',
+        lambda itr: itr.get_frame_rate()),
+    ('leybold_in_queue_depth', 'gauge', 'Chunks of received data waiting to be decoded.',
+        lambda itr: itr.in_queue.qsize() if itr.in_queue is not None else None),
+    ('leybold_out_queue_depth', 'gauge', 'Commands waiting to be sent to the gauge.',
+        lambda itr: itr.out_queue.qsize()),
+)
+
+def render_gauges(gauges):
+    """ Renders the metrics of all ITR objects in the dict `gauges` (by device name).
+        Gauges running in other processes have no ingest metrics and are skipped. """
+    local = sorted((device, itr) for (device, itr) in gauges.items() if hasattr(itr, 'synchronizer'))
+    exposition = Exposition()
+    for (name, kind, help_text, value) in gauge_metrics:
+        exposition.family(name, kind, help_text)
+        for (device, itr) in local:
+            exposition.sample(name, dict(device=device), value(itr))
+    exposition.family('leybold_parse_latency_seconds', 'histogram', 'Time to parse a single frame.')
+    for (device, itr) in local:
+        exposition.histogram('leybold_parse_latency_seconds', dict(device=device), itr.parse_latency)
+    exposition.family('leybold_command_latency_seconds', 'histogram', 'Time from queueing a command until it was written to the serial port.')
+    for (device, itr) in local:
+        if isinstance(itr.out_queue, TimedQueue):
+            exposition.histogram('leybold_command_latency_seconds', dict(device=device), itr.out_queue.latency)
+    exposition.family('leybold_command_confirm_seconds', 'histogram', 'Time from sending a command until the status frames confirmed it.')
+    for (device, itr) in local:
+        exposition.histogram('leybold_command_confirm_seconds', dict(device=device), itr.command_scheduler.latency)
+    return exposition.render()
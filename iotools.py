@@ -0,0 +1,25 @@
+""" Helpers shared by the modules reading serial ports and writing files:
+non-blocking file descriptors, file names per gauge and the byte order
+of the binary file formats and protocols (all little-endian). """
+
+import os
+import re
+import sys
+
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+def to_little_endian(data):
+    """ Swaps the bytes of the array `data` in place unless this machine is
+        little-endian, i.e. converts native to little-endian and vice versa. """
+    if not LITTLE_ENDIAN:
+        data.byteswap()
+    return data
+
+def device_file_name(device_name):
+    """ A file name for the gauge `device_name`, e.g. dev_ttyUSB0 for /dev/ttyUSB0 """
+    return re.sub(r'[^A-Za-z0-9]+', '_', device_name).strip('_')
+
+def set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
@@ -35,16 +35,108 @@ class DataCollector(object):
             pass
 
 import math
+import itertools
 def get_metric(dc, seconds, transformation):
-    history = dc.rbuffer.to_list()
-    num_entries = min(len(history), int(math.floor(float(seconds) / dc.update_every_seconds)))
-    history = history[-num_entries:]
+    num_entries = min(len(dc.rbuffer), int(math.floor(float(seconds) / dc.update_every_seconds)))
     val = .0
     tim = .0
-    for entry in history:
+    for entry in itertools.islice(reversed(dc.rbuffer), num_entries):
         tim += entry[0]
         val += transformation(entry[1])
-    return (tim/len(history), val/len(history))
+    return (tim/num_entries, val/num_entries)
+
+class Bucket(object):
+    """ The aggregate of all values within [start, start+seconds) """
+    __slots__ = ('start', 'total', 'minimum', 'maximum', 'count')
+    def __init__(self, start):
+        self.start = start
+        self.total = .0
+        self.minimum = float('inf')
+        self.maximum = float('-inf')
+        self.count = 0
+    def add(self, value):
+        self.total += value
+        if value < self.minimum: self.minimum = value
+        if value > self.maximum: self.maximum = value
+        self.count += 1
+    def merge(self, other):
+        self.total += other.total
+        if other.minimum < self.minimum: self.minimum = other.minimum
+        if other.maximum > self.maximum: self.maximum = other.maximum
+        self.count += other.count
+    @property
+    def mean(self):
+        return self.total / self.count
+    def to_dict(self):
+        return dict(start=self.start, mean=self.mean, min=self.minimum, max=self.maximum, count=self.count)
+
+class RollupLevel(object):
+    """ Keeps the last `maxlen` completed buckets of `seconds` length """
+    def __init__(self, seconds, maxlen):
+        self.seconds = seconds
+        self.rbuffer = RingBuffer(maxlen)
+        self.current = None
+    def bucket_start(self, timestamp):
+        return math.floor(timestamp / self.seconds) * self.seconds
+    def add(self, timestamp, value=None, bucket=None):
+        """ Adds a value or merges a bucket of a finer level.
+            Returns the bucket completed by this, if any. """
+        completed = None
+        if self.current is None or timestamp >= self.current.start + self.seconds:
+            completed = self.current
+            if completed is not None: self.rbuffer.append(completed)
+            self.current = Bucket(self.bucket_start(timestamp))
+        if bucket is None:
+            self.current.add(value)
+        else:
+            self.current.merge(bucket)
+        return completed
+    def buckets(self, t_from=None, t_to=None):
+        """ The completed buckets and the current one overlapping [t_from, t_to) """
+        buckets = list(self.rbuffer)
+        if self.current is not None: buckets.append(self.current)
+        return [bucket for bucket in buckets if (t_from is None or bucket.start + self.seconds > t_from)
+                                            and (t_to is None or bucket.start < t_to)]
+
+class Rollup(object):
+    """ Aggregates values incrementally into buckets of increasing length.
+
+    Each value is added to the bucket of the finest level only. When a
+    bucket completes, it is merged into the current bucket of the next
+    coarser level, so the work per value is constant. By default 1 s
+    buckets are kept for an hour, 1 min buckets for a day and 1 h buckets
+    for 90 days. Instances can be registered as ITR listeners, which
+    aggregate the pressures in mbar, so a unit change doesn't mix units. """
+    default_levels = ((1, 3600), (60, 24*60), (3600, 90*24))
+    def __init__(self, levels=default_levels):
+        self.levels = [RollupLevel(seconds, maxlen) for (seconds, maxlen) in levels]
+    def __call__(self, itr):
+        if itr.pressure is None: return
+        self.add(itr.last_update, itr.to_mbar(itr.pressure, itr.pressure_unit))
+    def add(self, timestamp, value):
+        completed = self.levels[0].add(timestamp, value)
+        for level in self.levels[1:]:
+            if completed is None: break
+            completed = level.add(completed.start, bucket=completed)
+    def clear(self):
+        for level in self.levels:
+            level.rbuffer.clear()
+            level.current = None
+    def level(self, seconds):
+        for level in self.levels:
+            if level.seconds == seconds: return level
+        raise KeyError('no rollup level with %s second buckets' % seconds)
+    def query(self, t_from=None, t_to=None, max_buckets=None):
+        """ Returns the buckets of the finest level covering [t_from, t_to)
+            in at most `max_buckets` buckets. """
+        for level in self.levels:
+            buckets = level.buckets(t_from, t_to)
+            rbuffer = level.rbuffer
+            # does this level still hold everything from t_from on?
+            complete = len(rbuffer) < rbuffer.maxlen or (t_from is not None and rbuffer[0].start <= t_from)
+            if complete and (max_buckets is None or len(buckets) <= max_buckets):
+                break
+        return (level.seconds, buckets)
 
 def returner(argument):
     return argument
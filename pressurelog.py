@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+""" A persistent, append-only log of the pressure readings of a gauge.
+
+The samples are stored in segment files as fixed size little-endian
+records (double time, double pressure in mbar, whatever unit the gauge
+is set to). Each segment `<start>.seg` comes
+with a sparse index `<start>.idx` holding the (time, record number) of
+every `index_every`-th record, where <start> is the time of the first
+record in microseconds. Range queries map the relevant segments and use
+binary search instead of scanning the files. """
+
+import bisect
+import mmap
+import os
+import struct
+from array import array
+from iotools import to_little_endian, device_file_name
+from Leybold import HistoryWriter
+
+RECORD = struct.Struct('<dd')
+INDEX_ENTRY = struct.Struct('<dQ')
+
+def pressure_log_path(directory, device_name):
+    """ The directory used for the log of the gauge `device_name` """
+    return os.path.join(directory, device_file_name(device_name))
+
+class PressureLogWriter(HistoryWriter):
+    """ Appends samples to the log in `path`, writing them in batches.
+
+    Instances can be registered as ITR listeners with
+    itr.add_listener(writer, decimated=True).
+    The ingest thread only appends to an in-memory batch; the files are
+    written once per `batch_size` samples. """
+    def __init__(self, path, segment_records=1<<20, index_every=1024, batch_size=512):
+        self.path = path
+        self.segment_records = segment_records
+        self.index_every = index_every
+        self.batch_size = batch_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.batch = array('d')
+        self.segment = None
+        self.index = None
+        self.segment_count = 0 # the number of records in the current segment
+
+    def append(self, timestamp, value):
+        self.batch.append(timestamp)
+        self.batch.append(value)
+        if len(self.batch) >= 2 * self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch = self.batch
+        position = 0
+        while position < len(batch):
+            if self.segment is None or self.segment_count >= self.segment_records:
+                self.open_segment(batch[position])
+            num_records = min(len(batch)/2 - position/2, self.segment_records - self.segment_count)
+            chunk = batch[position:position + 2*num_records]
+            for record in xrange(-self.segment_count % self.index_every, num_records, self.index_every):
+                self.index.write(INDEX_ENTRY.pack(chunk[2*record], self.segment_count + record))
+            self.segment.write(to_little_endian(chunk).tostring())
+            self.segment_count += num_records
+            position += 2*num_records
+        del batch[:]
+        if self.segment is not None:
+            self.segment.flush()
+            self.index.flush()
+
+    def open_segment(self, start_time):
+        self.close_segment()
+        name = os.path.join(self.path, '%d' % int(start_time * 1e6))
+        self.segment = open(name + '.seg', 'ab')
+        self.index = open(name + '.idx', 'ab')
+        self.segment_count = 0
+
+    def close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = self.index = None
+
+    def close(self):
+        self.flush()
+        self.close_segment()
+
+class PressureLogReader(object):
+    """ Range queries on the log in `path`. """
+    def __init__(self, path):
+        self.path = path
+
+    def segments(self):
+        """ The (start time, file name without extension) of all segments, oldest first """
+        starts = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg'))
+        return [(start / 1e6, os.path.join(self.path, '%d' % start)) for start in starts]
+
+    def iter_raw(self, t_from=None, t_to=None, chunk_records=65536):
+        """ Yields the records with t_from <= time < t_to as strings of
+            little-endian (time, pressure) doubles of up to `chunk_records` records each. """
+        segments = self.segments()
+        for (i, (start, name)) in enumerate(segments):
+            if t_to is not None and start >= t_to: break
+            if t_from is not None and i + 1 < len(segments) and segments[i+1][0] <= t_from: continue
+            for chunk in self._iter_segment(name, t_from, t_to, chunk_records):
+                yield chunk
+
+    def query(self, t_from=None, t_to=None):
+        """ Returns the records with t_from <= time < t_to as an array('d')
+            of interleaved times and pressures. """
+        data = array('d')
+        for chunk in self.iter_raw(t_from, t_to):
+            data.fromstring(chunk)
+        return to_little_endian(data)
+
+    def _iter_segment(self, name, t_from, t_to, chunk_records):
+        with open(name + '.seg', 'rb') as segment:
+            num_records = os.fstat(segment.fileno()).st_size // RECORD.size
+            if not num_records: return
+            mm = mmap.mmap(segment.fileno(), num_records * RECORD.size, access=mmap.ACCESS_READ)
+        try:
+            index = self._read_index(name)
+            first = 0 if t_from is None else self._search(mm, index, num_records, t_from)
+            last = num_records if t_to is None else self._search(mm, index, num_records, t_to)
+            for start in xrange(first, last, chunk_records):
+                stop = min(start + chunk_records, last)
+                yield mm[start*RECORD.size:stop*RECORD.size]
+        finally:
+            mm.close()
+
+    def _read_index(self, name):
+        try:
+            with open(name + '.idx', 'rb') as index_file:
+                data = index_file.read()
+        except IOError:
+            data = ''
+        entries = [INDEX_ENTRY.unpack_from(data, offset) for offset in xrange(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+        return ([entry[0] for entry in entries], [entry[1] for entry in entries])
+
+    def _search(self, mm, index, num_records, timestamp):
+        """ The number of the first record with a time >= timestamp """
+        (times, numbers) = index
+        i = bisect.bisect_left(times, timestamp)
+        low = numbers[i-1] if i > 0 else 0
+        high = min(numbers[i], num_records) if i < len(numbers) else num_records
+        while low < high:
+            middle = (low + high) // 2
+            if RECORD.unpack_from(mm, middle * RECORD.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Print the pressure log of a gauge')
+    parser.add_argument('path', help='The log directory of the gauge.')
+    parser.add_argument('-s', '--seconds', type=float, default=60., help='How many seconds to show, counting back from now.')
+    args = parser.parse_args()
+
+    data = PressureLogReader(args.path).query(time.time() - args.seconds)
+    for i in xrange(0, len(data), 2):
+        print "%.3f %.4g mbar" % (data[i], data[i+1])
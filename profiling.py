@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+""" Profiling hooks for the parse pipeline which can be switched on at runtime.
+
+While stage timing is enabled, the ingest methods of each gauge are
+shadowed by timing wrappers set as instance attributes; disabling it
+deletes them again, so a gauge which is not profiled runs the unmodified
+code. The cProfile window works the same way: the profiler has to run in
+the thread that ingests the data, so the wrappers enable it there.
+
+Python 2 has no perf_counter_ns, the stages are timed with the most
+precise clock available (timeit.default_timer) in seconds. """
+
+import cProfile
+import pstats
+import signal
+import threading
+from timeit import default_timer as timer
+
+# the shadowed methods of the ITR objects, in the order they are called:
+itr_stages = ('check_message', 'parse_state', 'parse_pressure', 'fix_gauge_type')
+stages = ('queue', 'feed', 'parse_status') + itr_stages
+
+class StageTimer(object):
+    """ The number, total, minimum and maximum duration of a stage in seconds """
+    __slots__ = ('count', 'total', 'minimum', 'maximum')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if self.minimum is None or duration < self.minimum: self.minimum = duration
+        if self.maximum is None or duration > self.maximum: self.maximum = duration
+
+    def to_dict(self):
+        return dict(count=self.count, total=self.total, minimum=self.minimum, maximum=self.maximum,
+                    mean=self.total / self.count if self.count else None)
+
+def bound_method(itr, name):
+    """ The method `name` of the class of `itr`, ignoring instance attributes.
+        Looked up on each call, as fix_gauge_type() changes the class. """
+    cls = type(itr)
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass.__dict__[name].__get__(itr, cls)
+    raise AttributeError(name)
+
+class GaugeProfiler(object):
+    """ Stage timings and cProfile windows for the local ITR objects in the
+        dict `gauges` (by device name). Gauges of other processes are ignored. """
+    def __init__(self, gauges, dump_path='/tmp/leybold-gauges.prof'):
+        self.gauges = dict((device, itr) for (device, itr) in gauges.items() if hasattr(itr, 'synchronizer'))
+        self.dump_path = dump_path
+        self.timers = dict((device, dict((stage, StageTimer()) for stage in stages)) for device in self.gauges)
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.profiles = None # device -> (cProfile.Profile, lock) during a cProfile window
+        self.profile_timer = None
+
+    def enable(self):
+        with self.lock:
+            if self.enabled: return
+            self.enabled = True
+            for device in self.gauges:
+                self.install(device)
+
+    def disable(self):
+        with self.lock:
+            if not self.enabled: return
+            self.enabled = False
+            for device in self.gauges:
+                self.install(device)
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def reset(self):
+        for device in self.timers:
+            self.timers[device] = dict((stage, StageTimer()) for stage in stages)
+
+    def install(self, device):
+        """ Sets or removes the wrappers of a gauge according to the current settings """
+        itr = self.gauges[device]
+        synchronizer = itr.synchronizer
+        for stage in itr_stages:
+            itr.__dict__.pop(stage, None)
+        synchronizer.__dict__.pop('feed', None)
+        synchronizer.callback = itr.parse_status
+        if self.enabled:
+            for stage in itr_stages:
+                setattr(itr, stage, self.timed(device, stage, method_caller(itr, stage)))
+            synchronizer.callback = self.timed(device, 'parse_status', method_caller(itr, 'parse_status'))
+            synchronizer.feed = self.timed_feed(device, synchronizer.feed)
+        if self.profiles is not None:
+            synchronizer.feed = self.profiled_feed(device, synchronizer.feed)
+
+    def timed(self, device, stage, method):
+        timers = self.timers
+        def wrapper(*args):
+            start = timer()
+            try:
+                return method(*args)
+            finally:
+                timers[device][stage].add(timer() - start)
+        return wrapper
+
+    def timed_feed(self, device, feed):
+        itr = self.gauges[device]
+        timers = self.timers
+        def wrapper(data):
+            start = timer()
+            # the time the data waited in the in_queue of a SerialManager:
+            put_time = getattr(itr.in_queue, 'put_time', None)
+            if put_time is not None:
+                timers[device]['queue'].add(max(start - put_time, 0.))
+            try:
+                return feed(data)
+            finally:
+                timers[device]['feed'].add(timer() - start)
+        return wrapper
+
+    def profiled_feed(self, device, feed):
+        (profile, lock) = self.profiles[device]
+        def wrapper(data):
+            with lock:
+                return profile.runcall(feed, data)
+        return wrapper
+
+    def stats(self):
+        """ The stage timings of all gauges as a dict """
+        return dict((device, dict((stage, timer.to_dict()) for (stage, timer) in self.timers[device].items()))
+                    for device in self.timers)
+
+    def state(self):
+        return dict(enabled=self.enabled, cprofile_running=self.profiles is not None, gauges=self.stats())
+
+    def configure(self, enabled=None, reset=False, cprofile=None):
+        """ Switches the stage timing on or off, resets it and/or starts a
+            cProfile window of `cprofile` seconds. Returns False if the
+            window could not be started as another one is running. """
+        if enabled is not None:
+            if enabled:
+                self.enable()
+            else:
+                self.disable()
+        if reset:
+            self.reset()
+        if cprofile:
+            return self.run_cprofile(cprofile)
+        return True
+
+    def run_cprofile(self, seconds=10., path=None):
+        """ Profiles the ingest of all gauges with cProfile for `seconds`
+            and dumps the merged statistics to `path` (in the background).
+            Returns False if a window is running already. """
+        with self.lock:
+            if self.profiles is not None:
+                return False
+            self.profiles = dict((device, (cProfile.Profile(), threading.Lock())) for device in self.gauges)
+            for device in self.gauges:
+                self.install(device)
+            self.profile_timer = threading.Timer(seconds, self.finish_cprofile, args=(path or self.dump_path,))
+            self.profile_timer.daemon = True
+            self.profile_timer.start()
+        return True
+
+    def finish_cprofile(self, path):
+        with self.lock:
+            (profiles, self.profiles) = (self.profiles, None)
+            for device in self.gauges:
+                self.install(device)
+        stats = None
+        for (profile, lock) in profiles.values():
+            # wait for a running call:
+            with lock:
+                profile.create_stats()
+            if not profile.stats: continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is not None:
+            stats.dump_stats(path)
+
+def method_caller(obj, name):
+    return lambda *args: bound_method(obj, name)(*args)
+
+def install_signal_handlers(profiler, toggle_signal=signal.SIGUSR1, cprofile_signal=signal.SIGUSR2, seconds=10.):
+    """ `toggle_signal` switches the stage timing on and off, `cprofile_signal`
+        starts a cProfile window of `seconds` dumped to profiler.dump_path.
+        Has to be called from the main thread. """
+    signal.signal(toggle_signal, lambda signum, frame: profiler.toggle())
+    signal.signal(cprofile_signal, lambda signum, frame: profiler.run_cprofile(seconds))
@@ -3,36 +3,95 @@
 import serial
 import threading
 import time
-from Queue import Queue, Empty
+from Queue import Empty
+from instrumentation import TimedQueue
+from capture import CaptureWriter, capture_path
+
+def serial_settings(kwargs=dict()):
+    """ The settings for the RS232 interface of the gauges, updated by `kwargs`. """
+    settings = dict()
+    settings['baudrate'] = 9600
+    settings['bytesize'] = serial.EIGHTBITS
+    settings['parity'] = serial.PARITY_NONE
+    settings['stopbits'] = serial.STOPBITS_ONE
+    settings['timeout'] = 0
+    settings.update(kwargs)
+    return settings
 
 class SerialManager(threading.Thread):
     """ This class has been written by
         Philipp Klaus and can be found on
         https://gist.github.com/4039175 .  """
-    def __init__(self, device, kwargs=dict()):
-        settings = dict()
-        settings['baudrate'] = 9600
-        settings['bytesize'] = serial.EIGHTBITS
-        settings['parity'] = serial.PARITY_NONE
-        settings['stopbits'] = serial.STOPBITS_ONE
-        settings['timeout'] = 0
+    modes = ('poll', 'events')
+
+    def __init__(self, device, kwargs=dict(), mode='poll', capture_dir=None):
+        """ mode 'poll' checks the serial port and the out_queue every
+            0.5 ms, mode 'events' blocks on the serial port instead and
+            writes from a separate thread woken up by the out_queue.
+            With `capture_dir`, the received data is also recorded to a
+            capture file in that directory. """
+        if mode not in self.modes:
+            raise ValueError('unknown mode %s' % mode)
+        self.mode = mode
+        # in 'events' mode the timeout only defines how fast we notice close()
+        settings = serial_settings(dict(timeout = 0 if mode == 'poll' else 0.1))
         settings.update(kwargs)
         self._kwargs = settings
         self.ser = serial.Serial(device, **self._kwargs)
-        self.in_queue = Queue()
-        self.out_queue = Queue()
+        self.in_queue = TimedQueue()
+        self.out_queue = TimedQueue()
+        self.capture = CaptureWriter(capture_path(capture_dir, device), device) if capture_dir else None
         self.closing = False # A flag to indicate thread shutdown
         self.sleeptime = 0.0005
         threading.Thread.__init__(self)
 
     def run(self):
+        if self.mode == 'events':
+            self.run_events()
+        else:
+            self.run_polling()
+        if self.capture is not None:
+            self.capture.close()
+
+    def run_events(self):
+        writer = threading.Thread(target=self.write_from_queue)
+        writer.start()
+        while not self.closing:
+            in_data = self.ser.read(1)
+            if not in_data: continue
+            waiting = self.bytes_waiting()
+            if waiting: in_data += self.ser.read(waiting)
+            if self.capture is not None: self.capture.write(in_data)
+            self.in_queue.put(in_data)
+        self.out_queue.put(None)
+        writer.join()
+        self.ser.close()
+
+    def write_from_queue(self):
+        while True:
+            out_buffer = self.out_queue.get()
+            if out_buffer is None: break
+            self.ser.write(out_buffer)
+            self.out_queue.sent()
+
+    def bytes_waiting(self):
+        try:
+            return self.ser.in_waiting
+        except AttributeError:
+            # pyserial < 3.0
+            return self.ser.inWaiting()
+
+    def run_polling(self):
         while not self.closing:
             time.sleep(self.sleeptime)
             in_data = self.ser.read(9)
-            if in_data: self.in_queue.put(in_data)
+            if in_data:
+                if self.capture is not None: self.capture.write(in_data)
+                self.in_queue.put(in_data)
             try:
                 out_buffer = self.out_queue.get_nowait()
                 self.ser.write(out_buffer)
+                self.out_queue.sent()
             except Empty:
                 pass
         self.ser.close()
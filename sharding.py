@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+""" Spreads the acquisition of many gauges over several worker processes.
+
+Every worker runs a GaugeEventLoop for its share of the serial ports and
+publishes the state of each gauge into a block of shared memory. The
+parent process reads these blocks through SharedGauge objects which
+provide the read side of the ITR API. Commands travel to the workers
+through a multiprocessing.Queue. """
+
+import math
+import multiprocessing
+import os
+import threading
+import time
+from Queue import Empty
+from Leybold import ITR, ITR90, ITR200, GaugeState, NoDataError
+
+# layout of the shared state block of each gauge:
+state_fields = ('sequence', 'last_update', 'pressure', 'pressure_unit', 'emission_state',
+                'toggle_bit', 'version', 'sensor_type', 'error_code', 'currently_adjusting',
+                'frame_rate', 'readings_per_sample', 'history_count', 'history_head')
+STATE = dict((name, index) for (index, name) in enumerate(state_fields))
+HISTORY_START = len(state_fields)
+
+class StatePublisher(object):
+    """ Writes the state of an ITR into a shared array after each message (worker side).
+
+    The sequence number is odd while the block is being written, so
+    readers can detect and retry torn reads (a sequence lock). """
+    def __init__(self, block, history_size):
+        self.block = block
+        self.history_size = history_size
+        self.written = 0 # of the pressure history of the ITR, which may be decimated
+        # a worker which died while writing left the sequence odd:
+        if block[STATE['sequence']] % 2:
+            block[STATE['sequence']] += 1
+
+    def __call__(self, itr):
+        if itr.pressure is None: return
+        block = self.block
+        sequence = block[STATE['sequence']] + 1
+        block[STATE['sequence']] = sequence
+        try:
+            block[STATE['last_update']] = itr.last_update
+            block[STATE['pressure']] = itr.pressure
+            block[STATE['pressure_unit']] = itr.pressure_unit
+            block[STATE['emission_state']] = itr.emission_state
+            block[STATE['toggle_bit']] = itr.toggle_bit
+            block[STATE['version']] = itr.version
+            for (code, sensor_type) in itr.sensor_types.items():
+                if sensor_type is itr.sensor_type: block[STATE['sensor_type']] = code
+            block[STATE['error_code']] = getattr(itr, 'error_code', 0)
+            block[STATE['currently_adjusting']] = getattr(itr, 'currently_adjusting', False)
+            block[STATE['frame_rate']] = itr.get_frame_rate() or 0.
+            history = itr.pressure_history
+            block[STATE['readings_per_sample']] = history.readings_per_sample
+            # the history is empty after clear_history():
+            if len(history) and history.written != self.written:
+                self.written = history.written
+                head = int(block[STATE['history_head']])
+                block[HISTORY_START + head] = history.latest()[1]
+                block[STATE['history_head']] = (head + 1) % self.history_size
+            # follows clear_history() of the ITR:
+            block[STATE['history_count']] = min(len(itr.pressure_history), self.history_size)
+        finally:
+            block[STATE['sequence']] = sequence + 1
+
+class SharedGauge(object):
+    """ Read access to the state of a gauge running in a worker process (parent side). """
+    commands = ('send_message', 'set_unit_mbar', 'set_unit_Torr', 'set_unit_Pa',
+                'permanently_store_unit', 'set_degas', 'clear_history', 'clear_buffers')
+    sensor_types = {10: ITR90, 12: ITR200}
+    # a reader gives up after about 0.1 s of writes in progress:
+    max_retries = 1000
+    retry_interval = 0.0001
+
+    def __init__(self, device_name, block, history_size, supervisor):
+        self.device_name = device_name
+        self.block = block
+        self.history_size = history_size
+        self.supervisor = supervisor
+
+    def read_state(self, history=0):
+        """ Returns a consistent copy of the state block including
+            the `history` newest pressure values. Raises a NoDataError if
+            the block stays inconsistent, e.g. while a worker hangs. """
+        block = self.block
+        for retry in xrange(self.max_retries):
+            sequence = block[STATE['sequence']]
+            if sequence % 2:
+                time.sleep(self.retry_interval)
+                continue
+            state = block[:HISTORY_START]
+            values = []
+            count = min(int(state[STATE['history_count']]), history)
+            if count:
+                head = int(state[STATE['history_head']])
+                start = HISTORY_START + head - count
+                if start >= HISTORY_START:
+                    values = block[start:HISTORY_START+head]
+                else:
+                    values = block[start+self.history_size:HISTORY_START+self.history_size] + block[HISTORY_START:HISTORY_START+head]
+            if block[STATE['sequence']] == sequence:
+                return (state, values)
+        raise NoDataError('the state of %s is not consistent after %d attempts' % (self.device_name, self.max_retries))
+
+    def __getattr__(self, name):
+        if name in self.commands:
+            return lambda *args: self.supervisor.send_command(self.device_name, name, args)
+        if name not in STATE:
+            raise AttributeError(name)
+        (state, values) = self.read_state()
+        if not state[STATE['sequence']]:
+            return None
+        value = state[STATE[name]]
+        if name in ('pressure_unit', 'emission_state', 'error_code'):
+            return int(value)
+        if name in ('toggle_bit', 'currently_adjusting'):
+            return bool(value)
+        return value
+
+    @property
+    def sensor_type(self):
+        (state, values) = self.read_state()
+        return self.sensor_types.get(int(state[STATE['sensor_type']]))
+
+    @property
+    def state(self):
+        """ A consistent GaugeState like ITR.state """
+        (state, values) = self.read_state()
+        if not state[STATE['sequence']]:
+            return GaugeState.empty
+        value = lambda name: state[STATE[name]]
+        return GaugeState(int(value('sequence')) // 2, value('last_update'), value('pressure'),
+            int(value('pressure_unit')), int(value('emission_state')), bool(value('toggle_bit')), value('version'),
+            self.sensor_types.get(int(value('sensor_type'))), int(value('error_code')), bool(value('currently_adjusting')))
+
+    def get_frame_rate(self):
+        return self.frame_rate or None
+
+    def get_average_pressure(self, num_samples=60):
+        """ Like ITR.get_average_pressure(), `num_samples` counts readings. """
+        num_samples = max(int(round(num_samples / (self.readings_per_sample or 1))), 1)
+        (state, values) = self.read_state(history=num_samples)
+        if not values:
+            raise NoDataError('cannot calculate an average pressure without any values.')
+        return math.fsum(values) / len(values)
+
+    def __str__(self):
+        sensor_type = self.sensor_type
+        return sensor_type.__name__ if sensor_type else ITR.__name__
+
+def worker_main(device_names, blocks, history_size, command_queue, itr_kwargs, listener_factories=()):
+    """ The main function of a worker process. """
+    from eventloop import GaugeEventLoop
+    loop = GaugeEventLoop(device_names, **itr_kwargs)
+    listeners = []
+    for device_name in device_names:
+        loop.gauges[device_name].add_listener(StatePublisher(blocks[device_name], history_size))
+        for factory in listener_factories:
+            listener = factory(device_name)
+            loop.gauges[device_name].add_listener(listener, decimated=True)
+            listeners.append(listener)
+    loop.daemon = True
+    loop.start()
+    parent = os.getppid()
+    while loop.is_alive() and os.getppid() == parent:
+        try:
+            (device_name, name, args) = command_queue.get(timeout=0.5)
+        except Empty:
+            continue
+        if device_name is None: break
+        try:
+            getattr(loop.gauges[device_name], name)(*args)
+        except AttributeError, e:
+            # e.g. a command the type of the gauge doesn't support
+            if itr_kwargs.get('debug'): print "%s: %s" % (device_name, e)
+    loop.close()
+    loop.join()
+    for listener in listeners:
+        if hasattr(listener, 'close'): listener.close()
+
+class GaugeSupervisor(threading.Thread):
+    """ Distributes `device_names` over `num_workers` processes and restarts
+        workers which died. The gauges are accessible via self.gauges. """
+    check_interval = 1.
+
+    def __init__(self, device_names, num_workers=None, history_size=1000, listener_factories=(), **itr_kwargs):
+        """ Each of the `listener_factories` is called with the device name in
+            the worker process and returns a listener to add to the gauge. """
+        num_workers = min(num_workers or multiprocessing.cpu_count(), len(device_names)) or 1
+        self.history_size = history_size
+        self.listener_factories = listener_factories
+        self.itr_kwargs = itr_kwargs
+        self.itr_kwargs['history_size'] = history_size
+        self.shards = [device_names[i::num_workers] for i in range(num_workers)]
+        self.blocks = dict()
+        self.gauges = dict()
+        for device_name in device_names:
+            self.blocks[device_name] = multiprocessing.RawArray('d', HISTORY_START + history_size)
+            self.gauges[device_name] = SharedGauge(device_name, self.blocks[device_name], history_size, self)
+        self.command_queues = [multiprocessing.Queue() for shard in self.shards]
+        self.workers = [None] * num_workers
+        self.restarts = 0
+        self.closing = False # A flag to indicate thread shutdown
+        threading.Thread.__init__(self)
+
+    def start_worker(self, index):
+        shard = self.shards[index]
+        blocks = dict((device_name, self.blocks[device_name]) for device_name in shard)
+        worker = multiprocessing.Process(target=worker_main, name='gauges-worker-%d' % index,
+                     args=(shard, blocks, self.history_size, self.command_queues[index], self.itr_kwargs, self.listener_factories))
+        worker.daemon = True
+        worker.start()
+        self.workers[index] = worker
+
+    def run(self):
+        for index in range(len(self.shards)):
+            self.start_worker(index)
+        while not self.closing:
+            time.sleep(self.check_interval)
+            for (index, worker) in enumerate(self.workers):
+                if not worker.is_alive() and not self.closing:
+                    self.restarts += 1
+                    self.start_worker(index)
+        for command_queue in self.command_queues:
+            command_queue.put((None, None, None))
+        for worker in self.workers:
+            worker.join(2.)
+            if worker.is_alive(): worker.terminate()
+
+    def send_command(self, device_name, name, args):
+        for (index, shard) in enumerate(self.shards):
+            if device_name in shard:
+                self.command_queues[index].put((device_name, name, args))
+
+    def close(self):
+        self.closing = True
+
+if __name__ == "__main__":
+    import sys
+
+    supervisor = GaugeSupervisor(sys.argv[1:], debug = True)
+    supervisor.start()
+    try:
+        while True:
+            time.sleep(1.)
+            for device in sorted(supervisor.gauges):
+                gauge = supervisor.gauges[device]
+                if gauge.pressure is None: continue
+                print "%s: %.3g %s (%s)" % (device, gauge.get_average_pressure(), ITR.pressure_units[gauge.pressure_unit], gauge)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.close()
+    supervisor.join()
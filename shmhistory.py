@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+""" A pressure history in shared memory, readable by any local process.
+
+The acquisition process writes the (time, pressure) samples of a gauge
+into a memory mapped file (in /dev/shm by default). Readers map the
+same file and read it without locks and without talking to the writer.
+
+File layout (all little-endian):
+
+    header (64 bytes):
+        8s  magic 'LVGHIST1'
+        I   header size
+        I   record size
+        Q   capacity (number of records)
+        Q   write sequence: number of records written so far
+        32s device name
+    records (capacity * 16 bytes):
+        d   time
+        d   pressure in mbar, whatever unit the gauge is set to
+
+The record with sequence number s is stored in slot s % capacity. The
+writer fills the slot first and increments the write sequence afterwards.
+A reader copies the records it wants and reads the write sequence again:
+records with a sequence number up to (write sequence - capacity) may have
+been overwritten in the meantime and are dropped. Readers wanting to avoid
+the copy can map the records directly, e.g. with numpy.frombuffer(reader.mm),
+and apply the same check afterwards. """
+
+import mmap
+import os
+import struct
+from array import array
+from iotools import to_little_endian, device_file_name
+from Leybold import HistoryWriter, NoDataError
+
+MAGIC = 'LVGHIST1'
+HEADER = struct.Struct('<8sIIQQ32s')
+HEADER_SIZE = 64
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 24
+RECORD = struct.Struct('<dd')
+
+def shared_history_path(directory, device_name):
+    """ The file used for the gauge `device_name`, e.g. /dev/shm/dev_ttyUSB0.hist """
+    return os.path.join(directory, device_file_name(device_name) + '.hist')
+
+class SharedHistoryWriter(HistoryWriter):
+    """ Creates the shared history file and appends samples to it.
+
+    Instances can be registered as ITR listeners with
+    itr.add_listener(writer, decimated=True). """
+    def __init__(self, path, capacity=100000, device_name=''):
+        self.path = path
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.mm, 0, MAGIC, HEADER_SIZE, RECORD.size, capacity, 0, device_name)
+        self.sequence = 0
+
+    def append(self, timestamp, value):
+        slot = self.sequence % self.capacity
+        RECORD.pack_into(self.mm, HEADER_SIZE + slot * RECORD.size, timestamp, value)
+        self.sequence += 1
+        SEQUENCE.pack_into(self.mm, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        self.mm.close()
+        os.unlink(self.path)
+
+class SharedHistoryReader(object):
+    """ Read access to a shared history file written by another process. """
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        (magic, header_size, record_size, capacity, sequence, device_name) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError('%s is not a shared pressure history file' % path)
+        self.header_size = header_size
+        self.capacity = capacity
+        self.device_name = device_name.rstrip('\0')
+
+    @property
+    def sequence(self):
+        """ The number of records written so far. """
+        return SEQUENCE.unpack_from(self.mm, SEQUENCE_OFFSET)[0]
+
+    def __len__(self):
+        return min(self.sequence, self.capacity)
+
+    def read(self, num_samples=None):
+        """ Returns the last `num_samples` records as an array('d')
+            of interleaved times and pressures, oldest first. """
+        end = self.sequence
+        start = max(end - self.capacity, 0)
+        if num_samples is not None:
+            start = max(start, end - num_samples)
+        data = array('d')
+        for (first, last) in self._slot_ranges(start, end):
+            data.fromstring(self.mm[self.header_size + first * RECORD.size:self.header_size + last * RECORD.size])
+        # drop what the writer may have overwritten while we were copying:
+        overwritten = self.sequence - self.capacity + 1 - start
+        if overwritten > 0:
+            del data[:2*overwritten]
+        return to_little_endian(data)
+
+    def _slot_ranges(self, start, end):
+        if start >= end:
+            return []
+        first, last = start % self.capacity, end % self.capacity
+        if first < last:
+            return [(first, last)]
+        return [(first, self.capacity), (0, last)]
+
+    def latest(self):
+        data = self.read(1)
+        if not data:
+            raise NoDataError('the shared history %s is empty.' % self.path)
+        return (data[0], data[1])
+
+    def mean(self, num_samples):
+        values = self.read(num_samples)[1::2]
+        if not values:
+            raise NoDataError('cannot calculate an average pressure without any values.')
+        return sum(values) / len(values)
+
+    def close(self):
+        self.mm.close()
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    readers = [SharedHistoryReader(path) for path in sys.argv[1:]]
+    while True:
+        for reader in readers:
+            try:
+                (timestamp, pressure) = reader.latest()
+                print "%s: %.3g mbar (%.1f s ago, average of the last 60 samples: %.3g mbar)" % (reader.device_name, pressure, time.time() - timestamp, reader.mean(60))
+            except NoDataError:
+                print "%s: no data" % reader.device_name
+        time.sleep(1.)
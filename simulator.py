@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+""" Simulates ITR90 / ITR200 gauges on pseudo terminals.
+
+Each SimulatedGauge sends protocol-correct 9 byte frames with a pressure
+following a configurable curve and answers the commands sent by
+ITR.send_message() (unit switching and degas). Faults can be injected
+with a given probability per frame: corrupted checksums, dropped bytes,
+bursts (frames held back and sent at once) and stalls (no frames for a
+while). A single thread serves all gauges with select.poll(), so
+hundreds of them can run on one machine. Unix only. """
+
+import errno
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+from iotools import set_nonblocking
+from Leybold import ITR
+
+# conversion of mbar to the pressure units of the gauges:
+unit_factors = {0: 1., 1: 0.750062, 2: 100.}
+
+def constant(pressure):
+    return lambda t: pressure
+
+def pumpdown(start=1000., end=1e-7, tau=60.):
+    """ Falls exponentially (in log space) from `start` to `end` mbar with the time constant `tau` """
+    (log_start, log_end) = (math.log10(start), math.log10(end))
+    return lambda t: 10 ** (log_end + (log_start - log_end) * math.exp(-t / tau))
+
+def oscillation(center=1e-5, decades=1., period=60.):
+    """ Oscillates by +-`decades` around `center` mbar """
+    log_center = math.log10(center)
+    return lambda t: 10 ** (log_center + decades * math.sin(2 * math.pi * t / period))
+
+def steps(*pressures, **kwargs):
+    """ Jumps through `pressures` every `duration` seconds """
+    duration = kwargs.get('duration', 10.)
+    return lambda t: pressures[int(t / duration) % len(pressures)]
+
+curves = dict(constant=constant, pumpdown=pumpdown, oscillation=oscillation, steps=steps)
+
+def parse_curve(spec):
+    """ Creates a curve from a string like 'pumpdown:1000,1e-7,60' """
+    (name, sep, args) = spec.partition(':')
+    return curves[name](*[float(arg) for arg in args.split(',') if arg])
+
+class Faults(object):
+    """ The probability per frame of each fault """
+    def __init__(self, corrupt=0., drop=0., burst=0., stall=0., burst_frames=20, stall_time=1., seed=None):
+        self.corrupt = corrupt
+        self.drop = drop
+        self.burst = burst
+        self.stall = stall
+        self.burst_frames = burst_frames
+        self.stall_time = stall_time
+        self.random = random.Random(seed)
+
+class SimulatedGauge(object):
+    """ The state of a simulated gauge and the frames it sends. """
+    def __init__(self, sensor_type=10, curve=None, pressure_unit=0, version=1.4, faults=None):
+        self.sensor_type = sensor_type
+        self.curve = curve or constant(1000.)
+        self.pressure_unit = pressure_unit
+        self.version = version
+        self.faults = faults or Faults()
+        self.emission_state = 1
+        self.error_code = 0
+        self.toggle_bit = False
+        self.start = time.time()
+        self.held_back = [] # frames of a burst
+        self.burst_left = 0
+        self.stalled_until = 0.
+        self.commands = 0
+
+    def pressure(self, now):
+        """ The pressure in the current unit """
+        return self.curve(now - self.start) * unit_factors[self.pressure_unit]
+
+    def counts(self, pressure):
+        counts = int(round(4000. * (math.log10(pressure) + ITR.pressure_offsets[self.pressure_unit])))
+        return min(max(counts, 0), 0xffff)
+
+    def frame(self, now):
+        """ A valid frame with the current state """
+        counts = self.counts(self.pressure(now))
+        status = self.emission_state | self.toggle_bit << 3 | self.pressure_unit << 4
+        body = [0x5, status, self.error_code << 4, counts >> 8, counts & 0xff,
+                int(round(self.version * 20)), self.sensor_type]
+        return chr(0x7) + ''.join(chr(byte) for byte in body) + chr(sum(body) % 256)
+
+    def output(self, now):
+        """ The bytes to send at this tick, with the faults applied """
+        faults = self.faults
+        rnd = faults.random
+        if now < self.stalled_until:
+            return ''
+        if faults.stall and rnd.random() < faults.stall:
+            self.stalled_until = now + faults.stall_time
+            return ''
+        frame = self.frame(now)
+        if faults.corrupt and rnd.random() < faults.corrupt:
+            frame = frame[:8] + chr((ord(frame[8]) + rnd.randint(1, 255)) % 256)
+        if faults.drop and rnd.random() < faults.drop:
+            position = rnd.randrange(len(frame))
+            frame = frame[:position] + frame[position + rnd.randint(1, len(frame) - position):]
+        if self.burst_left or (faults.burst and rnd.random() < faults.burst):
+            if not self.burst_left: self.burst_left = faults.burst_frames
+            self.held_back.append(frame)
+            self.burst_left -= 1
+            if self.burst_left: return ''
+            (frame, self.held_back) = (''.join(self.held_back), [])
+        return frame
+
+    def receive(self, message):
+        """ Handles a 5 byte command like those from ITR.send_message() """
+        if len(message) != 5 or message[0] != '\x03' or ord(message[4]) != ITR.checksum256(message[1:4]):
+            return
+        self.commands += 1
+        command = tuple(ord(byte) for byte in message[1:4])
+        if command[:2] == (16, 62) and command[2] in unit_factors:
+            self.pressure_unit = command[2]
+        elif command == (16, 93, 148) and self.sensor_type == 10:
+            self.emission_state = 3
+        elif command == (16, 93, 105) and self.emission_state == 3:
+            self.emission_state = 1
+        # (32, 62, 62) stores the unit permanently, nothing to do here
+
+class GaugeSimulator(threading.Thread):
+    """ Serves `gauges` (SimulatedGauge objects) on pseudo terminals, sending
+        a frame every `interval` seconds. The device names of the gauges
+        are in self.device_names. """
+    def __init__(self, gauges, interval=0.016):
+        self.gauges = gauges
+        self.interval = interval
+        self.ptys = []
+        self.device_names = []
+        for gauge in gauges:
+            (master, slave) = os.openpty()
+            # no echo and no translation of the binary data:
+            tty.setraw(slave)
+            set_nonblocking(master)
+            self.ptys.append((master, slave))
+            self.device_names.append(os.ttyname(slave))
+        self.inputs = dict((master, '') for (master, slave) in self.ptys)
+        self.dropped = 0 # bytes nobody read
+        self.closing = False # A flag to indicate thread shutdown
+        threading.Thread.__init__(self)
+
+    def run(self):
+        poller = select.poll()
+        by_fd = dict()
+        for ((master, slave), gauge) in zip(self.ptys, self.gauges):
+            poller.register(master, select.POLLIN)
+            by_fd[master] = gauge
+        next_tick = time.time()
+        try:
+            while not self.closing:
+                timeout = max(0., next_tick - time.time())
+                for (fd, event) in poller.poll(timeout * 1000.):
+                    if event & select.POLLIN:
+                        self.read_commands(fd, by_fd[fd])
+                now = time.time()
+                if now < next_tick: continue
+                for ((master, slave), gauge) in zip(self.ptys, self.gauges):
+                    self.write(master, gauge.output(now))
+                next_tick += self.interval
+                if next_tick < now:
+                    # we are too slow, don't try to catch up
+                    next_tick = now + self.interval
+        finally:
+            for (master, slave) in self.ptys:
+                os.close(master)
+                os.close(slave)
+
+    def write(self, fd, data):
+        if not data: return
+        try:
+            written = os.write(fd, data)
+        except OSError, e:
+            if e.errno != errno.EAGAIN: raise
+            written = 0
+        self.dropped += len(data) - written
+
+    def read_commands(self, fd, gauge):
+        try:
+            data = self.inputs[fd] + os.read(fd, 4096)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EIO): return
+            raise
+        start = data.find('\x03')
+        while start >= 0 and len(data) - start >= 5:
+            gauge.receive(data[start:start+5])
+            start = data.find('\x03', start + 5)
+        self.inputs[fd] = data[start:] if start >= 0 else ''
+
+    def close(self):
+        self.closing = True
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Simulate Leybold ITR90 / ITR200 gauges on pseudo terminals')
+    parser.add_argument('-n', '--gauges', type=int, default=1, help='The number of simulated gauges.')
+    parser.add_argument('-i', '--interval', type=float, default=0.016, help='Seconds between two frames.')
+    parser.add_argument('-T', '--sensor-types', type=int, nargs='+', choices=[10, 12], default=[10], help='The sensor types of the gauges (used in turn): 10 = ITR90, 12 = ITR200.')
+    parser.add_argument('-u', '--unit', choices=['mbar', 'Torr', 'Pa'], default='mbar', help='The initial pressure unit.')
+    parser.add_argument('-c', '--curve', default='pumpdown:1000,1e-7,60', help='The pressure in mbar over time: ' + ', '.join(sorted(curves)) + ' with arguments, e.g. oscillation:1e-5,1,60.')
+    parser.add_argument('--corrupt', type=float, default=0., help='The probability of a corrupted checksum per frame.')
+    parser.add_argument('--drop', type=float, default=0., help='The probability of dropped bytes per frame.')
+    parser.add_argument('--burst', type=float, default=0., help='The probability of a burst (20 frames held back) per frame.')
+    parser.add_argument('--stall', type=float, default=0., help='The probability of a 1 s stall per frame.')
+    parser.add_argument('--seed', type=int, help='The seed of the fault generator.')
+    parser.add_argument('-o', '--output', metavar='FILE', help='Write the device names to FILE, one per line.')
+    args = parser.parse_args()
+
+    unit = dict((name, code) for (code, name) in ITR.pressure_units.items())[args.unit]
+    gauges = []
+    for i in range(args.gauges):
+        faults = Faults(args.corrupt, args.drop, args.burst, args.stall, seed=None if args.seed is None else args.seed + i)
+        gauges.append(SimulatedGauge(args.sensor_types[i % len(args.sensor_types)], parse_curve(args.curve), unit, faults=faults))
+    simulator = GaugeSimulator(gauges, args.interval)
+    print ' '.join(simulator.device_names)
+    sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write('\n'.join(simulator.device_names) + '\n')
+    simulator.start()
+    try:
+        while simulator.is_alive():
+            time.sleep(1.)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+    simulator.join()
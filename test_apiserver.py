@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+""" Calls the routes of the API server as a WSGI application, with the
+gauges simulated on pseudo terminals (Unix only). """
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from array import array
+from StringIO import StringIO
+from wsgiref.util import setup_testing_defaults
+from simulator import GaugeSimulator, SimulatedGauge, constant
+from apiserver import api, LeyboldGaugesBottlePlugin
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def call(path, headers={}):
+    """ Returns the status code, the headers (in lower case) and the body of a GET request """
+    environ = dict(REQUEST_METHOD='GET')
+    (environ['PATH_INFO'], sep, environ['QUERY_STRING']) = path.partition('?')
+    environ['wsgi.input'] = StringIO('')
+    for (name, value) in headers.items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    setup_testing_defaults(environ)
+    started = []
+    body = ''.join(api(environ, lambda status, headers, exc_info=None: started.append((status, headers))))
+    (status, headers) = started[0]
+    return (int(status.split()[0]), dict((name.lower(), value) for (name, value) in headers), body)
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'the simulator needs pseudo terminals')
+class ApiServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.simulated = [SimulatedGauge(10, constant(1e-3)), SimulatedGauge(12, constant(2e-6))]
+        cls.simulator = GaugeSimulator(cls.simulated, 0.005)
+        cls.simulator.start()
+        # names without slashes for the URLs:
+        cls.directory = tempfile.mkdtemp(prefix='test_apiserver')
+        cls.names = ['gauge0', 'gauge1']
+        for (name, device_name) in zip(cls.names, cls.simulator.device_names):
+            os.symlink(device_name, os.path.join(cls.directory, name))
+        cwd = os.getcwd()
+        os.chdir(cls.directory)
+        try:
+            cls.plugin = LeyboldGaugesBottlePlugin(cls.names, snapshot_interval=0.02, engine='eventloop', debug=False)
+        finally:
+            os.chdir(cwd)
+        api.install(cls.plugin)
+        gauges = [cls.plugin.devices[name]['ITR'] for name in cls.names]
+        deadline = time.time() + 10.
+        while not all(gauge.state.sequence > 100 for gauge in gauges) and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.1) # a snapshot of full averages
+
+    @classmethod
+    def tearDownClass(cls):
+        api.uninstall(cls.plugin)
+        cls.simulator.close()
+        cls.simulator.join()
+        shutil.rmtree(cls.directory)
+
+    def test_pressure(self):
+        (status, headers, body) = call('/pressure/all')
+        self.assertEqual(status, 200)
+        pressures = json.loads(body)
+        self.assertAlmostEqual(pressures['gauge0']['pressure'] / 1e-3, 1., places=3)
+        self.assertAlmostEqual(pressures['gauge1']['pressure'] / 2e-6, 1., places=3)
+        self.assertEqual(call('/pressure/nonexistent')[0], 504)
+
+    def test_etag(self):
+        for path in ('/pressure/all', '/pressure/gauge0'):
+            (status, headers, body) = call(path)
+            etag = headers['etag']
+            # the pressures are constant, so is the ETag:
+            (status, headers, body) = call(path, {'If-None-Match': etag})
+            self.assertEqual((status, headers['etag'], body), (304, etag, ''))
+            (status, headers, body) = call(path, {'If-None-Match': '"other"'})
+            self.assertEqual(status, 200)
+            self.assertTrue(json.loads(body))
+
+    def test_etag_changes_with_the_pressure(self):
+        etag = call('/pressure/gauge1')[1]['etag']
+        self.simulated[1].curve = constant(4e-6)
+        try:
+            deadline = time.time() + 5.
+            while call('/pressure/gauge1', {'If-None-Match': etag})[0] == 304:
+                self.assertTrue(time.time() < deadline, 'the ETag did not change')
+                time.sleep(0.02)
+            (status, headers, body) = call('/pressure/gauge1', {'If-None-Match': etag})
+            self.assertEqual(status, 200)
+            self.assertNotEqual(headers['etag'], etag)
+        finally:
+            self.simulated[1].curve = constant(2e-6)
+            time.sleep(0.5) # until the averages are back
+
+    def test_history_formats(self):
+        # a range of 50 samples, which stay in the history during the test:
+        held = json.loads(call('/history/gauge0')[2])['time']
+        query = 'from=%r&to=%r' % (held[-100], held[-50])
+        (status, headers, body) = call('/history/gauge0?format=json&' + query)
+        self.assertEqual(status, 200)
+        history = json.loads(body)
+        self.assertEqual(history['pressure_unit'], 'mbar')
+        times = history['time']
+        self.assertEqual(times, held[-100:-50])
+        for pressure in history['pressure']:
+            self.assertAlmostEqual(pressure / 1e-3, 1., places=3)
+        # the same samples as little-endian doubles:
+        (status, headers, body) = call('/history/gauge0?format=f64&' + query)
+        self.assertEqual((status, headers['x-num-points'], headers['x-pressure-unit']), (200, str(len(times)), 'mbar'))
+        data = array('d', body)
+        if sys.byteorder != 'little': data.byteswap()
+        self.assertEqual((data[0::2].tolist(), data[1::2].tolist()), (times, history['pressure']))
+        # and as a .npy file:
+        (status, headers, npy) = call('/history/gauge0?format=npy&' + query)
+        self.assertTrue(npy.startswith('\x93NUMPY\x01\x00'))
+        self.assertEqual(npy[-len(body):], body)
+        if np is not None:
+            records = np.load(StringIO(npy))
+            self.assertEqual((records['time'].tolist(), records['pressure'].tolist()), (times, history['pressure']))
+
+    def test_history_max_points(self):
+        (status, headers, body) = call('/history/gauge1?max_points=10')
+        history = json.loads(body)
+        self.assertTrue(5 <= len(history['time']) <= 10)
+        (status, headers, body) = call('/history/gauge1?format=f64&max_points=10')
+        self.assertEqual(len(body), 16 * int(headers['x-num-points']))
+
+    def test_history_errors(self):
+        self.assertEqual(call('/history/gauge0?format=csv')[0], 400)
+        # only a gauge decimated into buckets has other statistics:
+        self.assertEqual(call('/history/gauge0?statistic=max')[0], 400)
+        self.assertEqual(call('/history/nonexistent')[0], 504)
+
+    def test_metrics(self):
+        (status, headers, body) = call('/metrics')
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['content-type'].startswith('text/plain; version=0.0.4'))
+        samples = dict()
+        types = dict()
+        for line in body.splitlines():
+            if line.startswith('# TYPE '):
+                (name, kind) = line.split()[2:]
+                types[name] = kind
+            elif not line.startswith('#'):
+                (name, value) = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        self.assertEqual(types['leybold_frames_total'], 'counter')
+        self.assertEqual(types['leybold_parse_latency_seconds'], 'histogram')
+        for name in self.names:
+            frames = samples['leybold_frames_total{device="%s"}' % name]
+            self.assertTrue(frames > 100)
+            self.assertTrue(samples['leybold_bytes_received_total{device="%s"}' % name] >= 9 * frames)
+            self.assertEqual(samples['leybold_checksum_errors_total{device="%s"}' % name], 0)
+            # the frames counted before the histogram was rendered (but one still being parsed):
+            count = samples['leybold_parse_latency_seconds_count{device="%s"}' % name]
+            self.assertTrue(count >= frames - 1)
+            # a scrape may see an observation in a bucket but not yet in the count:
+            self.assertTrue(0 <= samples['leybold_parse_latency_seconds_bucket{device="%s",le="+Inf"}' % name] - count <= 1)
+
+if __name__ == "__main__":
+    unittest.main()
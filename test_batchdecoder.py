@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+""" Compares the frames found and decoded by the batch decoder with the
+streaming FrameSynchronizer and ITR.parse_status(). """
+
+import unittest
+from sampledata import sample_itr90
+from Leybold import ITR
+from test_framesync import noisy_stream, synchronize
+
+try:
+    import numpy as np
+    from batchdecoder import find_frames, decode_frames
+except ImportError:
+    np = None
+
+@unittest.skipIf(np is None, 'the batch decoder requires NumPy')
+class BatchDecoderTest(unittest.TestCase):
+
+    def test_find_frames_matches_streaming(self):
+        for seed in range(20):
+            data = noisy_stream(seed)
+            offsets = find_frames(np.frombuffer(data, dtype=np.uint8))
+            self.assertEqual([data[offset:offset+9] for offset in offsets], synchronize([data])[0], 'seed %d' % seed)
+
+    def test_truncated_frame(self):
+        frame = ''.join(sample_itr90)[5:14]
+        # the header of the truncated frame starts a candidate overlapping the next frame:
+        data = frame[:5] + frame + frame
+        streamed = synchronize([data])[0]
+        offsets = find_frames(np.frombuffer(data, dtype=np.uint8))
+        self.assertEqual([data[offset:offset+9] for offset in offsets], streamed)
+
+    def test_decode_frames_matches_parse_status(self):
+        data = noisy_stream(1)
+        itr = ITR(None, None)
+        pressures = []
+        itr.add_listener(lambda itr: pressures.append((itr.pressure, itr.pressure_unit)))
+        itr.synchronizer.feed(data)
+        frames = decode_frames(data)
+        self.assertEqual(len(frames), len(pressures))
+        for (frame, (pressure, pressure_unit)) in zip(frames, pressures):
+            self.assertAlmostEqual(frame['pressure'] / pressure, 1.)
+            self.assertEqual(frame['pressure_unit'], pressure_unit)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+""" Writes capture files and replays them into an ITR object. """
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from Queue import Queue
+from capture import CaptureWriter, CaptureReader, capture_path, replay, MAX_LENGTH, MAX_DELTA
+from simulator import SimulatedGauge, constant
+from Leybold import ITR
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_capture')
+        self.path = os.path.join(self.directory, 'gauge.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, chunks, device_name='/dev/ttyUSB0'):
+        """ Records the (seconds since the start, data) `chunks` """
+        writer = CaptureWriter(self.path, device_name)
+        for (offset, data) in chunks:
+            writer.write(data, writer.start_monotonic + offset)
+        writer.close()
+
+    def test_path(self):
+        path = capture_path(self.directory, '/dev/ttyUSB0')
+        self.assertEqual(os.path.dirname(path), self.directory)
+        self.assertTrue(os.path.basename(path).startswith('dev_ttyUSB0-'))
+        self.assertTrue(path.endswith('.cap'))
+
+    def test_round_trip(self):
+        chunks = [(0., 'a'), (0.016, 'bcdefghij'), (0.5, 'k' * 100), (0.500001, 'l')]
+        self.write(chunks)
+        reader = CaptureReader(self.path)
+        self.assertEqual(reader.device_name, '/dev/ttyUSB0')
+        self.assertTrue(abs(reader.start_time - time.time()) < 10.)
+        recorded = list(reader)
+        self.assertEqual([data for (offset, data) in recorded], [data for (offset, data) in chunks])
+        for ((offset, data), (expected, expected_data)) in zip(recorded, chunks):
+            self.assertAlmostEqual(offset, expected, places=6)
+        self.assertAlmostEqual(reader.duration(), 0.500001, places=6)
+        reader.close()
+
+    def test_long_chunk_and_pause(self):
+        long_chunk = ''.join(chr(i % 256) for i in xrange(MAX_LENGTH * 2 + 10))
+        pause = MAX_DELTA * 1e-6 * 2.5
+        self.write([(1., long_chunk), (pause, 'x')])
+        reader = CaptureReader(self.path)
+        recorded = list(reader)
+        # split into records of at most MAX_LENGTH bytes, all at the time of the chunk:
+        self.assertEqual([len(data) for (offset, data) in recorded], [MAX_LENGTH, MAX_LENGTH, 10, 1])
+        self.assertEqual(''.join(data for (offset, data) in recorded[:3]), long_chunk)
+        self.assertEqual([round(offset, 6) for (offset, data) in recorded[:3]], [1.] * 3)
+        self.assertAlmostEqual(recorded[3][0], pause, places=5) # rounded to microseconds
+        reader.close()
+
+    def test_truncated_capture(self):
+        self.write([(0., 'abc'), (0.1, 'defgh')])
+        with open(self.path, 'r+b') as capture:
+            capture.truncate(os.path.getsize(self.path) - 2)
+        reader = CaptureReader(self.path)
+        self.assertEqual([data for (offset, data) in reader], ['abc'])
+        reader.close()
+
+    def test_replay(self):
+        gauge = SimulatedGauge(12, constant(2e-6))
+        frames = [(i * 0.016, gauge.frame(0)) for i in xrange(50)]
+        # a frame split over two chunks and line noise:
+        frames[10:11] = [(0.16, frames[10][1][:4]), (0.161, frames[10][1][4:])]
+        frames.insert(20, (0.3, '\x07\x05\x00'))
+        self.write(frames)
+        itr = ITR(None, Queue())
+        start = time.time()
+        fed = replay(self.path, itr, speed=None)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(fed, sum(len(data) for (offset, data) in frames))
+        self.assertEqual(itr.synchronizer.frames, 50)
+        self.assertAlmostEqual(itr.get_average_pressure(50) / 2e-6, 1., places=3)
+        # the readings got the recorded times:
+        reader = CaptureReader(self.path)
+        start_time = reader.start_time
+        reader.close()
+        (first, last) = (itr.pressure_history.tolist()[0][0], itr.last_update)
+        self.assertAlmostEqual(first - start_time, 0., places=6)
+        self.assertAlmostEqual(last - start_time, 49 * 0.016, places=6)
+        self.assertFalse('clock' in itr.__dict__)
+
+    def test_replay_speed(self):
+        gauge = SimulatedGauge(10, constant(1e-3))
+        self.write([(i * 0.016, gauge.frame(0)) for i in xrange(20)])
+        start = time.time()
+        replay(self.path, ITR(None, Queue()), speed=2.)
+        self.assertTrue(time.time() - start >= 19 * 0.016 / 2.)
+
+if __name__ == "__main__":
+    unittest.main()
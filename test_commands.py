@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+""" Runs the CommandScheduler of an ITR object against a SimulatedGauge,
+frame by frame in the test thread. """
+
+import time
+import unittest
+from Queue import Queue, Empty
+from Leybold import ITR, ITR90, CommandTimeout, CommandSuperseded
+from simulator import SimulatedGauge, constant
+
+class CommandSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gauge = SimulatedGauge(10, constant(1e-3))
+        self.itr = ITR(None, Queue())
+        self.scheduler = self.itr.command_scheduler
+        self.sent = []
+        self.frame()
+        self.assertTrue(isinstance(self.itr, ITR90))
+
+    def messages(self):
+        """ The messages the ITR sent since the last call """
+        messages = []
+        while True:
+            try:
+                messages.append(self.itr.out_queue.get_nowait())
+            except Empty:
+                return messages
+
+    def frame(self, deliver=True):
+        """ Hands the sent commands to the gauge (unless the line is broken)
+            and feeds the next frame of the gauge to the ITR. """
+        for message in self.messages():
+            self.sent.append(message)
+            if deliver: self.gauge.receive(message)
+        self.itr.synchronizer.feed(self.gauge.frame(time.time()))
+
+    def test_confirmation(self):
+        command = self.itr.set_unit_Torr()
+        self.assertEqual(command.state, 'sent')
+        self.frame()
+        self.assertEqual(command.state, 'confirmed')
+        self.assertEqual(self.itr.pressure_unit, 1)
+        self.assertTrue(command.result(0) >= 0.)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_identical_commands_are_coalesced(self):
+        command = self.itr.set_unit_Torr()
+        self.assertTrue(self.itr.set_unit_Torr() is command)
+        pending = self.itr.set_degas(True)
+        self.assertTrue(self.itr.set_degas(True) is pending)
+        self.frame()
+        self.frame()
+        self.frame()
+        self.assertEqual(command.state, 'confirmed')
+        self.assertEqual(pending.state, 'confirmed')
+        self.assertEqual(len(self.sent), 2)
+
+    def test_pending_command_is_superseded(self):
+        in_flight = self.itr.set_unit_Torr()
+        older = self.itr.set_unit_Pa()
+        newer = self.itr.set_unit_mbar()
+        self.assertEqual(older.state, 'superseded')
+        self.assertRaises(CommandSuperseded, older.result, 0)
+        for i in range(3):
+            self.frame()
+        self.assertEqual(in_flight.state, 'confirmed')
+        self.assertEqual(newer.state, 'confirmed')
+        self.assertEqual(self.itr.pressure_unit, 0)
+        self.assertEqual(self.gauge.commands, 2)
+
+    def test_degas_off_has_priority(self):
+        self.itr.set_degas(True)
+        self.frame()
+        self.assertEqual(self.itr.emission_state, 3)
+        unit = self.itr.set_unit_Torr()
+        degas_off = self.itr.set_degas(False)
+        # sent right away, although the unit change is not confirmed yet:
+        self.assertEqual(degas_off.state, 'sent')
+        self.assertTrue(self.scheduler.in_flight is degas_off)
+        self.assertEqual([message[1:4] for message in self.messages()], ['\x10\x3e\x01', '\x10\x5d\x69'])
+        self.gauge.receive('\x03\x10\x5d\x69' + chr(ITR.checksum256('\x10\x5d\x69')))
+        self.frame()
+        self.assertEqual(degas_off.state, 'confirmed')
+        # the interrupted unit change is sent again if needed:
+        for i in range(2):
+            self.frame()
+        self.assertEqual(unit.state, 'confirmed')
+        self.assertEqual(self.itr.pressure_unit, 1)
+
+    def test_retries_and_timeout(self):
+        self.scheduler.confirm_timeout = 0.01
+        command = self.itr.set_unit_Torr()
+        while not command.done():
+            time.sleep(0.02)
+            self.frame(deliver=False)
+        self.assertEqual(command.state, 'timeout')
+        self.assertEqual(command.attempts, self.scheduler.retries + 1)
+        self.assertEqual(len(self.sent), self.scheduler.retries + 1)
+        self.assertRaises(CommandTimeout, command.result, 0)
+        # the next command is sent after the timeout:
+        following = self.itr.set_unit_Pa()
+        self.frame()
+        self.assertEqual(following.state, 'confirmed')
+
+    def test_retry_is_confirmed(self):
+        self.scheduler.confirm_timeout = 0.01
+        command = self.itr.set_unit_Torr()
+        time.sleep(0.02)
+        self.frame(deliver=False)
+        self.assertEqual(command.attempts, 2)
+        self.frame()
+        self.assertEqual(command.state, 'confirmed')
+
+    def test_timeout_without_frames(self):
+        # a gauge which stopped sending doesn't confirm anything:
+        self.scheduler.confirm_timeout = 0.01
+        command = self.itr.set_unit_Torr()
+        for i in range(self.scheduler.retries + 1):
+            time.sleep(0.02)
+            self.scheduler.expire()
+        self.assertEqual(command.state, 'timeout')
+
+    def test_unit_change_clears_history_at_next_frame(self):
+        for i in range(5):
+            self.frame()
+        command = self.itr.set_unit_Pa()
+        self.frame()
+        self.assertEqual(command.state, 'confirmed')
+        self.frame()
+        self.assertEqual(len(self.itr.pressure_history), 1)
+        self.assertAlmostEqual(self.itr.get_average_pressure() / 0.1, 1., places=3)
+
+if __name__ == "__main__":
+    unittest.main()
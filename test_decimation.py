@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+""" Checks the decimated histories against the readings appended to them. """
+
+import unittest
+from Leybold import PressureHistory
+from decimation import EveryNth, Buckets
+
+interval = 0.016
+
+class DecimationTest(unittest.TestCase):
+
+    def test_every_nth(self):
+        history = EveryNth(PressureHistory(100), 10)
+        for i in xrange(95):
+            history.append(i * interval, float(i))
+        self.assertEqual([value for (timestamp, value) in history.tolist()], [float(i) for i in xrange(0, 95, 10)])
+        self.assertAlmostEqual(history.rate(), 1. / interval)
+
+    def test_buckets(self):
+        history = Buckets(PressureHistory(100), frames=4)
+        for i in xrange(10):
+            history.append(i * interval, float(i))
+        self.assertEqual([value for (timestamp, value) in history.tolist()], [1.5, 5.5])
+        for (statistic, expected) in (('min', [0., 4.]), ('max', [3., 7.]), ('last', [3., 7.])):
+            self.assertEqual([value for (timestamp, value) in history.statistics[statistic].tolist()], expected)
+        self.assertEqual(history.readings_per_sample, 4)
+        history.clear()
+        self.assertEqual(len(history), 0)
+        self.assertEqual(len(history.statistics['max']), 0)
+
+if __name__ == "__main__":
+    unittest.main()
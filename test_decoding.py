@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+""" Compares the pressures decoded with the lookup tables of the ITR with
+those computed with a power per reading. """
+
+import unittest
+from Queue import Queue
+from sampledata import sample_itr90
+from simulator import SimulatedGauge, constant
+from Leybold import ITR
+
+class LookupTableTest(unittest.TestCase):
+
+    def test_tables_match_pow(self):
+        for pressure_unit in ITR.pressure_units:
+            table = ITR.pressure_table(pressure_unit)
+            self.assertEqual(len(table), 65536)
+            for counts in xrange(0, 65536, 7):
+                self.assertAlmostEqual(table[counts] / ITR.counts_to_pressure(counts, pressure_unit), 1., places=12)
+        self.assertTrue(ITR.pressure_table(0) is ITR.pressure_table(0))
+
+    def decode(self, chunks, lookup_tables):
+        itr = ITR(None, Queue(), lookup_tables=lookup_tables)
+        pressures = []
+        itr.add_listener(lambda itr: pressures.append((itr.pressure, itr.pressure_unit)))
+        for chunk in chunks:
+            itr.synchronizer.feed(chunk)
+        return pressures
+
+    def test_sample_data(self):
+        pressures = self.decode(sample_itr90, lookup_tables=True)
+        self.assertTrue(pressures)
+        self.assertEqual(pressures, self.decode(sample_itr90, lookup_tables=False))
+
+    def test_all_units(self):
+        for pressure_unit in ITR.pressure_units:
+            gauge = SimulatedGauge(12, constant(2e-6))
+            gauge.pressure_unit = pressure_unit
+            frames = [gauge.frame(i) for i in xrange(3)]
+            self.assertEqual(self.decode(frames, lookup_tables=True), self.decode(frames, lookup_tables=False))
+
+if __name__ == "__main__":
+    unittest.main()
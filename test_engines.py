@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+""" Runs each acquisition engine against simulated gauges on pseudo
+terminals (Unix only). """
+
+import os
+import sys
+import time
+import unittest
+from StringIO import StringIO
+from simulator import GaugeSimulator, SimulatedGauge, constant, unit_factors
+from acquisition import GaugeAcquisition
+from Leybold import ITR90, ITR200
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'the simulator needs pseudo terminals')
+class EngineTestMixin(object):
+    """ The tests shared by all engines, each test case sets `engine` """
+
+    def setUp(self):
+        self.simulated = [SimulatedGauge(10, constant(1e-3)), SimulatedGauge(12, constant(2e-6))]
+        self.simulator = GaugeSimulator(self.simulated, 0.005)
+        self.simulator.start()
+        self.acquisition = GaugeAcquisition(self.simulator.device_names, engine=self.engine, workers=2, debug=False)
+        self.acquisition.start()
+        self.gauges = [self.acquisition.gauges[device_name] for device_name in self.simulator.device_names]
+
+    def tearDown(self):
+        self.acquisition.close()
+        self.simulator.close()
+        self.simulator.join()
+
+    def wait_for(self, condition, timeout=10.):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail('timed out')
+            time.sleep(0.02)
+
+    def test_readings(self):
+        self.wait_for(lambda: all(gauge.state.sequence > 50 for gauge in self.gauges))
+        for (gauge, sensor_type, pressure) in zip(self.gauges, (ITR90, ITR200), (1e-3, 2e-6)):
+            state = gauge.state
+            self.assertTrue(state.sensor_type is sensor_type)
+            self.assertEqual(state.pressure_unit, 0)
+            self.assertAlmostEqual(state.pressure / pressure, 1., places=3)
+            self.assertAlmostEqual(gauge.get_average_pressure(30) / pressure, 1., places=3)
+            self.assertTrue(gauge.get_frame_rate() > 50.)
+
+    def test_unit_change(self):
+        self.wait_for(lambda: self.gauges[0].state.sequence > 10)
+        self.gauges[0].set_unit_Torr()
+        self.wait_for(lambda: self.gauges[0].state.pressure_unit == 1)
+        self.assertEqual(self.simulated[0].pressure_unit, 1)
+        # the history is cleared with the next reading, so the average doesn't mix units:
+        sequence = self.gauges[0].state.sequence
+        self.wait_for(lambda: self.gauges[0].state.sequence > sequence + 1)
+        self.assertAlmostEqual(self.gauges[0].get_average_pressure(1000) / (1e-3 * unit_factors[1]), 1., places=3)
+
+class ThreadsTest(EngineTestMixin, unittest.TestCase):
+    engine = 'threads'
+
+    def test_failing_listener(self):
+        def fail(itr):
+            raise IOError('disk full')
+        self.gauges[0].add_listener(fail)
+        (stderr, sys.stderr) = (sys.stderr, StringIO())
+        try:
+            sequence = self.gauges[0].state.sequence
+            self.wait_for(lambda: self.gauges[0].state.sequence > sequence + 10)
+            self.assertTrue('IOError: disk full' in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+class EventLoopTest(EngineTestMixin, unittest.TestCase):
+    engine = 'eventloop'
+
+class ProcessesTest(EngineTestMixin, unittest.TestCase):
+    engine = 'processes'
+
+if __name__ == "__main__":
+    unittest.main()
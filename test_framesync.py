@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+""" Compares the FrameSynchronizer with the former slide-by-one
+synchronisation on recorded data with line noise. """
+
+import random
+import unittest
+from sampledata import sample_itr90
+from Leybold import ITR, FrameSynchronizer
+
+def slide_by_one(chunks):
+    """ The frames found by the former ITR.read_from_queue() """
+    frames = []
+    str_buffer = ""
+    for chunk in chunks:
+        str_buffer += chunk
+        while len(str_buffer) >= ITR.msg_size_bytes:
+            msg = str_buffer[:9]
+            if ITR.valid_message(msg):
+                frames.append(msg)
+                str_buffer = str_buffer[9:]
+            else:
+                str_buffer = str_buffer[1:]
+    return frames
+
+def synchronize(chunks):
+    frames = []
+    synchronizer = FrameSynchronizer(frames.append)
+    for chunk in chunks:
+        synchronizer.feed(chunk)
+    return (frames, synchronizer)
+
+def noisy_stream(seed, length=20000):
+    """ The sample data with bytes dropped, corrupted and inserted; the
+        inserted bytes are often header or fixed bytes to provoke resyncs. """
+    rnd = random.Random(seed)
+    data = bytearray(''.join(sample_itr90) * (length // len(''.join(sample_itr90)) + 1))
+    for i in xrange(len(data) // 50):
+        position = rnd.randrange(len(data))
+        kind = rnd.random()
+        if kind < 0.3:
+            del data[position:position + rnd.randint(1, 5)]
+        elif kind < 0.6:
+            data[position] = rnd.randrange(256)
+        else:
+            data[position:position] = bytearray(rnd.choice('\x07\x05\x00\xf2') for j in xrange(rnd.randint(1, 12)))
+    return str(data)
+
+def random_chunks(data, seed):
+    rnd = random.Random(seed)
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rnd.choice((1, 2, 5, 9, 17, 64, 600))
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+class FrameSynchronizerTest(unittest.TestCase):
+
+    def test_sample_data(self):
+        (frames, synchronizer) = synchronize(sample_itr90)
+        self.assertEqual(frames, slide_by_one(sample_itr90))
+        self.assertEqual(synchronizer.frames, len(frames))
+        self.assertEqual(synchronizer.checksum_errors, 0)
+
+    def test_noisy_data_in_random_chunks(self):
+        for seed in range(20):
+            chunks = random_chunks(noisy_stream(seed), seed)
+            (frames, synchronizer) = synchronize(chunks)
+            expected = slide_by_one(chunks)
+            self.assertEqual(frames, expected, 'seed %d' % seed)
+            # every byte is either part of a frame, skipped or still buffered:
+            self.assertEqual(synchronizer.bytes_received, 9 * len(frames) + synchronizer.skipped_bytes + len(synchronizer.buffer))
+
+    def test_partial_frame_is_kept(self):
+        frame = ''.join(sample_itr90)[5:14]
+        self.assertTrue(ITR.valid_message(frame))
+        (frames, synchronizer) = synchronize([frame[:4]])
+        self.assertEqual(frames, [])
+        synchronizer.feed(frame[4:])
+        self.assertEqual(frames, [frame])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+""" Runs a GaugeDaemon with simulated gauges (Unix only) and talks to it
+through a GaugeDaemonClient. """
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from simulator import GaugeSimulator, SimulatedGauge, constant, unit_factors
+from acquisition import GaugeAcquisition
+from gaugedaemon import GaugeDaemon, GaugeDaemonClient, DaemonError, pack_name, STATE, COMMAND, WAIT, WAIT_QUERY, OK, ERROR
+from Leybold import ITR90, ITR200
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'the simulator needs pseudo terminals')
+class GaugeDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulated = [SimulatedGauge(10, constant(1e-3)), SimulatedGauge(12, constant(2e-6))]
+        self.simulator = GaugeSimulator(self.simulated, 0.005)
+        self.simulator.start()
+        self.device_names = self.simulator.device_names
+        self.acquisition = GaugeAcquisition(self.device_names, engine='eventloop', debug=False)
+        self.acquisition.start()
+        self.directory = tempfile.mkdtemp(prefix='test_gaugedaemon')
+        self.daemon = GaugeDaemon(os.path.join(self.directory, 'gauges.sock'), self.acquisition)
+        self.thread = threading.Thread(target=self.daemon.serve_forever, kwargs=dict(poll_interval=0.05))
+        self.thread.start()
+        self.client = GaugeDaemonClient(self.daemon.server_address)
+        self.gauges = self.client.gauges()
+        self.wait_for(lambda: all(self.gauges[name].state.sequence > 50 for name in self.device_names))
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.shutdown()
+        self.thread.join()
+        self.daemon.server_close()
+        self.acquisition.close()
+        self.simulator.close()
+        self.simulator.join()
+        shutil.rmtree(self.directory)
+
+    def wait_for(self, condition, timeout=10.):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail('timed out')
+            time.sleep(0.02)
+
+    def test_gauges(self):
+        self.assertEqual(self.client.list_gauges(), sorted(self.device_names))
+        for (name, sensor_type, pressure) in zip(self.device_names, (ITR90, ITR200), (1e-3, 2e-6)):
+            gauge = self.gauges[name]
+            state = gauge.state
+            self.assertTrue(state.sensor_type is sensor_type)
+            self.assertEqual(state.pressure_unit, 0)
+            self.assertAlmostEqual(state.pressure / pressure, 1., places=3)
+            self.assertAlmostEqual(gauge.get_average_pressure(30) / pressure, 1., places=3)
+            self.assertTrue(gauge.get_frame_rate() > 50.)
+            (num_points, chunks) = gauge.get_history(max_points=20)
+            self.assertTrue(10 <= num_points <= 20)
+            self.assertEqual(len(chunks[0]), 2 * num_points)
+
+    def test_pipelined_requests(self):
+        requests = [(STATE, pack_name(name)) for name in self.device_names] + [(STATE, pack_name('nonexistent'))]
+        responses = self.client.pipeline(requests)
+        self.assertEqual([status for (status, payload) in responses], [OK, OK, ERROR])
+        self.assertRaises(DaemonError, self.client.request, STATE, pack_name('nonexistent'))
+        self.assertRaises(DaemonError, self.client.request, 99, pack_name(self.device_names[0]))
+        self.assertTrue('leybold_frames_total{device="%s"}' % self.device_names[0] in self.client.metrics())
+
+    def test_command_and_wait(self):
+        gauge = self.gauges[self.device_names[0]]
+        command = gauge.set_unit_Torr()
+        self.assertTrue(command.to_dict()['state'] in ('sent', 'confirmed'))
+        self.assertTrue(command.wait(5.))
+        self.assertEqual(command.to_dict()['state'], 'confirmed')
+        self.assertEqual(self.simulated[0].pressure_unit, 1)
+        self.wait_for(lambda: gauge.state.pressure_unit == 1)
+        self.assertAlmostEqual(gauge.state.pressure / (1e-3 * unit_factors[1]), 1., places=3)
+        self.assertRaises(DaemonError, self.client.request, COMMAND, pack_name(self.device_names[0]) + pack_name('bogus'))
+
+    def test_wait_for_stalled_gauge(self):
+        # a gauge which stopped sending doesn't confirm the command:
+        self.simulated[0].stalled_until = time.time() + 100.
+        gauge = self.gauges[self.device_names[0]]
+        command = gauge.set_unit_Pa()
+        start = time.time()
+        self.assertFalse(command.wait(0.3))
+        self.assertTrue(0.3 <= time.time() - start < 1.)
+        self.assertEqual(command.to_dict()['state'], 'sent')
+        # and times out after all retries:
+        self.assertTrue(command.wait(10.))
+        self.assertEqual(command.to_dict()['state'], 'timeout')
+        payload = pack_name(self.device_names[0]) + WAIT_QUERY.pack(command.to_dict()['id'] + 1000, 0.)
+        self.assertRaises(DaemonError, self.client.request, WAIT, payload)
+
+if __name__ == "__main__":
+    unittest.main()
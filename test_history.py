@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+""" Checks the pressure histories against a plain list of all samples,
+before and after wrapping around and after clear(). """
+
+import math
+import random
+import sys
+import threading
+import unittest
+from Leybold import PressureHistory, RunLengthHistory, NoDataError
+
+interval = 0.016
+
+class HistoryTestMixin(object):
+    """ The tests shared by both history types, which implement make_history() """
+    capacity = 16
+
+    def setUp(self):
+        self.history = self.make_history()
+        self.samples = []
+        self.rnd = random.Random(1)
+        self.time = 1000.
+
+    def append(self, num_samples):
+        for i in xrange(num_samples):
+            # runs of identical readings, as sent by a gauge in a stable vacuum:
+            value = self.rnd.choice((1e-3, 1e-3, 1e-3, 2e-3, 5e-7))
+            self.time += interval
+            self.history.append(self.time, value)
+            self.samples.append((self.time, value))
+
+    def kept(self):
+        """ The samples the history should hold """
+        return self.samples[len(self.samples) - len(self.history):]
+
+    def check(self):
+        history = self.history
+        kept = self.kept()
+        self.assertTrue(0 < len(history) <= len(self.samples))
+        self.assertEqual(history.written, self.written + len(self.samples))
+        self.assertSamplesEqual(history.tolist(), kept)
+        self.assertEqual(history.latest(), kept[-1])
+        for num_samples in (1, 2, 5, len(kept), len(kept) + 10):
+            expected = [value for (timestamp, value) in kept[-num_samples:]]
+            self.assertAlmostEqual(history.mean(num_samples) / (math.fsum(expected) / len(expected)), 1.)
+        first_sequence = history.written - len(kept)
+        for (t_from, t_to) in ((None, None), (kept[2][0], None), (None, kept[-3][0]),
+                               (kept[1][0] - interval / 2, kept[-2][0] + interval / 2), (0., 1.), (1e10, None)):
+            (first, last) = history.select(t_from, t_to)
+            expected = [(timestamp, value) for (timestamp, value) in kept
+                        if (t_from is None or timestamp >= t_from) and (t_to is None or timestamp < t_to)]
+            self.assertEqual(last - first, len(expected))
+            if expected:
+                self.assertEqual(first, first_sequence + kept.index(expected[0]))
+            for stride in (1, 3):
+                data = [value for chunk in history.chunks(first, last, stride, chunk_size=4) for value in chunk]
+                self.assertSamplesEqual(zip(data[0::2], data[1::2]), expected[::stride])
+
+    def assertSamplesEqual(self, samples, expected):
+        self.assertEqual(len(samples), len(expected))
+        for ((timestamp, value), (expected_time, expected_value)) in zip(samples, expected):
+            self.assertAlmostEqual(timestamp, expected_time, places=6)
+            self.assertEqual(value, expected_value)
+
+    def test_before_wrap(self):
+        self.written = 0
+        self.append(self.capacity // 2)
+        self.check()
+
+    def test_after_wrap(self):
+        self.written = 0
+        for i in range(10):
+            self.append(self.capacity // 2 + 1)
+            self.check()
+
+    def test_clear(self):
+        self.append(self.capacity * 3)
+        self.history.clear()
+        self.assertEqual(len(self.history), 0)
+        self.assertEqual(self.history.tolist(), [])
+        self.assertRaises(NoDataError, self.history.latest)
+        self.assertRaises(NoDataError, self.history.mean, 10)
+        self.assertEqual(self.history.select(), (self.history.written, self.history.written))
+        # the sequence numbers go on after a clear:
+        self.written = self.history.written
+        self.samples = []
+        self.append(self.capacity * 2)
+        self.check()
+
+class PressureHistoryTest(HistoryTestMixin, unittest.TestCase):
+
+    def make_history(self):
+        return PressureHistory(self.capacity)
+
+    def test_capacity(self):
+        self.append(self.capacity * 3)
+        self.assertEqual(len(self.history), self.capacity)
+
+    def test_mean_after_drop_by_orders_of_magnitude(self):
+        # the running sums cancel out, the mean must not:
+        for i in xrange(self.capacity - 4):
+            self.history.append(i, 1000.)
+        for i in xrange(4):
+            self.history.append(i, 1e-9)
+        self.assertAlmostEqual(self.history.mean(4) / 1e-9, 1.)
+
+    def test_mean_while_appending(self):
+        # mean() in another thread must not mix the running sums before and after a wrap:
+        for i in xrange(self.capacity):
+            self.history.append(i, 1e-6)
+        done = threading.Event()
+        def append():
+            for i in xrange(20000):
+                self.history.append(i, 1e-6)
+            done.set()
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            thread = threading.Thread(target=append)
+            thread.start()
+            while not done.is_set():
+                for num_samples in (1, self.capacity // 2, self.capacity - 1, self.capacity):
+                    self.assertAlmostEqual(self.history.mean(num_samples) / 1e-6, 1.)
+            thread.join()
+        finally:
+            sys.setcheckinterval(check_interval)
+
+class RunLengthHistoryTest(HistoryTestMixin, unittest.TestCase):
+
+    def make_history(self):
+        return RunLengthHistory(self.capacity)
+
+    def test_runs(self):
+        for i in xrange(1000):
+            self.history.append(i * interval, 1e-3)
+        self.assertEqual(len(self.history), 1000)
+        self.assertEqual(self.history._count, 1)
+        self.assertAlmostEqual(self.history.rate(), 1. / interval)
+
+    def test_gap_starts_new_run(self):
+        self.history.append(0., 1e-3)
+        self.history.append(RunLengthHistory.max_gap * 2, 1e-3)
+        self.assertEqual(self.history._count, 2)
+        self.assertEqual(self.history.tolist(), [(0., 1e-3), (RunLengthHistory.max_gap * 2, 1e-3)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+""" Checks the buckets of the Rollup levels against the values added. """
+
+import unittest
+from Queue import Queue
+from metrics import Rollup
+from simulator import SimulatedGauge, constant, unit_factors
+from Leybold import ITR
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rollup = Rollup(((1, 10), (5, 4), (20, 100)))
+
+    def add_seconds(self, start, stop, per_second=4):
+        for i in xrange(start * per_second, stop * per_second):
+            self.rollup.add(float(i) / per_second, float(i // per_second))
+
+    def test_cascade(self):
+        self.add_seconds(0, 42)
+        # the finest level keeps the last 10 completed buckets and the current one:
+        buckets = self.rollup.level(1).buckets()
+        self.assertEqual([bucket.start for bucket in buckets], range(31, 42))
+        self.assertEqual([bucket.count for bucket in buckets], [4] * 11)
+        # the 5 s buckets are merged from completed 1 s buckets:
+        buckets = self.rollup.level(5).buckets()
+        self.assertEqual([bucket.start for bucket in buckets], [20, 25, 30, 35, 40])
+        self.assertEqual([bucket.to_dict()['mean'] for bucket in buckets[:-1]], [22., 27., 32., 37.])
+        self.assertEqual((buckets[-1].minimum, buckets[-1].maximum, buckets[-1].count), (40., 40., 4))
+        buckets = self.rollup.level(20).buckets()
+        self.assertEqual([(bucket.start, bucket.count) for bucket in buckets], [(0, 80), (20, 80)])
+        self.assertEqual(buckets[0].mean, 9.5)
+        self.assertRaises(KeyError, self.rollup.level, 2)
+
+    def test_query(self):
+        self.add_seconds(0, 42)
+        (seconds, buckets) = self.rollup.query(35, 40)
+        self.assertEqual(seconds, 1)
+        self.assertEqual([bucket.start for bucket in buckets], range(35, 40))
+        # the finest level doesn't reach back far enough:
+        (seconds, buckets) = self.rollup.query(22, 40)
+        self.assertEqual(seconds, 5)
+        self.assertEqual([bucket.start for bucket in buckets], [20, 25, 30, 35])
+        # nor does it fit into 4 buckets:
+        (seconds, buckets) = self.rollup.query(35, None, max_buckets=4)
+        self.assertEqual((seconds, len(buckets)), (5, 2))
+        (seconds, buckets) = self.rollup.query(None, None, max_buckets=4)
+        self.assertEqual((seconds, len(buckets)), (20, 2))
+
+    def test_unit_change(self):
+        gauge = SimulatedGauge(10, constant(1e-3))
+        itr = ITR(None, Queue())
+        itr.add_listener(self.rollup)
+        for i in xrange(4):
+            itr.synchronizer.feed(gauge.frame(i))
+        itr.set_unit_Torr()
+        gauge.receive(itr.out_queue.get_nowait())
+        for i in xrange(4):
+            itr.synchronizer.feed(gauge.frame(i))
+        self.assertAlmostEqual(itr.pressure / (1e-3 * unit_factors[1]), 1., places=3)
+        # the buckets keep all readings, in mbar:
+        buckets = self.rollup.level(1).buckets()
+        self.assertEqual(sum(bucket.count for bucket in buckets), 8)
+        for bucket in buckets:
+            self.assertAlmostEqual(bucket.minimum / 1e-3, 1., places=3)
+            self.assertAlmostEqual(bucket.maximum / 1e-3, 1., places=3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+""" Writes a pressure log over several segments and checks range queries
+against a plain list of all records. """
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from array import array
+from pressurelog import PressureLogWriter, PressureLogReader, pressure_log_path
+
+class PressureLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_pressurelog')
+        self.path = pressure_log_path(self.directory, '/dev/ttyUSB0')
+        self.records = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, num_records, **kwargs):
+        writer = PressureLogWriter(self.path, **kwargs)
+        for i in xrange(num_records):
+            timestamp = 1000. + 0.5 * len(self.records)
+            writer.append(timestamp, 1e-3 * len(self.records))
+            self.records.append((timestamp, 1e-3 * len(self.records)))
+        writer.close()
+
+    def expected(self, t_from, t_to):
+        return [(timestamp, pressure) for (timestamp, pressure) in self.records
+                if (t_from is None or timestamp >= t_from) and (t_to is None or timestamp < t_to)]
+
+    def check_query(self, reader, t_from, t_to):
+        data = reader.query(t_from, t_to)
+        self.assertEqual(zip(data[0::2], data[1::2]), self.expected(t_from, t_to), 'query(%s, %s)' % (t_from, t_to))
+
+    def test_path(self):
+        self.assertEqual(os.path.basename(self.path), 'dev_ttyUSB0')
+
+    def test_round_trip(self):
+        self.write(1000, segment_records=100, index_every=8, batch_size=16)
+        reader = PressureLogReader(self.path)
+        self.assertEqual([start for (start, name) in reader.segments()], [1000. + 50. * i for i in xrange(10)])
+        self.check_query(reader, None, None)
+        data = array('d')
+        for chunk in reader.iter_raw(chunk_records=7):
+            self.assertTrue(len(chunk) <= 7 * 16)
+            data.fromstring(chunk)
+        self.assertEqual(len(data), 2 * len(self.records))
+
+    def test_index_search_across_segments(self):
+        self.write(1000, segment_records=100, index_every=8, batch_size=16)
+        reader = PressureLogReader(self.path)
+        first, last = self.records[0][0], self.records[-1][0]
+        # segment and index boundaries, times between records and outside of the log:
+        bounds = [None, first - 10., first, 1004., 1004.25, 1049.5, 1050., 1050.25, 1149.75, 1200., last, last + 10.]
+        rnd = random.Random(1)
+        bounds += [rnd.uniform(first - 5., last + 5.) for i in xrange(20)]
+        for t_from in bounds:
+            for t_to in bounds:
+                self.check_query(reader, t_from, t_to)
+
+    def test_reopened_log(self):
+        self.write(150, segment_records=100, index_every=8, batch_size=16)
+        # a second writer (e.g. after a restart) starts a new segment:
+        self.write(130, segment_records=100, index_every=8, batch_size=1000)
+        reader = PressureLogReader(self.path)
+        self.assertEqual(len(reader.segments()), 4)
+        self.check_query(reader, None, None)
+        self.check_query(reader, 1060., 1100.)
+
+if __name__ == "__main__":
+    unittest.main()
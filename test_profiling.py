@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+""" Switches the profiling hooks of an ITR object on and off while feeding
+it frames of a SimulatedGauge. """
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from Queue import Queue
+from profiling import GaugeProfiler, itr_stages
+from simulator import SimulatedGauge, constant
+from Leybold import ITR, ITR90
+
+class GaugeProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gauge = SimulatedGauge(10, constant(1e-3))
+        self.itr = ITR(None, Queue())
+        self.profiler = GaugeProfiler(dict(gauge=self.itr))
+        self.directory = tempfile.mkdtemp(prefix='test_profiling')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def feed(self, num_frames):
+        for i in xrange(num_frames):
+            self.itr.synchronizer.feed(self.gauge.frame(i))
+
+    def counts(self):
+        return dict((stage, timer['count']) for (stage, timer) in self.profiler.stats()['gauge'].items())
+
+    def assertUninstalled(self):
+        for stage in itr_stages:
+            self.assertFalse(stage in self.itr.__dict__)
+        self.assertFalse('feed' in self.itr.synchronizer.__dict__)
+        self.assertEqual(self.itr.synchronizer.callback, self.itr.parse_status)
+
+    def test_enable_disable(self):
+        self.profiler.enable()
+        for stage in itr_stages:
+            self.assertTrue(stage in self.itr.__dict__)
+        self.feed(10)
+        # the class changes with the first frame, the wrappers call the methods of the new one:
+        self.assertTrue(isinstance(self.itr, ITR90))
+        counts = self.counts()
+        for stage in ('feed', 'parse_status', 'check_message', 'parse_state', 'parse_pressure'):
+            self.assertEqual(counts[stage], 10, stage)
+        self.assertEqual(counts['fix_gauge_type'], 1)
+        self.assertEqual(counts['queue'], 0) # no in_queue
+        self.profiler.disable()
+        self.assertUninstalled()
+        self.feed(5)
+        self.assertEqual(self.counts(), counts)
+        self.assertAlmostEqual(self.itr.pressure / 1e-3, 1., places=3)
+
+    def test_toggle_and_reset(self):
+        self.profiler.configure(enabled=True)
+        self.feed(3)
+        self.profiler.toggle()
+        self.assertFalse(self.profiler.enabled)
+        self.assertUninstalled()
+        self.profiler.configure(reset=True)
+        self.assertEqual(set(self.counts().values()), set([0]))
+        self.profiler.toggle()
+        self.feed(2)
+        self.assertEqual(self.counts()['parse_status'], 2)
+        self.assertTrue(self.profiler.state()['enabled'])
+
+    def test_cprofile_window(self):
+        path = os.path.join(self.directory, 'ingest.prof')
+        self.profiler.enable()
+        self.assertTrue(self.profiler.run_cprofile(0.1, path))
+        self.assertFalse(self.profiler.run_cprofile(0.1, path))
+        self.assertTrue(self.profiler.state()['cprofile_running'])
+        self.feed(10)
+        self.profiler.profile_timer.join()
+        self.assertFalse(self.profiler.state()['cprofile_running'])
+        functions = [name for (filename, line, name) in pstats.Stats(path).stats]
+        self.assertTrue('parse_status' in functions)
+        # the stage timing stays installed after the window:
+        self.assertTrue('feed' in self.itr.synchronizer.__dict__)
+        self.profiler.disable()
+        self.assertUninstalled()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+""" Reads a shared history file while it is written, including records
+overwritten during the read. """
+
+import os
+import shutil
+import tempfile
+import unittest
+from Queue import Queue
+from shmhistory import SharedHistoryWriter, SharedHistoryReader, shared_history_path
+from simulator import SimulatedGauge, constant, unit_factors
+from Leybold import ITR, NoDataError
+
+class OverwritingReader(SharedHistoryReader):
+    """ Lets the writer append `appends` records after the reader chose the slots to copy """
+    writer = None
+    appends = 0
+
+    def _slot_ranges(self, start, end):
+        ranges = SharedHistoryReader._slot_ranges(self, start, end)
+        for i in xrange(self.appends):
+            sequence = self.writer.sequence
+            self.writer.append(sequence, sequence)
+        return ranges
+
+class SharedHistoryTest(unittest.TestCase):
+    capacity = 8
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_shmhistory')
+        self.path = shared_history_path(self.directory, '/dev/ttyUSB0')
+        self.writer = SharedHistoryWriter(self.path, self.capacity, device_name='/dev/ttyUSB0')
+        self.reader = OverwritingReader(self.path)
+        self.reader.writer = self.writer
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.directory)
+
+    def append(self, num_samples):
+        for i in xrange(num_samples):
+            sequence = self.writer.sequence
+            self.writer.append(sequence, sequence)
+
+    def records(self, data):
+        return zip(data[0::2], data[1::2])
+
+    def test_path(self):
+        self.assertEqual(os.path.basename(self.path), 'dev_ttyUSB0.hist')
+        self.assertEqual(self.reader.device_name, '/dev/ttyUSB0')
+
+    def test_read(self):
+        self.assertEqual(len(self.reader), 0)
+        self.assertRaises(NoDataError, self.reader.latest)
+        self.assertRaises(NoDataError, self.reader.mean, 10)
+        self.append(5)
+        self.assertEqual(self.records(self.reader.read()), [(float(i), float(i)) for i in xrange(5)])
+        self.append(15)
+        self.assertEqual(len(self.reader), self.capacity)
+        # the oldest record is dropped, the writer may be overwriting it:
+        self.assertEqual(self.records(self.reader.read()), [(float(i), float(i)) for i in xrange(13, 20)])
+        self.assertEqual(self.records(self.reader.read(3)), [(17., 17.), (18., 18.), (19., 19.)])
+        self.assertEqual(self.reader.latest(), (19., 19.))
+        self.assertEqual(self.reader.mean(4), 17.5)
+
+    def test_overwritten_while_reading(self):
+        self.append(20)
+        for appends in (1, 3, self.capacity - 2, self.capacity):
+            self.reader.appends = appends
+            records = self.records(self.reader.read())
+            end = self.writer.sequence - appends
+            # only the records which weren't overwritten while copying:
+            self.assertEqual(len(records), max(self.capacity - 1 - appends, 0))
+            self.assertEqual(records, [(float(i), float(i)) for i in xrange(end - len(records), end)])
+
+    def test_itr_listener_stores_mbar(self):
+        gauge = SimulatedGauge(10, constant(1e-3))
+        itr = ITR(None, Queue())
+        itr.add_listener(self.writer, decimated=True)
+        for i in xrange(3):
+            itr.synchronizer.feed(gauge.frame(i))
+        itr.set_unit_Torr()
+        gauge.receive(itr.out_queue.get_nowait())
+        for i in xrange(3):
+            itr.synchronizer.feed(gauge.frame(i))
+        self.assertAlmostEqual(itr.pressure / (1e-3 * unit_factors[1]), 1., places=3)
+        self.assertEqual(len(self.reader), 6)
+        for (timestamp, pressure) in self.records(self.reader.read()):
+            self.assertAlmostEqual(pressure / 1e-3, 1., places=3)
+
+if __name__ == "__main__":
+    unittest.main()
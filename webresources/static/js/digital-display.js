@@ -51,19 +51,40 @@ $.ajax({
     }
 });
 
+var show_pressures = function(pressure) {
+    for (var key in pressure) {
+        $('#'+slug(key)).children('.value').html(pressure[key]['pressure'].toExponential(3).replace(/e/g, 'E'));
+    }
+}
+
 var tv = 500;
-var iv = setInterval( function() {
-    $.ajax({
-        url:      'api/pressure/all',
-        method:   'GET',
-        dataType: 'json',
-        timeout:  1000,
-        success:  function(pressure) {
-            for (var key in pressure) {
-                $('#'+slug(key)).children('.value').html(pressure[key]['pressure'].toExponential(3).replace(/e/g, 'E'));
+var poll_pressures = function() {
+    return setInterval( function() {
+        $.ajax({
+            url:      'api/pressure/all',
+            method:   'GET',
+            dataType: 'json',
+            timeout:  1000,
+            success:  show_pressures,
+            error: function(xhr, textStatus, errorThrown){
             }
-        },
-        error: function(xhr, textStatus, errorThrown){
-        }
-    });
-}, tv );
\ No newline at end of file
+        });
+    }, tv );
+}
+
+if (window.EventSource) {
+    // the server pushes new values, fall back to polling if the stream is unavailable
+    var source = new EventSource('api/stream?interval=' + tv/1000);
+    var received = false;
+    source.onmessage = function(event) {
+        received = true;
+        show_pressures(JSON.parse(event.data));
+    };
+    source.onerror = function() {
+        if (received) return; // the browser reconnects by itself
+        source.close();
+        poll_pressures();
+    };
+} else {
+    poll_pressures();
+}